@@ -0,0 +1,449 @@
+import subprocess
+import sys
+import tempfile
+import time
+
+import museval
+import numpy as np
+import tensorflow as tf
+
+from Input import Input as Input
+from Input import urmp_input
+import Models.SeparatorFactory
+from Models.NumpyUnetAudioSeparator import NumpyUnetAudioSeparator
+import Evaluate
+import Training
+import Utils
+
+def load_separator(model_config, load_model, conditional=None):
+    '''
+    Builds the separator for single-example inference and restores its weights
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path
+    :param conditional: Whether the separator is conditioned on source labels. By default as Training.py trains it, i.e. for the unet network
+    :return: Dictionary with session, separator object, input/output shapes, front padding, output tensors and input placeholder,
+             plus the labels input [batch_size, num_sources] for conditional separators, which defaults to all sources
+    '''
+    if conditional is None:
+        conditional = model_config["network"] == "unet"
+    disc_input_shape = [1, model_config["num_frames"], 0]
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
+    pad_front = Evaluate.get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
+
+    placeholder_shapes = [[Evaluate.get_inference_batch_size(model_config)] + list(shape[1:]) for shape in [sep_input_shape, sep_output_shape]]
+    mix_context, _ = Input.get_multitrack_placeholders(placeholder_shapes[1], model_config["num_sources"], placeholder_shapes[0], "input")
+    if conditional:
+        labels = tf.placeholder_with_default(tf.ones(tf.stack([tf.shape(mix_context)[0], model_config["num_sources"]])),
+                                             [None, model_config["num_sources"]], name="labels")
+        separator_sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix_context, labels, False, reuse=False)
+    else:
+        separator_sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix_context, False, reuse=False)
+
+    sess = tf.Session(config=Utils.get_session_config(model_config["xla_inference"]))
+    sess.run(tf.global_variables_initializer())
+    restorer = tf.train.Saver(None, write_version=tf.train.SaverDef.V2)
+    restorer.restore(sess, load_model)
+
+    model = {"sess" : sess, "separator" : separator_class, "input_shape" : sep_input_shape, "output_shape" : sep_output_shape,
+             "pad_front" : pad_front, "sources" : separator_sources, "mix" : mix_context}
+    if conditional:
+        model["labels"] = labels
+    return model
+
+def evaluate_separator(model_config, model, audio_list, return_predictions=False):
+    '''
+    Separates all tracks and measures quality and processing time. Conditional separators get the sources that are not
+    silent in the ground truth of a track as labels, as in the training records
+    :param model: Dictionary as returned by load_separator, or with the NumPy inference engine (NumpyUnetAudioSeparator) under the key "engine"
+    :param audio_list: List of tracks as in Test.test, each a list of mixture followed by the sources
+    :param return_predictions: Whether to also return the source estimates of all tracks under the key "predictions"
+    :return: Dictionary with mean squared error, mean SNR over sources and tracks, median SDR over all non-silent source segments, and processing time per second of audio
+    '''
+    total_loss, total_samples, total_audio, total_time = 0.0, 0, 0.0, 0.0
+    snrs = list()
+    sdrs = list()
+    predictions = list()
+    for sample in audio_list:
+        mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
+        sources_gt = [Utils.load(s.path, sr=model_config["expected_sr"], mono=model_config["mono_downmix"] and not model_config["channels_as_batch"], res_type="kaiser_fast")[0]
+                      for s in sample[1:]]
+        labels = np.zeros([1, model_config["num_sources"]], np.float32)
+        labels[0, :len(sources_gt)] = [float(np.any(source_gt != 0)) for source_gt in sources_gt]
+
+        start = time.time()
+        if "engine" in model:
+            engine = model["engine"]
+            sources_pred = engine.separate(Evaluate.preprocess_mix(model_config, mix_audio, mix_sr), labels=labels[0] if engine.conditional else None)
+        else:
+            feed_dict = {model["labels"] : labels} if "labels" in model else None
+            sources_pred = Evaluate.predict_track(model_config, model["sess"], mix_audio, mix_sr, model["input_shape"], model["output_shape"],
+                                                  model["sources"], model["mix"], model["pad_front"], feed_dict)
+        total_time += time.time() - start
+        total_audio += mix_audio.shape[0] / float(mix_sr)
+        if return_predictions:
+            predictions.append(sources_pred)
+
+        for source_gt, source_pred in zip(sources_gt, sources_pred):
+            total_loss += np.sum(np.square(source_gt - source_pred))
+            total_samples += np.prod(source_gt.shape)
+            if np.sum(np.square(source_gt)) > 0:
+                snrs.append(Evaluate.alpha_snr(source_gt.flatten(), source_pred.flatten()))
+
+        sdr, _, _, _ = museval.evaluate(np.stack(sources_gt), np.stack(sources_pred), win=model_config["expected_sr"], hop=model_config["expected_sr"])
+        sdrs.append(sdr.flatten())
+
+    sdrs = np.concatenate(sdrs)
+    result = {"mse" : total_loss / float(total_samples),
+              "snr" : float(np.mean(snrs)) if len(snrs) > 0 else float("nan"),
+              "sdr" : float(np.nanmedian(sdrs)) if np.any(np.isfinite(sdrs)) else float("nan"),
+              "seconds_per_audio_second" : total_time / total_audio}
+    if return_predictions:
+        result["predictions"] = predictions
+    return result
+
+def print_table(results, columns):
+    print(" | ".join(["model"] + columns))
+    for result in results:
+        print(" | ".join([result["model"]] + ["%.4f" % result[c] if isinstance(result[c], float) else str(result[c]) for c in columns]))
+
+def latency_quality(models, audio_list):
+    '''
+    Compares algorithmic latency and separation quality of several models (e.g. unet and causal_unet) on the same tracks
+    :param models: List of (name, model_config, checkpoint path) tuples
+    :param audio_list: List of tracks as in Test.test
+    :return: List of result dictionaries, one per model
+    '''
+    results = list()
+    for name, model_config, load_model in models:
+        model = load_separator(model_config, load_model)
+        sr = float(model_config["expected_sr"])
+        lookahead = model["input_shape"][1] - model["output_shape"][1] - model["pad_front"] # Future samples needed per output sample
+        result = {"model" : name,
+                  "latency_ms" : 1000.0 * lookahead / sr,
+                  "past_context_ms" : 1000.0 * model["pad_front"] / sr}
+        result.update(evaluate_separator(model_config, model, audio_list))
+        results.append(result)
+
+        model["sess"].close()
+        tf.reset_default_graph()
+
+    print_table(results, ["latency_ms", "past_context_ms", "mse", "snr", "seconds_per_audio_second"])
+    return results
+
+def precision_policies(model_config, load_model, audio_list, policies=("float32", "float16", "bfloat16")):
+    '''
+    Compares throughput and numerical drift of the same checkpoint under different precision policies. Drift is measured
+    against the float32 source estimates, which are always computed first
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path
+    :param audio_list: List of tracks as in Test.test
+    :param policies: Precision policies to compare
+    :return: List of result dictionaries, one per policy
+    '''
+    policies = ["float32"] + [p for p in policies if p != "float32"]
+    results = list()
+    reference = None
+    for precision in policies:
+        config = dict(model_config)
+        config["precision"] = precision
+        model = load_separator(config, load_model)
+        result = evaluate_separator(config, model, audio_list, return_predictions=True)
+        predictions = result.pop("predictions")
+        model["sess"].close()
+        tf.reset_default_graph()
+
+        if reference is None:
+            reference = predictions
+        errors = np.concatenate([(pred - ref).flatten() for track, ref_track in zip(predictions, reference) for pred, ref in zip(track, ref_track)])
+        signal = np.concatenate([ref.flatten() for ref_track in reference for ref in ref_track])
+        result.update({"model" : precision,
+                       "audio_seconds_per_second" : 1.0 / result["seconds_per_audio_second"],
+                       "max_abs_drift" : float(np.max(np.abs(errors))),
+                       "drift_snr" : float(10 * np.log10(np.sum(np.square(signal)) / max(np.sum(np.square(errors)), 1e-20)))})
+        results.append(result)
+
+    print_table(results, ["audio_seconds_per_second", "max_abs_drift", "drift_snr", "mse", "snr"])
+    return results
+
+def get_peak_bytes(run_metadata):
+    '''
+    :param run_metadata: tf.RunMetadata of a session run traced with tf.RunOptions.FULL_TRACE
+    :return: Highest peak memory of all allocators on any device during that run, in bytes
+    '''
+    peaks = dict()
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                key = (dev_stats.device, memory.allocator_name)
+                peaks[key] = max(peaks.get(key, 0), memory.peak_bytes)
+    return max(peaks.values()) if len(peaks) > 0 else 0
+
+def training_step(model_config, num_steps=10, session_config=None):
+    '''
+    Builds one training step of the separator on random data and measures its step time and peak memory
+    :param model_config: Model configuration dictionary
+    :param num_steps: Number of timed training steps, after one untimed warm-up step
+    :param session_config: Optional tf.ConfigProto of the session
+    :return: Dictionary with seconds_per_step and peak_bytes
+    '''
+    conditional = model_config["network"] == "unet"
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array([model_config["batch_size"], model_config["num_frames"], 0]))
+    mix = tf.random_uniform([model_config["batch_size"], sep_input_shape[1], model_config["num_channels"]], -1.0, 1.0)
+    sources = tf.random_uniform([model_config["batch_size"], model_config["num_sources"], sep_output_shape[1], model_config["num_channels"]], -1.0, 1.0)
+
+    if conditional:
+        labels = tf.ones([model_config["batch_size"], model_config["num_sources"]])
+        separator_sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix, labels, True, reuse=False)
+    else:
+        separator_sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix, True, reuse=False)
+    loss = tf.reduce_mean(tf.squared_difference(tf.stack(separator_sources, axis=1), sources))
+    optimizer = tf.train.AdamOptimizer(model_config["init_sup_sep_lr"])
+    if model_config.get("gradient_accumulation_steps", 1) > 1:
+        train_op = Training.accumulate_gradients(optimizer, optimizer.compute_gradients(loss), tf.train.get_or_create_global_step(),
+                                                 model_config["gradient_accumulation_steps"])
+    else:
+        train_op = optimizer.minimize(loss)
+
+    with tf.Session(config=session_config) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(train_op)
+        start = time.time()
+        for _ in range(num_steps):
+            sess.run(train_op)
+        seconds_per_step = (time.time() - start) / num_steps
+
+        run_metadata = tf.RunMetadata()
+        sess.run(train_op, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+    tf.reset_default_graph()
+
+    return {"seconds_per_step" : seconds_per_step, "peak_bytes" : get_peak_bytes(run_metadata)}
+
+def recomputation(model_config, settings, memory_budget, num_steps=10):
+    '''
+    Compares peak training memory and step time of several activation recomputation settings, and how far each one
+    lets batch size and output length grow within a memory budget. The latter is extrapolated from the measured peak
+    memory with the activation memory of the planner (see UnetAudioSeparator.get_plan), which grows linearly in both
+    :param model_config: Model configuration dictionary (unet network)
+    :param settings: List of (name, recompute_levels, recompute_decoder_levels) tuples, e.g.
+                     [("none", [], []), ("encoder", range(6), []), ("all", range(12), range(12))]
+    :param memory_budget: Available device memory in bytes
+    :param num_steps: Number of timed training steps per setting
+    :return: List of result dictionaries, one per setting
+    '''
+    results = list()
+    for name, recompute_levels, recompute_decoder_levels in settings:
+        config = dict(model_config)
+        config["recompute_levels"] = list(recompute_levels)
+        config["recompute_decoder_levels"] = list(recompute_decoder_levels)
+        result = {"model" : name}
+        result.update(training_step(config, num_steps))
+
+        plan = Models.SeparatorFactory.get_separator(config).get_plan(config["num_frames"], config["batch_size"],
+                                                                       Utils.get_compute_dtype(config["precision"]).size)
+        fixed_bytes = max(result["peak_bytes"] - plan["training_activation_bytes"], 0) # Weights, optimizer slots and workspace
+        scale = (memory_budget - fixed_bytes) / float(max(result["peak_bytes"] - fixed_bytes, 1))
+        result.update({"planned_activation_bytes" : plan["training_activation_bytes"],
+                       "recompute_flops" : plan["recompute_flops"],
+                       "max_batch_size" : int(config["batch_size"] * scale),
+                       "max_num_frames" : int(config["num_frames"] * scale)})
+        results.append(result)
+
+    print_table(results, ["seconds_per_step", "peak_bytes", "planned_activation_bytes", "recompute_flops", "max_batch_size", "max_num_frames"])
+    return results
+
+def gradient_accumulation(model_config, settings, num_steps=10):
+    '''
+    Compares peak memory per micro-batch and time per optimizer step for several ways to split one effective batch
+    :param model_config: Model configuration dictionary
+    :param settings: List of (micro batch size, accumulation steps) tuples, e.g. [(64, 1), (16, 4), (4, 16)]
+    :param num_steps: Number of timed micro-batches per setting
+    :return: List of result dictionaries, one per setting
+    '''
+    results = list()
+    for batch_size, accumulation_steps in settings:
+        config = dict(model_config)
+        config.update({"batch_size" : batch_size, "gradient_accumulation_steps" : accumulation_steps})
+        result = {"model" : str(batch_size) + " x " + str(accumulation_steps)}
+        result.update(training_step(config, num_steps))
+        result.update({"effective_batch_size" : batch_size * accumulation_steps,
+                       "seconds_per_optimizer_step" : result["seconds_per_step"] * accumulation_steps})
+        results.append(result)
+
+    print_table(results, ["effective_batch_size", "peak_bytes", "seconds_per_step", "seconds_per_optimizer_step"])
+    return results
+
+def cpu_scaling(model_config, core_counts, inter_op_threads=2, num_steps=10):
+    '''
+    Measures how CPU training throughput scales with the number of cores the session may use
+    :param model_config: Model configuration dictionary
+    :param core_counts: List of core counts, e.g. [1, 2, 4, 8, 16]
+    :param inter_op_threads: Inter-op threads of every session, at most the number of cores
+    :param num_steps: Number of timed training steps per core count
+    :return: List of result dictionaries, one per core count
+    '''
+    results = list()
+    for num_cores in core_counts:
+        session_config = Utils.get_cpu_session_config(num_cores, min(inter_op_threads, num_cores))
+        result = {"model" : str(num_cores) + " cores"}
+        result.update(training_step(model_config, num_steps, session_config))
+        result["examples_per_second"] = model_config["batch_size"] / result["seconds_per_step"]
+        results.append(result)
+
+    for result, num_cores in zip(results, core_counts):
+        result["speedup"] = result["examples_per_second"] / results[0]["examples_per_second"]
+        result["efficiency"] = result["speedup"] * core_counts[0] / float(num_cores)
+
+    print_table(results, ["seconds_per_step", "examples_per_second", "speedup", "efficiency"])
+    return results
+
+def summary_window(model_config, windows=(1, 100), num_steps=20):
+    '''
+    Measures the training step time including the host call summaries for several metric windows (see Training.get_window_metrics).
+    A window of 1 writes the summaries every step
+    :param model_config: Model configuration dictionary
+    :param windows: List of summary_window values
+    :param num_steps: Number of timed training steps per window, after one untimed warm-up step
+    :return: List of result dictionaries, one per window
+    '''
+    results = list()
+    for window in windows:
+        config = dict(model_config)
+        config.update({"summary_window" : window, "use_tpu" : False, "distillation" : False, "model_base_dir" : tempfile.mkdtemp()})
+        dtype = Utils.get_compute_dtype(config["precision"])
+        features = {"mix" : tf.cast(tf.random_uniform([config["batch_size"], urmp_input.MIX_WITH_PADDING, config["num_channels"]], -1.0, 1.0), dtype),
+                    "labels" : tf.ones([config["batch_size"], config["num_sources"]], dtype)}
+        sources = tf.cast(tf.random_uniform([config["batch_size"], config["num_sources"], urmp_input.NUM_SAMPLES, config["num_channels"]], -1.0, 1.0), dtype)
+        tf.train.get_or_create_global_step()
+        spec = Training.unet_separator(features, sources, tf.estimator.ModeKeys.TRAIN, config)
+        fetches = [spec.train_op] + spec.host_call[0](*spec.host_call[1]) # Host call runs after every step as on the CPU path
+
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.contrib.summary.summary_writer_initializer_op()])
+            sess.run(fetches)
+            start = time.time()
+            for _ in range(num_steps):
+                sess.run(fetches)
+            results.append({"model" : "window " + str(window), "seconds_per_step" : (time.time() - start) / num_steps})
+        tf.reset_default_graph()
+
+    for result in results:
+        result["speedup"] = results[0]["seconds_per_step"] / result["seconds_per_step"]
+    print_table(results, ["seconds_per_step", "speedup"])
+    return results
+
+def conv_variants(models, audio_list, batch_size=1):
+    '''
+    Compares dense, depthwise-separable and grouped convolution variants of the Wave-U-Net on the same tracks
+    :param models: List of (name, model_config, checkpoint path) tuples
+    :param audio_list: List of tracks as in Test.test
+    :param batch_size: Batch size for which the planned FLOPs are reported
+    :return: List of result dictionaries, one per model
+    '''
+    results = list()
+    for name, model_config, load_model in models:
+        plan = Models.SeparatorFactory.get_separator(model_config).get_plan(model_config["num_frames"], batch_size)
+        model = load_separator(model_config, load_model)
+        result = {"model" : name,
+                  "params" : plan["params"],
+                  "flops_per_output_sample" : plan["flops"] / float(batch_size * plan["output_length"])}
+        result.update(evaluate_separator(model_config, model, audio_list))
+        results.append(result)
+
+        model["sess"].close()
+        tf.reset_default_graph()
+
+    print_table(results, ["params", "flops_per_output_sample", "seconds_per_audio_second", "mse", "snr", "sdr"])
+    return results
+
+def get_import_seconds(module):
+    '''
+    :return: Seconds a fresh Python interpreter needs to import a module
+    '''
+    start = time.time()
+    subprocess.check_call([sys.executable, "-c", "import " + module])
+    return time.time() - start
+
+def numpy_engine(model_config, load_model, export_dir, audio_list, tolerance=1e-4):
+    '''
+    Compares the Tensorflow separator with the NumPy inference engine for the same checkpoint: startup time (import,
+    graph construction or weight mapping, and a first forward pass), throughput and the largest output difference
+    :param model_config: Model configuration dictionary
+    :param load_model: Checkpoint path
+    :param export_dir: Folder written by Export.export_numpy for this checkpoint
+    :param audio_list: List of tracks as in Test.test
+    :param tolerance: Largest absolute difference between the source estimates of both implementations that is accepted
+    :return: List of result dictionaries for Tensorflow and NumPy
+    '''
+    model_config = dict(model_config)
+    model_config["precision"] = "float32"
+
+    start = time.time()
+    model = load_separator(model_config, load_model)
+    model["sess"].run(model["sources"], feed_dict={model["mix"] : np.zeros(model["input_shape"], np.float32)})
+    tf_startup = time.time() - start
+
+    start = time.time()
+    engine = NumpyUnetAudioSeparator(export_dir)
+    engine.get_output(np.zeros([1, engine.input_length, engine.num_channels], np.float32))
+    numpy_startup = time.time() - start
+
+    tf_time, numpy_time, total_audio, max_diff = 0.0, 0.0, 0.0, 0.0
+    for sample in audio_list:
+        mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
+        total_audio += mix_audio.shape[0] / float(mix_sr)
+        start = time.time()
+        tf_preds = Evaluate.predict_track(model_config, model["sess"], mix_audio, mix_sr, model["input_shape"], model["output_shape"],
+                                          model["sources"], model["mix"], model["pad_front"])
+        tf_time += time.time() - start
+
+        start = time.time()
+        numpy_preds = engine.separate(Evaluate.preprocess_mix(model_config, mix_audio, mix_sr))
+        numpy_time += time.time() - start
+        max_diff = max([max_diff] + [float(np.max(np.abs(t - n))) for t, n in zip(tf_preds, numpy_preds)])
+    model["sess"].close()
+    tf.reset_default_graph()
+
+    results = [{"model" : "tensorflow", "import_seconds" : get_import_seconds("tensorflow"), "startup_seconds" : tf_startup,
+                "seconds_per_audio_second" : tf_time / total_audio, "max_abs_diff" : 0.0},
+               {"model" : "numpy", "import_seconds" : get_import_seconds("numpy"), "startup_seconds" : numpy_startup,
+                "seconds_per_audio_second" : numpy_time / total_audio, "max_abs_diff" : max_diff}]
+    print_table(results, ["import_seconds", "startup_seconds", "seconds_per_audio_second", "max_abs_diff"])
+    assert(max_diff <= tolerance)
+    return results
+
+def xla_inference(models, audio_list, num_runs=10):
+    '''
+    Compares plain and XLA-compiled inference on CPU for several configurations (e.g. those of the baseline, urmp and
+    musdb named configs of Training.py)
+    :param models: List of (name, model_config, checkpoint path) tuples
+    :param audio_list: List of tracks as in Test.test
+    :param num_runs: Number of timed forward passes on one input window, after the first (compiling) one
+    :return: List of result dictionaries, one per model and mode
+    '''
+    results = list()
+    for name, model_config, load_model in models:
+        for xla in [False, True]:
+            config = dict(model_config)
+            config["xla_inference"] = xla
+            model = load_separator(config, load_model)
+            feed_dict = {model["mix"] : np.zeros(model["input_shape"], np.float32)}
+            start = time.time()
+            model["sess"].run(model["sources"], feed_dict)
+            first_run = time.time() - start
+            start = time.time()
+            for _ in range(num_runs):
+                model["sess"].run(model["sources"], feed_dict)
+            run_seconds = (time.time() - start) / num_runs
+
+            result = {"model" : name + (" xla" if xla else ""), "compile_seconds" : max(first_run - run_seconds, 0.0), "run_seconds" : run_seconds}
+            result.update(evaluate_separator(config, model, audio_list))
+            results.append(result)
+            model["sess"].close()
+            tf.reset_default_graph()
+        results[-1]["speedup"] = results[-2]["seconds_per_audio_second"] / results[-1]["seconds_per_audio_second"]
+        results[-2]["speedup"] = 1.0
+
+    print_table(results, ["compile_seconds", "run_seconds", "seconds_per_audio_second", "speedup", "snr"])
+    return results
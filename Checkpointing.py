@@ -0,0 +1,347 @@
+import os
+import signal
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from Models.UnetAudioSeparator import conv_layer_name
+
+EMA_SUFFIX = "/ExponentialMovingAverage"
+KEEP_CHECKPOINT_MAX = 5 # Number of newest checkpoints kept in the model folder of a training run, as the default of RunConfig
+
+class CheckpointStore:
+    '''
+    Remote folder that checkpoints are mirrored to. Works with every path tf.gfile supports, e.g. gs://bucket/run or a
+    local directory
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        if not tf.gfile.Exists(root):
+            tf.gfile.MakeDirs(root)
+
+    def upload(self, local_path, name):
+        '''
+        Copies a local file to the store, replacing an older copy
+        :param name: Path of the file relative to the store root
+        '''
+        remote_path = os.path.join(self.root, name)
+        if not tf.gfile.Exists(os.path.dirname(remote_path)):
+            tf.gfile.MakeDirs(os.path.dirname(remote_path))
+        tf.gfile.Copy(local_path, remote_path, overwrite=True)
+
+    def upload_checkpoint(self, checkpoint, folder=""):
+        '''
+        Copies all files of a checkpoint (index, data shards and meta graph) to a folder of the store
+        :param checkpoint: Local checkpoint path prefix, e.g. /tmp/run/model.ckpt-500
+        '''
+        for filename in tf.gfile.Glob(checkpoint + ".*"):
+            self.upload(filename, os.path.join(folder, os.path.basename(filename)))
+
+    def delete_checkpoint(self, name):
+        '''
+        Removes all files of a checkpoint from the store
+        :param name: Checkpoint path prefix relative to the store root
+        '''
+        for filename in tf.gfile.Glob(os.path.join(self.root, name) + ".*"):
+            tf.gfile.Remove(filename)
+
+    def update_state(self, names, folder=""):
+        '''
+        Writes the checkpoint state file of a folder of the store, so that tf.train.latest_checkpoint finds the newest of the given checkpoints
+        :param names: Checkpoint names in the folder, oldest first
+        '''
+        tf.train.update_checkpoint_state(os.path.join(self.root, folder), names[-1], all_model_checkpoint_paths=names)
+
+def read_variables(checkpoint, prefix="separator/"):
+    '''
+    :return: Dictionary of the values of all variables of a checkpoint whose names start with prefix
+    '''
+    reader = tf.train.load_checkpoint(checkpoint)
+    return {name : reader.get_tensor(name) for name in reader.get_variable_to_shape_map() if name.startswith(prefix)}
+
+def write_checkpoint(values, global_step, checkpoint):
+    '''
+    Writes variable values as a checkpoint that can be restored like a training checkpoint
+    :param values: Dictionary of variable values by name
+    :param global_step: Global step stored with the variables
+    :param checkpoint: Path prefix of the written checkpoint
+    '''
+    with tf.Graph().as_default():
+        variables = {name : tf.get_variable(name, initializer=value) for name, value in values.items()}
+        variables[tf.GraphKeys.GLOBAL_STEP] = tf.train.get_or_create_global_step()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            variables[tf.GraphKeys.GLOBAL_STEP].load(global_step, sess)
+            tf.train.Saver(variables, write_version=tf.train.SaverDef.V2).save(sess, checkpoint, write_meta_graph=False)
+
+def get_model_weights(values):
+    '''
+    Leaves out optimizer slots and moving averages, which are stored under the name of their variable followed by the slot name (e.g. "/Adam")
+    :param values: Dictionary of checkpoint values by variable name
+    :return: Dictionary with the values of the model weights only
+    '''
+    return {name : value for name, value in values.items() if not any([name.startswith(other + "/") for other in values])}
+
+def average_checkpoints(checkpoints, output_checkpoint, prefix="separator/"):
+    '''
+    Writes the mean of the model weights of several checkpoints of one run, without optimizer slots and moving averages
+    :param checkpoints: List of checkpoint paths, the global step of the last one is kept
+    :param output_checkpoint: Path prefix of the averaged checkpoint
+    :return: Number of averaged checkpoints
+    '''
+    values = None
+    for checkpoint in checkpoints:
+        weights = get_model_weights(read_variables(checkpoint, prefix))
+        values = weights if values is None else {name : values[name] + weights[name] for name in values}
+    global_step = int(tf.train.load_variable(checkpoints[-1], tf.GraphKeys.GLOBAL_STEP))
+    write_checkpoint({name : (value / float(len(checkpoints))).astype(value.dtype) for name, value in values.items()}, global_step, output_checkpoint)
+    return len(checkpoints)
+
+def ema_checkpoint(checkpoint, output_checkpoint, prefix="separator/"):
+    '''
+    Writes the exponential moving averages of the weights of a checkpoint trained with weight_averaging = 'ema' under the
+    names of the weights themselves, so the averaged model loads like any other checkpoint
+    '''
+    values = read_variables(checkpoint, prefix)
+    averages = {name[:-len(EMA_SUFFIX)] : value for name, value in values.items() if name.endswith(EMA_SUFFIX)}
+    if len(averages) == 0:
+        raise ValueError("Checkpoint " + checkpoint + " has no moving averages")
+    write_checkpoint(averages, int(tf.train.load_variable(checkpoint, tf.GraphKeys.GLOBAL_STEP)), output_checkpoint)
+
+class CheckpointUploader(threading.Thread):
+    '''
+    Mirrors a training run that writes its checkpoints to fast local disk to a remote store in the background, so the
+    training loop does not wait for remote writes. Only checkpoints listed in the local checkpoint state are uploaded,
+    which the saver updates after all their files are complete. Optionally also maintains an averaged model in the
+    "average" subfolder, from the last checkpoints or from the moving averages of the weights.
+    '''
+
+    def __init__(self, local_dir, store, keep_checkpoints=10, weight_averaging=None, num_average=5, keep_local_checkpoints=5, poll_secs=30):
+        '''
+        :param local_dir: Model folder of the training run
+        :param store: CheckpointStore the run is mirrored to
+        :param keep_checkpoints: Number of newest checkpoints kept in the store, older ones are deleted. None keeps all
+        :param weight_averaging: None, 'last_n' to average the last num_average checkpoints, or 'ema' to export the moving averages of the newest checkpoint
+        :param num_average: Number of checkpoints averaged for 'last_n'
+        :param keep_local_checkpoints: Number of newest checkpoints the saver of the run keeps in local_dir (keep_checkpoint_max)
+        :param poll_secs: Seconds between checks for new checkpoints and files
+        '''
+        if weight_averaging not in [None, "last_n", "ema"]:
+            raise ValueError("Unknown weight averaging " + str(weight_averaging))
+        if weight_averaging == "last_n" and num_average > keep_local_checkpoints:
+            raise ValueError("Can not average %d checkpoints, the saver keeps only %d" % (num_average, keep_local_checkpoints))
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.local_dir = local_dir
+        self.store = store
+        self.keep_checkpoints = keep_checkpoints
+        self.weight_averaging = weight_averaging
+        self.num_average = num_average
+        self.poll_secs = poll_secs
+        self.stop_event = threading.Event()
+        self.uploaded = list()
+        self.file_versions = dict()
+        self.last_average = None
+        self.error = None
+
+    def stop(self):
+        '''
+        Uploads everything written so far and stops the thread. Raises the last error of an upload, if any failed
+        '''
+        self.stop_event.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while not self.stop_event.wait(self.poll_secs):
+            self.try_sync()
+        self.try_sync()
+
+    def try_sync(self):
+        '''
+        Syncs and logs errors instead of ending the thread, so a failed upload is retried in the next sync
+        '''
+        try:
+            self.sync()
+        except Exception as e:
+            tf.logging.error("Checkpoint upload failed: " + str(e))
+            self.error = e
+
+    def sync(self):
+        '''
+        Uploads new checkpoints, the averaged model and all other changed files of the run (summaries, graph), and applies the retention policy
+        '''
+        state = tf.train.get_checkpoint_state(self.local_dir)
+        checkpoints = list(state.all_model_checkpoint_paths) if state is not None else list()
+        new_checkpoints = [checkpoint for checkpoint in checkpoints if os.path.basename(checkpoint) not in self.uploaded]
+        for checkpoint in new_checkpoints:
+            self.store.upload_checkpoint(checkpoint)
+            self.uploaded.append(os.path.basename(checkpoint))
+            tf.logging.info("Uploaded checkpoint " + checkpoint)
+
+        if len(new_checkpoints) > 0 and self.weight_averaging is not None:
+            average = os.path.join(self.local_dir, "average", os.path.basename(checkpoints[-1]))
+            if self.weight_averaging == "last_n":
+                average_checkpoints(checkpoints[-self.num_average:], average)
+            else:
+                ema_checkpoint(checkpoints[-1], average)
+            self.store.upload_checkpoint(average, "average")
+            self.store.update_state([os.path.basename(average)], "average")
+            if self.last_average is not None and self.last_average != average:
+                for filename in tf.gfile.Glob(self.last_average + ".*"):
+                    tf.gfile.Remove(filename)
+                self.store.delete_checkpoint(os.path.join("average", os.path.basename(self.last_average)))
+            self.last_average = average
+
+        # Summaries and other files that are not part of a checkpoint, uploaded whenever they changed
+        checkpoint_files = set([filename for checkpoint in checkpoints for filename in tf.gfile.Glob(checkpoint + ".*")])
+        for root, _, filenames in os.walk(self.local_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.local_dir)
+                if path in checkpoint_files or name == "checkpoint" or name.startswith("average" + os.path.sep) or ".ckpt-" in name:
+                    continue
+                version = (os.path.getmtime(path), os.path.getsize(path))
+                if self.file_versions.get(name) != version:
+                    self.store.upload(path, name)
+                    self.file_versions[name] = version
+
+        if self.keep_checkpoints is not None:
+            while len(self.uploaded) > self.keep_checkpoints:
+                self.store.delete_checkpoint(self.uploaded.pop(0))
+        if len(self.uploaded) > 0:
+            self.store.update_state(self.uploaded)
+
+def get_uploader(model_config, local_dir):
+    '''
+    :return: CheckpointUploader that mirrors a run in local_dir to the model folder of model_config
+    '''
+    store = CheckpointStore(model_config['model_base_dir'] + os.path.sep + str(model_config["experiment_id"]))
+    return CheckpointUploader(local_dir, store, model_config["remote_keep_checkpoints"], model_config["weight_averaging"], model_config["average_checkpoints"],
+                              KEEP_CHECKPOINT_MAX)
+
+def get_layer_index(name):
+    '''
+    :return: Creation index of the convolution a separator variable belongs to (see conv_layer_name), None for other variables
+    '''
+    scope = name.split("/")[1]
+    if scope == "conv1d":
+        return 0
+    elif scope.startswith("conv1d_"):
+        return int(scope.split("_")[1])
+    return None
+
+def remap_conditioned_channels(value, old_num_sources, new_num_sources, source_map, offset=0, axis=0):
+    '''
+    Remaps the channels of a feature map conditioned on source labels, which holds one copy of every filter per source
+    (channel f * num_sources + s), to another set of sources
+    :param value: Weights with the conditioned channels along an axis, starting at an offset
+    :param source_map: For every new source, the index of the old source it takes its weights from, or None for the mean over all old sources
+    :return: Remapped weights
+    '''
+    value = np.moveaxis(value, axis, 0)
+    conditioned = value[offset:]
+    num_filters = conditioned.shape[0] // old_num_sources
+    conditioned = conditioned.reshape((num_filters, old_num_sources) + conditioned.shape[1:])
+    remapped = [conditioned[:, s] if s is not None else conditioned.mean(axis=1) for s in source_map]
+    remapped = np.stack(remapped, axis=1).reshape((num_filters * new_num_sources,) + conditioned.shape[2:])
+    return np.moveaxis(np.concatenate([value[:offset], remapped], axis=0), 0, axis)
+
+def get_warm_start_values(checkpoint, variables, separator, conditional, source_map=None):
+    '''
+    Collects initial values for the variables of a separator from a checkpoint of a separator with the same encoder and
+    decoder but possibly another number of sources, e.g. a MUSDB model (4 sources) for a URMP model (13 sources).
+    Variables with the same name and shape are loaded. Output layers are taken from the checkpoint source given by
+    source_map, and the conditioned input channels of the first decoder layer are remapped per source. Everything else
+    keeps its initialisation
+    :param checkpoint: Checkpoint path
+    :param variables: Separator variables to initialise
+    :param separator: Separator the variables belong to
+    :param conditional: Whether both separators condition their bottleneck on source labels
+    :param source_map: For every source of the separator, the index of the checkpoint source to start from, or None.
+                       By default the first sources of the checkpoint in order
+    :return: Dictionary of values by variable, and report dictionary with the names of the loaded, remapped and skipped variables
+    '''
+    reader = tf.train.load_checkpoint(checkpoint)
+    shapes = reader.get_variable_to_shape_map()
+    L = separator.num_layers
+    first_output = 2 * L + 1
+    num_output_convs = separator.num_sources if separator.output_type == "direct" else separator.num_sources - 1
+    old_num_output_convs = len([name for name in shapes if name.startswith("separator/") and name.endswith("/bias")
+                                and get_layer_index(name) is not None and get_layer_index(name) >= first_output])
+    old_num_sources = old_num_output_convs if separator.output_type == "direct" else old_num_output_convs + 1
+    if source_map is None:
+        source_map = [s if s < old_num_sources else None for s in range(separator.num_sources)]
+
+    values = dict()
+    report = {"loaded" : list(), "remapped" : list(), "skipped" : list()}
+    for var in variables:
+        name = var.op.name
+        shape = var.get_shape().as_list()
+        index = get_layer_index(name)
+        if index is not None and index >= first_output: # Output layer of one source
+            old_source = source_map[index - first_output] if index - first_output < num_output_convs else None
+            old_name = name.replace(conv_layer_name(index) + "/", conv_layer_name(first_output + old_source) + "/") if old_source is not None else None
+            if old_source is not None and old_source < old_num_output_convs and list(shapes.get(old_name, [])) == shape:
+                values[var] = reader.get_tensor(old_name)
+                report["remapped" if old_name != name else "loaded"].append(name)
+            else:
+                report["skipped"].append(name)
+        elif name in shapes and list(shapes[name]) == shape:
+            values[var] = reader.get_tensor(name)
+            report["loaded"].append(name)
+        elif name in shapes and conditional and (index == L + 1 or name.split("/")[-1] == "interp_0"):
+            # Bottleneck channels conditioned on the sources, behind the skip connection channels for the first decoder convolution
+            offset = separator.get_num_filters(L - 1) if index == L + 1 else 0
+            remapped = remap_conditioned_channels(reader.get_tensor(name), old_num_sources, separator.num_sources, source_map, offset,
+                                                  axis=1 if index is not None else 0)
+            if list(remapped.shape) == shape:
+                values[var] = remapped
+                report["remapped"].append(name)
+            else:
+                report["skipped"].append(name)
+        else:
+            report["skipped"].append(name)
+    return values, report
+
+def get_warm_start_scaffold(checkpoint, separator, conditional, source_map=None):
+    '''
+    Warm start of all trainable separator variables for a TPUEstimatorSpec scaffold_fn (see get_warm_start_values).
+    Only applies when training starts without a checkpoint in the model folder, otherwise that checkpoint is restored
+    :return: Function that returns a tf.train.Scaffold
+    '''
+    values, report = get_warm_start_values(checkpoint, tf.trainable_variables("separator"), separator, conditional, source_map)
+    for key in ["loaded", "remapped", "skipped"]:
+        tf.logging.info("Warm start from %s, %s %d variables: %s" % (checkpoint, key, len(report[key]), ", ".join(report[key])))
+
+    def init_fn(scaffold, session):
+        for var, value in values.items():
+            var.load(value, session)
+    return lambda: tf.train.Scaffold(init_fn=init_fn)
+
+class PreemptionHook(tf.train.SessionRunHook):
+    '''
+    Stops training after the current step when the process receives SIGTERM, as preemptible machines do shortly before
+    they are shut down. The checkpoint saver of the Estimator then writes a final checkpoint when training ends, and a
+    restarted run continues from it
+    '''
+
+    def __init__(self):
+        self.preempted = False
+
+    def begin(self):
+        self.previous_handler = signal.signal(signal.SIGTERM, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        tf.logging.warning("Received SIGTERM, stopping training after the current step")
+        self.preempted = True
+
+    def after_run(self, run_context, run_values):
+        if self.preempted:
+            run_context.request_stop()
+
+    def end(self, session):
+        signal.signal(signal.SIGTERM, self.previous_handler)
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from Input import urmp_input
+import Models.SeparatorFactory
+import Benchmark
+import Utils
+
+def cache_teacher_outputs(model_config, input_dir, output_dir):
+    '''
+    Runs the teacher separator over all training records once and writes copies of the records that additionally contain
+    its source estimates (feature 'audio/teacher', same layout as the sources), so distillation does not need to run the
+    teacher in the training graph (model_config["teacher_cache"] = output_dir)
+    :param model_config: Model configuration dictionary with teacher_checkpoint and teacher_config
+    :param input_dir: Folder with the training records
+    :param output_dir: Folder the records with teacher estimates are written to
+    :return: Number of written examples
+    '''
+    teacher_config = dict(model_config)
+    teacher_config.update(model_config["teacher_config"])
+    conditional = teacher_config["network"] == "unet"
+    teacher_class = Models.SeparatorFactory.get_separator(teacher_config, conditional=conditional)
+    teacher_input_shape, teacher_output_shape = teacher_class.get_padding(np.array([1, teacher_config["num_frames"], 0]))
+
+    # Teacher estimates for the source excerpt, which is centred in the stored mixture
+    mix_length = urmp_input.MIX_WITH_PADDING
+    crop_start = (mix_length - teacher_input_shape[1]) // 2
+    offset = (mix_length - urmp_input.NUM_SAMPLES) // 2 - crop_start - (teacher_input_shape[1] - teacher_output_shape[1]) // 2
+    assert(crop_start >= 0 and offset >= 0 and offset + urmp_input.NUM_SAMPLES <= teacher_output_shape[1])
+
+    mix = tf.placeholder(tf.float32, [1, mix_length, urmp_input.CHANNELS])
+    labels = tf.placeholder(tf.float32, [1, urmp_input.NUM_SOURCES])
+    mix_crop = mix[:, crop_start:crop_start + teacher_input_shape[1], :]
+    if conditional:
+        teacher_sources = teacher_class.get_output(mix_crop, labels, False, reuse=False)
+    else:
+        teacher_sources = teacher_class.get_output(mix_crop, False, reuse=False)
+    teacher_sources = tf.stack(teacher_sources, axis=1)[0, :, offset:offset + urmp_input.NUM_SAMPLES, :]
+
+    if not tf.gfile.Exists(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+    num_examples = 0
+    with tf.Session() as sess:
+        tf.train.Saver(tf.global_variables("separator"), write_version=tf.train.SaverDef.V2).restore(sess, model_config["teacher_checkpoint"])
+        for filename in sorted(tf.gfile.Glob(os.path.join(input_dir, 'train-*'))):
+            with tf.python_io.TFRecordWriter(os.path.join(output_dir, os.path.basename(filename))) as writer:
+                for record in tf.python_io.tf_record_iterator(filename):
+                    example = tf.train.Example.FromString(record)
+                    feature = example.features.feature
+                    audio = np.array(feature['audio/encoded'].float_list.value, np.float32)
+                    example_labels = np.array(feature['audio/labels'].int64_list.value, np.float32)
+                    estimates = sess.run(teacher_sources, feed_dict={mix : audio[:mix_length].reshape([1, mix_length, urmp_input.CHANNELS]),
+                                                                     labels : example_labels[np.newaxis]})
+                    feature['audio/teacher'].float_list.value.extend(estimates.flatten().tolist())
+                    writer.write(example.SerializeToString())
+                    num_examples += 1
+    tf.reset_default_graph()
+    return num_examples
+
+def distillation_report(teacher, student, audio_list):
+    '''
+    Compares a distilled student separator with its teacher on the same tracks
+    :param teacher: (model_config, checkpoint path) of the teacher
+    :param student: (model_config, checkpoint path) of the student
+    :param audio_list: List of tracks as in Test.test
+    :return: List of result dictionaries for teacher and student
+    '''
+    results = list()
+    for name, (model_config, load_model) in [("teacher", teacher), ("student", student)]:
+        model = Benchmark.load_separator(model_config, load_model)
+        result = {"model" : name, "params" : int(Utils.getNumParams(tf.global_variables("separator")))}
+        result.update(Benchmark.evaluate_separator(model_config, model, audio_list))
+        results.append(result)
+        model["sess"].close()
+        tf.reset_default_graph()
+
+    for result in results:
+        result.update({"speedup" : results[0]["seconds_per_audio_second"] / result["seconds_per_audio_second"],
+                       "snr_gap" : results[0]["snr"] - result["snr"],
+                       "sdr_gap" : results[0]["sdr"] - result["sdr"]})
+
+    Benchmark.print_table(results, ["params", "seconds_per_audio_second", "speedup", "snr", "snr_gap", "sdr", "sdr_gap"])
+    return results
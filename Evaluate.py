@@ -11,7 +11,8 @@ import json
 import glob
 
 from Input import Input
-import Models.UnetAudioSeparator
+import Utils
+import Models.SeparatorFactory
 
 import musdb
 import museval
@@ -46,22 +47,21 @@ def predict(track):
 
     # Determine input and output shapes, if we use U-net as separator
     disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]  # Shape of discriminator input
-    if model_config["network"] == "unet":
-        separator_class = Models.UnetAudioSeparator.UnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
-                                                                   output_type=model_config["output_type"],
-                                                                   context=model_config["context"],
-                                                                   mono=model_config["mono_downmix"],
-                                                                   upsampling=model_config["upsampling"],
-                                                                   num_sources=model_config["num_sources"],
-                                                                   filter_size=model_config["filter_size"],
-                                                                   merge_filter_size=model_config["merge_filter_size"])
+    separator_class = Models.SeparatorFactory.get_separator(model_config)
 
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
     separator_func = separator_class.get_output
-
-    # Batch size of 1
-    sep_input_shape[0] = 1
-    sep_output_shape[0] = 1
+    pad_front = get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
+
+    # Batch size of 1, or one batch entry per channel
+    sep_input_shape[0] = get_inference_batch_size(model_config)
+    sep_output_shape[0] = get_inference_batch_size(model_config)
+    if model_config["polymorphic_inference"]:
+        # Any batch size and valid number of samples, whole track is separated in a few calls.
+        # Needs get_valid_length and symmetric context, which only the Wave-U-Net has
+        assert(model_config["network"] == "unet")
+        sep_input_shape = [None, None, sep_input_shape[2]]
+        sep_output_shape = [None, None, sep_output_shape[2]]
 
     mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
 
@@ -69,10 +69,10 @@ def predict(track):
 
     # BUILD MODELS
     # Separator
-    separator_sources = separator_func(mix_context, False, reuse=False)
+    separator_sources = Utils.get_output_with_precision(separator_func, model_config["precision"], mix_context, False, reuse=False)
 
     # Start session and queue input threads
-    sess = tf.Session()
+    sess = tf.Session(config=Utils.get_session_config(model_config["xla_inference"]))
     sess.run(tf.global_variables_initializer())
 
     # Load model
@@ -83,12 +83,15 @@ def predict(track):
     print('Pre-trained model restored for song prediction')
 
     mix_audio, orig_sr, mix_channels = track.audio, track.rate, track.audio.shape[1] # Audio has (n_samples, n_channels) shape
-    separator_preds = predict_track(model_config, sess, mix_audio, orig_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context)
+    if model_config["polymorphic_inference"]:
+        separator_preds = predict_track_polymorphic(model_config, sess, mix_audio, orig_sr, separator_class, separator_sources, mix_context, model_config["inference_max_frames"])
+    else:
+        separator_preds = predict_track(model_config, sess, mix_audio, orig_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context, pad_front)
 
     # Upsample predicted source audio and convert to stereo
     pred_audio = [librosa.resample(pred.T, model_config["expected_sr"], orig_sr).T for pred in separator_preds]
 
-    if model_config["mono_downmix"] and mix_channels > 1: # Convert to multichannel if mixture input was multichannel by duplicating mono estimate
+    if model_config["mono_downmix"] and not model_config["channels_as_batch"] and mix_channels > 1: # Convert to multichannel if mixture input was multichannel by duplicating mono estimate
         pred_audio = [np.tile(pred, [1, mix_channels]) for pred in pred_audio]
 
     # Set estimates depending on estimation task (voice or multi-instrument separation)
@@ -119,7 +122,92 @@ def predict(track):
 
     return estimates
 
-def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context):
+def get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape):
+    '''
+    Number of input samples that lie before the first output sample of the separator
+    :return: Padding at the beginning of the track for predict_track
+    '''
+    if model_config["network"] == "causal_unet":
+        # Causal model sees a long past but only lookahead samples of future
+        return sep_input_shape[1] - sep_output_shape[1] - separator_class.lookahead
+    else:
+        return (sep_input_shape[1] - sep_output_shape[1]) // 2
+
+def get_inference_batch_size(model_config):
+    '''
+    :return: Batch size of the inference graph: 1, or unknown when the channels of the mixture are separated as a batch of mono signals
+    '''
+    return None if model_config["channels_as_batch"] else 1
+
+def to_batch(model_config, mix_part):
+    '''
+    Converts a mixture excerpt [n_frames, n_channels] to the input batch of the network. With channels_as_batch, each
+    channel becomes one mono batch entry [n_channels, n_frames, 1]
+    '''
+    if model_config["channels_as_batch"]:
+        return np.transpose(mix_part)[:, :, np.newaxis]
+    return np.expand_dims(mix_part, axis=0)
+
+def from_batch(model_config, source_part):
+    '''
+    Converts a source estimate batch of the network back to a multichannel excerpt [n_frames, n_channels] (inverse of to_batch)
+    '''
+    if model_config["channels_as_batch"]:
+        return np.transpose(source_part[:, :, 0])
+    return source_part[0]
+
+def preprocess_mix(model_config, mix_audio, mix_sr):
+    '''
+    Converts a mixture [n_frames, n_channels] to the number of channels and the sampling rate of the model.
+    With channels_as_batch, mono models keep all channels, which are separated independently
+    '''
+    # Load mixture, convert to mono and downsample then
+    assert(len(mix_audio.shape) == 2)
+    if model_config["channels_as_batch"]:
+        assert(model_config["mono_downmix"])
+    elif model_config["mono_downmix"]:
+        mix_audio = np.mean(mix_audio, axis=1, keepdims=True)
+    else:
+        if mix_audio.shape[1] == 1:# Duplicate channels if input is mono but model is stereo
+            mix_audio = np.tile(mix_audio, [1, 2])
+    return librosa.resample(mix_audio.T, mix_sr, model_config["expected_sr"], res_type="kaiser_fast").T
+
+def predict_track_polymorphic(model_config, sess, mix_audio, mix_sr, separator_class, separator_sources, mix_context, max_output_frames):
+    '''
+    Outputs source estimates for a given input mixture signal mix_audio [n_frames, n_channels] with a shape-polymorphic
+    separator graph (input placeholder with unknown batch size and number of samples). Instead of many fixed-size windows,
+    the track is split into as few equally long segments as possible, each snapped to a valid length and separated in one call.
+    Only for the unet network, whose input context is symmetric around the output (works with linear and learned upsampling).
+    :param model_config: Model configuration dictionary
+    :param sess: Tensorflow session used to run the network inference
+    :param mix_audio: [n_frames, n_channels] audio signal (numpy array). Can have higher sampling rate or channels than the model supports, will be downsampled correspondingly.
+    :param mix_sr: Sampling rate of mix_audio
+    :param separator_class: Separator object the graph was built with, used to determine valid lengths
+    :param separator_sources: List of Tensorflow tensors that represent the output of the separator network
+    :param mix_context: Input tensor of the network, with shape [None, None, num_channels]
+    :param max_output_frames: Maximum number of output samples per call, limits memory usage
+    :return: List of source estimates, each [n_frames, n_channels]
+    '''
+    mix_audio = preprocess_mix(model_config, mix_audio, mix_sr)
+    source_time_frames = mix_audio.shape[0]
+
+    num_segments = int(np.ceil(source_time_frames / float(max_output_frames)))
+    input_time_frames, output_time_frames = separator_class.get_valid_length(int(np.ceil(source_time_frames / float(num_segments))))
+    pad_front = (input_time_frames - output_time_frames) // 2
+    pad_back = input_time_frames - output_time_frames - pad_front + num_segments * output_time_frames - source_time_frames
+    mix_audio_padded = np.pad(mix_audio, [(pad_front, pad_back), (0,0)], mode="constant", constant_values=0.0)
+
+    source_preds = [list() for _ in range(model_config["num_sources"])]
+    for segment in range(num_segments):
+        source_pos = segment * output_time_frames
+        mix_part = to_batch(model_config, mix_audio_padded[source_pos:source_pos + input_time_frames,:])
+        source_parts = sess.run(separator_sources, feed_dict={mix_context: mix_part})
+        for i in range(model_config["num_sources"]):
+            source_preds[i].append(from_batch(model_config, source_parts[i]))
+
+    return [np.concatenate(preds, axis=0)[:source_time_frames] for preds in source_preds]
+
+def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context, pad_front=None, feed_dict=None):
     '''
     Outputs source estimates for a given input mixture signal mix_audio [n_frames, n_channels] and a given Tensorflow session and placeholders belonging to the prediction network.
     It iterates through the track, collecting segment-wise predictions to form the output.
@@ -131,16 +219,11 @@ def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_ou
     :param sep_output_shape: Input shape of separator ([batch_size, num_samples, num_channels])
     :param separator_sources: List of Tensorflow tensors that represent the output of the separator network
     :param mix_context: Input tensor of the network
+    :param pad_front: Number of input samples before the first output sample. If None, the context is assumed to be symmetric (see get_front_padding)
+    :param feed_dict: Optional further feeds for every window, e.g. the conditioning labels of a conditional separator
     :return: 
     '''
-    # Load mixture, convert to mono and downsample then
-    assert(len(mix_audio.shape) == 2)
-    if model_config["mono_downmix"]:
-        mix_audio = np.mean(mix_audio, axis=1, keepdims=True)
-    else:
-        if mix_audio.shape[1] == 1:# Duplicate channels if input is mono but model is stereo
-            mix_audio = np.tile(mix_audio, [1, 2])
-    mix_audio = librosa.resample(mix_audio.T, mix_sr, model_config["expected_sr"], res_type="kaiser_fast").T
+    mix_audio = preprocess_mix(model_config, mix_audio, mix_sr)
 
     # Preallocate source predictions (same shape as input mixture)
     source_time_frames = mix_audio.shape[0]
@@ -150,8 +233,10 @@ def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_ou
     output_time_frames = sep_output_shape[1]
 
     # Pad mixture across time at beginning and end so that neural network can make prediction at the beginning and end of signal
-    pad_time_frames = (input_time_frames - output_time_frames) / 2
-    mix_audio_padded = np.pad(mix_audio, [(pad_time_frames, pad_time_frames), (0,0)], mode="constant", constant_values=0.0)
+    if pad_front is None:
+        pad_front = (input_time_frames - output_time_frames) // 2
+    pad_back = input_time_frames - output_time_frames - pad_front
+    mix_audio_padded = np.pad(mix_audio, [(pad_front, pad_back), (0,0)], mode="constant", constant_values=0.0)
 
     # Iterate over mixture magnitudes, fetch network rpediction
     for source_pos in range(0, source_time_frames, output_time_frames):
@@ -161,14 +246,17 @@ def predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_ou
 
         # Prepare mixture excerpt by selecting time interval
         mix_part = mix_audio_padded[source_pos:source_pos + input_time_frames,:]
-        mix_part = np.expand_dims(mix_part, axis=0)
+        mix_part = to_batch(model_config, mix_part)
 
-        source_parts = sess.run(separator_sources, feed_dict={mix_context: mix_part})
+        feed = {mix_context: mix_part}
+        if feed_dict is not None:
+            feed.update(feed_dict)
+        source_parts = sess.run(separator_sources, feed_dict=feed)
 
         # Save predictions
         # source_shape = [1, freq_bins, acc_mag_part.shape[2], num_chan]
         for i in range(model_config["num_sources"]):
-            source_preds[i][source_pos:source_pos + output_time_frames] = source_parts[i][0, :, :]
+            source_preds[i][source_pos:source_pos + output_time_frames] = from_batch(model_config, source_parts[i])
 
     return source_preds
 
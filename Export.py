@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import Models.SeparatorFactory
+from Models import NumpyUnetAudioSeparator
+import Evaluate
+import Utils
+from FrozenGraph import FROZEN_INFO_SUFFIX, load_frozen
+
+# Settings of the model configuration that determine the exported graph, see Models.SeparatorFactory.get_separator
+GEOMETRY_KEYS = ["network", "num_layers", "num_initial_filters", "filter_size", "merge_filter_size", "num_sources",
+                 "output_type", "context", "mono_downmix", "upsampling", "conv_type", "conv_groups", "layer_filters",
+                 "latency_ms", "expected_sr", "causal_filter_size", "causal_dilations", "num_frames"]
+
+def export_numpy(model_config, load_model, output_dir, conditional=True):
+    '''
+    Exports the separator weights of a checkpoint for the NumPy inference engine (Models.NumpyUnetAudioSeparator):
+    one .npy file per model variable and a json file with the network geometry
+    :param model_config: Model configuration dictionary (unet network with dense convolutions)
+    :param load_model: Checkpoint path
+    :param output_dir: Folder to write the exported model to
+    :param conditional: Whether the separator is conditioned on source labels, as Training.py trains the unet network
+    '''
+    assert(model_config["network"] == "unet" and model_config["conv_type"] == "dense")
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array([1, model_config["num_frames"], 0]))
+
+    config = {"num_layers" : separator_class.num_layers,
+              "num_sources" : separator_class.num_sources,
+              "num_channels" : separator_class.num_channels,
+              "context" : separator_class.context,
+              "upsampling" : separator_class.upsampling,
+              "output_type" : separator_class.output_type,
+              "conditional" : conditional,
+              "input_length" : int(sep_input_shape[1]),
+              "output_length" : int(sep_output_shape[1])}
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # Only the model variables, not optimizer slots, moving averages or other training state stored under the separator scope
+    reader = tf.train.load_checkpoint(load_model)
+    for name in NumpyUnetAudioSeparator.get_variable_names(config):
+        np.save(NumpyUnetAudioSeparator.weight_file(output_dir, name), reader.get_tensor("separator/" + name).astype(np.float32))
+
+    with open(os.path.join(output_dir, NumpyUnetAudioSeparator.CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+
+def export_frozen(model_config, load_model, output_path, polymorphic=False, conditional=False, measure=True):
+    '''
+    Writes a self-contained inference graph with the weights folded in as constants, so prediction needs neither the
+    model code nor a checkpoint restore. Inputs are "mix" and, for the conditional model, "labels" (defaults to all
+    sources), outputs "source_0", "source_1", ...
+    :param model_config: Model configuration dictionary, its precision policy is baked into the graph
+    :param load_model: Checkpoint path
+    :param output_path: Path of the .pb file. Shapes and padding needed for prediction are written next to it (.pb.json)
+    :param polymorphic: Whether the input length is unknown (see get_valid_length), otherwise fixed to the input length for model_config["num_frames"]
+    :param conditional: Whether to export the separator conditioned on source labels (unet network)
+    :param measure: Whether to measure and print cold-start latency of the artifact against building the graph and restoring the checkpoint
+    :return: Dictionary with the artifact information, and the cold-start measurements if measure is True
+    '''
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array([1, model_config["num_frames"], 0]))
+    pad_front = Evaluate.get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
+    assert(not polymorphic or model_config["network"] == "unet")
+
+    with tf.Graph().as_default():
+        input_shape = [None, None if polymorphic else sep_input_shape[1], sep_input_shape[2]]
+        mix = tf.placeholder(tf.float32, input_shape, name="mix") # Cast to the precision policy inside the graph
+        if conditional:
+            labels = tf.placeholder_with_default(tf.ones([1, model_config["num_sources"]]), [None, model_config["num_sources"]], name="labels")
+            sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix, labels, False, reuse=False)
+        else:
+            sources = Utils.get_output_with_precision(separator_class.get_output, model_config["precision"], mix, False, reuse=False)
+        output_names = ["source_" + str(i) for i in range(len(sources))]
+        for source, name in zip(sources, output_names):
+            tf.identity(source, name=name)
+
+        with tf.Session() as sess:
+            tf.train.Saver(tf.global_variables("separator"), write_version=tf.train.SaverDef.V2).restore(sess, load_model)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    input_names = ["mix", "labels"] if conditional else ["mix"]
+    graph_def = TransformGraph(graph_def, input_names, output_names, ["fold_constants(ignore_errors=true)", "strip_unused_nodes"])
+
+    with tf.gfile.GFile(output_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    info = {"input_shape" : [1, int(sep_input_shape[1]), int(sep_input_shape[2])],
+            "output_shape" : [1, int(sep_output_shape[1]), int(sep_output_shape[2])],
+            "pad_front" : int(pad_front),
+            "polymorphic" : polymorphic,
+            "conditional" : conditional,
+            "precision" : model_config["precision"],
+            "outputs" : output_names}
+    with open(output_path + FROZEN_INFO_SUFFIX, "w") as f:
+        json.dump(info, f, indent=2)
+
+    if measure:
+        info.update(measure_cold_start(model_config, load_model, output_path, conditional))
+    return info
+
+def get_cold_start_seconds(code):
+    '''
+    :param code: Python code to run in a fresh interpreter in the repository folder
+    :return: Seconds from interpreter start until the code finished
+    '''
+    start = time.time()
+    subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.time() - start
+
+def measure_cold_start(model_config, load_model, frozen_path, conditional=False):
+    '''
+    Measures the time from starting Python until the first prediction, once with the frozen artifact (loaded with
+    FrozenGraph, which imports nothing but Tensorflow) and once by building the graph and restoring the checkpoint as
+    Test.test and Evaluate.predict do
+    :param conditional: Whether the separator is conditioned on source labels, all sources are fed as labels
+    :return: Dictionary with checkpoint_cold_start_seconds and frozen_cold_start_seconds
+    '''
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(model_config, config_file, default=lambda value: value.item() if hasattr(value, "item") else str(value))
+    config_file.close()
+
+    first_prediction = "feed = {m['mix'] : np.zeros(m['input_shape'], np.float32)}; " + \
+                       ("feed[m['labels']] = np.ones([1, %d], np.float32); " % model_config["num_sources"] if conditional else "") + \
+                       "m['sess'].run(m['sources'], feed_dict=feed)"
+    checkpoint_seconds = get_cold_start_seconds("import json; import numpy as np; import Benchmark; "
+                                                "m = Benchmark.load_separator(json.load(open(%r)), %r, %r); " % (config_file.name, load_model, conditional) + first_prediction)
+    frozen_seconds = get_cold_start_seconds("import numpy as np; import FrozenGraph; m = FrozenGraph.load_frozen(%r); " % frozen_path + first_prediction)
+    os.remove(config_file.name)
+
+    print("Cold start until first prediction: checkpoint " + str(checkpoint_seconds) + "s, frozen " + str(frozen_seconds) + "s")
+    return {"checkpoint_cold_start_seconds" : checkpoint_seconds, "frozen_cold_start_seconds" : frozen_seconds}
+
+class InferenceCache:
+    '''
+    Separator sessions for inference, one per precision policy and input length of a checkpoint. Each session keeps the XLA
+    executables it compiled, so they are reused across tracks. Frozen graphs are persisted in a folder and reused
+    after a restart, which skips graph construction and checkpoint restore; XLA itself recompiles once per process.
+    '''
+
+    def __init__(self, model_config, load_model, cache_dir, xla=True, conditional=None):
+        '''
+        :param model_config: Model configuration dictionary
+        :param load_model: Checkpoint path
+        :param cache_dir: Folder for the frozen graphs
+        :param xla: Whether to JIT-compile with XLA
+        :param conditional: Whether the separator is conditioned on source labels, by default for the unet network as Training.py trains it
+        '''
+        self.model_config = model_config
+        self.load_model = load_model
+        self.cache_dir = cache_dir
+        self.xla = xla
+        self.conditional = model_config["network"] == "unet" if conditional is None else conditional
+        self.model_hash = self.get_model_hash()
+        self.models = dict()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_model_hash(self):
+        '''
+        :return: Hash of the checkpoint (path and global step) and the network geometry, so graphs of another checkpoint or model configuration in the cache folder are not reused
+        '''
+        global_step = tf.train.load_variable(self.load_model, tf.GraphKeys.GLOBAL_STEP)
+        geometry = dict((key, self.model_config.get(key)) for key in GEOMETRY_KEYS)
+        description = json.dumps([os.path.abspath(self.load_model), int(global_step), self.conditional, geometry], sort_keys=True, default=str)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
+
+    def get(self, precision, polymorphic=False):
+        '''
+        :param precision: Precision policy
+        :param polymorphic: Whether to use a graph with unknown input length instead of the fixed input length of model_config["num_frames"]
+        :return: Dictionary as returned by load_frozen
+        '''
+        key = (precision, "polymorphic" if polymorphic else self.model_config["num_frames"], self.model_hash)
+        if key not in self.models:
+            path = os.path.join(self.cache_dir, "separator_" + "_".join([str(k) for k in key]) + ".pb")
+            if not os.path.exists(path):
+                config = dict(self.model_config)
+                config["precision"] = precision
+                export_frozen(config, self.load_model, path, polymorphic=polymorphic, conditional=self.conditional, measure=False)
+            self.models[key] = load_frozen(path, self.xla)
+        return self.models[key]
+
+    def close(self):
+        for model in self.models.values():
+            model["sess"].close()
+        self.models = dict()
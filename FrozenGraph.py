@@ -0,0 +1,51 @@
+import json
+import os
+
+import tensorflow as tf
+
+# Loading a frozen separator only needs Tensorflow: this module does not import the models, Utils or Evaluate, so
+# scripts that only predict with an exported graph start fast
+
+FROZEN_INFO_SUFFIX = ".json"
+
+def get_session_config(xla=False):
+    '''
+    Session configuration for inference
+    :param xla: Whether to JIT-compile the graph with XLA, which fuses the many small ops of the separator. Compiled
+    executables are cached by the session for every input shape it sees
+    :return: tf.ConfigProto
+    '''
+    config = tf.ConfigProto()
+    if xla:
+        # Auto-clustering on CPU additionally needs this flag, which is read when the first cluster is compiled
+        if "--tf_xla_cpu_global_jit" not in os.environ.get("TF_XLA_FLAGS", ""):
+            os.environ["TF_XLA_FLAGS"] = (os.environ.get("TF_XLA_FLAGS", "") + " --tf_xla_cpu_global_jit").strip()
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+def load_frozen(path, xla=False):
+    '''
+    Loads an inference graph written by Export.export_frozen into a new session, ready to predict
+    :param path: Path of the .pb file
+    :param xla: Whether to JIT-compile the graph with XLA (see get_session_config)
+    :return: Dictionary as returned by Benchmark.load_separator (without the separator object), plus the labels input for conditional graphs
+    '''
+    with open(path + FROZEN_INFO_SUFFIX) as f:
+        info = json.load(f)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    model = {"sess" : tf.Session(graph=graph, config=get_session_config(xla)),
+             "mix" : graph.get_tensor_by_name("mix:0"),
+             "sources" : [graph.get_tensor_by_name(name + ":0") for name in info["outputs"]],
+             "input_shape" : info["input_shape"],
+             "output_shape" : info["output_shape"],
+             "pad_front" : info["pad_front"],
+             "polymorphic" : info["polymorphic"]}
+    if info["conditional"]:
+        model["labels"] = graph.get_tensor_by_name("labels:0")
+    return model
@@ -14,9 +14,10 @@ import functools
 CHANNEL_NAMES = ['.stem_mix.wav', '.stem_vocals.wav', '.stem_bass.wav', '.stem_drums.wav', '.stem_other.wav']
 SAMPLE_RATE = 22050     # Set a fixed sample rate
 NUM_SAMPLES = 16384     # get from parameters of the model
-# this is the proper size for mix input if "context" is set for NUM_SAMPLES = 16384
-# Actually, output will be 16389 but nobody cares
-MIX_WITH_PADDING = 147443
+# Mix input size (and actual output size) of the valid-padding model with the default geometry that was used to write the records,
+# UnetAudioSeparator(12, 24, 'linear', 'difference', True, 1, True, 15, 5).get_valid_length(NUM_SAMPLES). Not computed here, so the
+# input pipeline does not import the models
+MIX_WITH_PADDING, OUTPUT_SAMPLES = 147443, 16389
 CHANNELS = 1            # always work with mono!
 NUM_SOURCES = 4         # fix 4 sources for musdb + mix
 CACHE_SIZE = 16         # load 16 audio files in memory, then shuffle examples and write a tf.record
@@ -44,13 +45,13 @@ class MusDBInput(object):
     Args:
     is_training: `bool` for whether the input is for training
     data_dir: `str` for the directory of the training and validation data
-    use_bfloat16: If True, use bfloat16 precision; else use float32.
+    precision: `str` precision policy of the model, one of 'float32', 'float16' or 'bfloat16'. Audio (and labels) are cast to it.
     transpose_input: 'bool' for whether to use the double transpose trick # what is that??
     """
 
-    def __init__(self, is_training, data_dir, use_bfloat16=False, transpose_input=False):
+    def __init__(self, is_training, data_dir, precision='float32', transpose_input=False):
         self.is_training = is_training
-        self.use_bfloat16 = use_bfloat16
+        self.dtype = tf.as_dtype(precision) # Compute dtype of the precision policy as Utils.get_compute_dtype, without importing Utils
         self.data_dir = data_dir
         if self.data_dir == 'null' or self.data_dir == '':
             self.data_dir = None
@@ -96,8 +97,8 @@ class MusDBInput(object):
         audio_data = tf.reshape(audio_data, audio_shape)
         mix, sources = tf.reshape(audio_data[:MIX_WITH_PADDING], tf.stack([MIX_WITH_PADDING, CHANNELS])), \
                        tf.reshape(audio_data[MIX_WITH_PADDING:], tf.stack([NUM_SOURCES, NUM_SAMPLES, CHANNELS]))
-        mix = tf.cast(mix, tf.bfloat16)
-        sources = tf.cast(sources, tf.bfloat16)
+        mix = tf.cast(mix, self.dtype)
+        sources = tf.cast(sources, self.dtype)
         if self.is_training:
             features = {'mix': mix}
         else:
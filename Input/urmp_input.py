@@ -33,10 +33,15 @@ source_map = {
 
 SAMPLE_RATE = 22050     # Set a fixed sample rate
 NUM_SAMPLES = 16384     # get from parameters of the model
-MIX_WITH_PADDING = 147443
+# Mix input size (and actual output size) of the valid-padding model with the default geometry that was used to write the records,
+# UnetAudioSeparator(12, 24, 'linear', 'difference', True, 1, True, 15, 5).get_valid_length(NUM_SAMPLES). Not computed here, so the
+# input pipeline does not import the models
+MIX_WITH_PADDING, OUTPUT_SAMPLES = 147443, 16389
 CHANNELS = 1            # always work with mono!
 NUM_SOURCES = 13         # fix 13 sources for urmp + mix
 CACHE_SIZE = 16         # load 16 audio files in memory, then shuffle examples and write a tf.record
+# Largest shuffle buffer of a resumable iterator, whose buffered examples (about 1.4 MB each) are saved with every checkpoint
+RESUMABLE_SHUFFLE_BUFFER_SIZE = 64
 
 
 class URMPInput(object):
@@ -61,13 +66,31 @@ class URMPInput(object):
     Args:
     is_training: `bool` for whether the input is for training
     data_dir: `str` for the directory of the training and validation data
-    use_bfloat16: If True, use bfloat16 precision; else use float32.
+    precision: `str` precision policy of the model, one of 'float32', 'float16' or 'bfloat16'. Audio (and labels) are cast to it.
+    teacher_outputs: 'bool' for whether the records also contain precomputed teacher estimates 'audio/teacher' (see Distill.py),
+      of the same size as the sources, which are returned as feature 'teacher_sources'
+    input_length: 'int' for a shorter mix excerpt than stored in the records, e.g. for a separator with smaller num_frames.
+      None returns the whole stored mix
+    output_length: 'int' for a shorter source excerpt, together with input_length. The excerpts are cut so that the sources
+      stay centred in the mix as in the records
+    seed: 'int' seed for the file order and the shuffling of training examples, None for a different order in every run
+    resumable: 'bool' for whether the order of training examples is deterministic (no sloppy interleave), so that the
+      state of the input iterator can be saved with the checkpoints (see saveable_input_fn)
+    shuffle_buffer_size: 'int' number of examples in the shuffle buffer. A resumable iterator saves the buffer contents with every
+      checkpoint, so its buffer is capped at RESUMABLE_SHUFFLE_BUFFER_SIZE examples
     transpose_input: 'bool' for whether to use the double transpose trick # what is that??
     """
 
-    def __init__(self, mode, data_dir, use_bfloat16=False, transpose_input=False):
+    def __init__(self, mode, data_dir, precision='float32', transpose_input=False, teacher_outputs=False, input_length=None, output_length=None,
+                 seed=None, resumable=False, shuffle_buffer_size=1024):
         self.mode = mode
-        self.use_bfloat16 = use_bfloat16
+        self.seed = seed
+        self.resumable = resumable
+        self.shuffle_buffer_size = min(shuffle_buffer_size, RESUMABLE_SHUFFLE_BUFFER_SIZE) if resumable else shuffle_buffer_size
+        self.input_length = input_length
+        self.output_length = output_length
+        self.teacher_outputs = teacher_outputs
+        self.dtype = tf.as_dtype(precision) # Compute dtype of the precision policy as Utils.get_compute_dtype, without importing Utils
         self.data_dir = data_dir
         if self.data_dir == 'null' or self.data_dir == '':
             self.data_dir = None
@@ -112,19 +135,26 @@ class URMPInput(object):
             'audio/source_names':
                 tf.FixedLenFeature([], tf.string, ''),
         }
+        if self.teacher_outputs:
+            keys_to_features['audio/teacher'] = tf.VarLenFeature(tf.float32)
 
         parsed = tf.parse_single_example(value, keys_to_features)
         audio_data = tf.sparse_tensor_to_dense(parsed['audio/encoded'], default_value=0)
         audio_shape = tf.stack([MIX_WITH_PADDING + NUM_SOURCES*NUM_SAMPLES])
         audio_data = tf.reshape(audio_data, audio_shape)
         mix, sources = tf.reshape(audio_data[:MIX_WITH_PADDING], tf.stack([MIX_WITH_PADDING, CHANNELS])),tf.reshape(audio_data[MIX_WITH_PADDING:], tf.stack([NUM_SOURCES, NUM_SAMPLES, CHANNELS]))
+        teacher_sources = None
+        if self.teacher_outputs:
+            teacher_sources = tf.sparse_tensor_to_dense(parsed['audio/teacher'], default_value=0)
+            teacher_sources = tf.reshape(teacher_sources, tf.stack([NUM_SOURCES, NUM_SAMPLES, CHANNELS]))
+        if self.input_length is not None:
+            mix, sources, teacher_sources = self.crop(mix, sources, teacher_sources)
         labels = tf.sparse_tensor_to_dense(parsed['audio/labels'])
         labels = tf.reshape(labels, tf.stack([NUM_SOURCES]))
 
-        if self.use_bfloat16:
-            mix = tf.cast(mix, tf.bfloat16)
-            labels = tf.cast(labels, tf.bfloat16)
-            sources = tf.cast(sources, tf.bfloat16)
+        mix = tf.cast(mix, self.dtype)
+        labels = tf.cast(labels, self.dtype)
+        sources = tf.cast(sources, self.dtype)
         if self.mode == 'train':
             features = {'mix': mix,
                         'labels': labels}
@@ -134,8 +164,23 @@ class URMPInput(object):
         else:
             features = {'mix': mix, 'filename': parsed['audio/file_basename'],
                         'sample_id': parsed['audio/sample_idx'], 'labels': labels}
+        if self.teacher_outputs:
+            features['teacher_sources'] = tf.cast(teacher_sources, self.dtype)
         return features, sources
 
+    def crop(self, mix, sources, teacher_sources=None):
+        """Cuts the mix and source excerpts down to input_length and output_length, so that the sources start
+        (input_length - output_length) // 2 samples into the mix as in the records."""
+        output_length = min(self.output_length, NUM_SAMPLES)
+        source_start = (NUM_SAMPLES - output_length) // 2
+        mix_start = (MIX_WITH_PADDING - NUM_SAMPLES) // 2 + source_start - (self.input_length - output_length) // 2
+        assert(mix_start >= 0 and mix_start + self.input_length <= MIX_WITH_PADDING)
+        mix = mix[mix_start:mix_start + self.input_length]
+        sources = sources[:, source_start:source_start + output_length]
+        if teacher_sources is not None:
+            teacher_sources = teacher_sources[:, source_start:source_start + output_length]
+        return mix, sources, teacher_sources
+
     def input_fn(self, params):
         """Input function which provides a single batch for train or eval.
             Args:
@@ -154,7 +199,7 @@ class URMPInput(object):
         # Shuffle the filenames to ensure better randomization.
         file_pattern = os.path.join(
             self.data_dir, 'train-*' if self.mode == 'train' else 'test-*')
-        dataset = tf.data.Dataset.list_files(file_pattern, shuffle=(self.mode == 'train'))
+        dataset = tf.data.Dataset.list_files(file_pattern, shuffle=(self.mode == 'train'), seed=self.seed)
         if self.mode == 'train':
             dataset = dataset.repeat()
 
@@ -166,8 +211,8 @@ class URMPInput(object):
         # Read the data from disk in parallel
         dataset = dataset.apply(
             tf.contrib.data.parallel_interleave(
-                fetch_dataset, cycle_length=6, sloppy=True))
-        dataset = dataset.shuffle(1024, reshuffle_each_iteration=True)
+                fetch_dataset, cycle_length=6, sloppy=not self.resumable))
+        dataset = dataset.shuffle(self.shuffle_buffer_size, seed=self.seed, reshuffle_each_iteration=True)
 
         # Parse, preprocess, and batch the data in parallel
         dataset = dataset.apply(
@@ -182,3 +227,12 @@ class URMPInput(object):
         # Prefetch overlaps in-feed with training
         dataset = dataset.prefetch(tf.contrib.data.AUTOTUNE)
         return dataset
+
+    def saveable_input_fn(self, params):
+        """Input function for an Estimator on the CPU that returns the next batch of an iterator whose state (file order,
+        read positions, shuffle buffer and seeds) is saved with every checkpoint and restored with it, so a restarted
+        run continues with the examples it would have seen next. Not supported by the TPUEstimator, which reads its
+        input in a separate infeed graph."""
+        iterator = self.input_fn(params).make_one_shot_iterator()
+        tf.add_to_collection(tf.GraphKeys.SAVEABLE_OBJECTS, tf.contrib.data.make_saveable_from_iterator(iterator))
+        return iterator.get_next()
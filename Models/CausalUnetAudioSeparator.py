@@ -0,0 +1,137 @@
+import tensorflow as tf
+
+import Utils
+from Utils import LeakyReLU
+import numpy as np
+import OutputLayer
+
+def causal_conv_layer(input, num_filters, filter_size, dilation, name, activation=LeakyReLU):
+    '''
+    Causal (dilated) convolution layer: Output at time t only depends on the input up to time t. Output has the same length as the input
+    :param input: Input features [batch_size, width, channels]
+    :param num_filters: Number of output channels
+    :param filter_size: Width of the filter (number of taps)
+    :param dilation: Dilation factor, taps are dilation samples apart
+    :param name: Variable scope of the layer weights
+    :param activation: Activation function
+    :return: Output features [batch_size, width, num_filters]
+    '''
+    with tf.variable_scope(name):
+        in_channels = input.get_shape().as_list()[2]
+        kernel = tf.get_variable("kernel", [filter_size, in_channels, num_filters], dtype=tf.float32,
+                                 initializer=tf.glorot_uniform_initializer())
+        bias = tf.get_variable("bias", [num_filters], dtype=tf.float32, initializer=tf.zeros_initializer())
+        padded = tf.pad(input, [[0, 0], [(filter_size - 1) * dilation, 0], [0, 0]]) # Only past context
+        output = Utils.causal_conv(padded, tf.cast(kernel, input.dtype), dilation, 'VALID') + tf.cast(bias, input.dtype)
+        return activation(output)
+
+class CausalUnetAudioSeparator:
+    '''
+    Causal U-Net separator network with bounded algorithmic latency.
+    Every convolution only looks into the past, decimation keeps the most recent sample of each pair and upsampling holds
+    the last low-resolution sample, so output at time t depends only on input up to time t. The source estimate at time t
+    is predicted at time t + lookahead, so the network gets lookahead samples of future context and the algorithmic
+    latency is lookahead samples (plus the hop size when streaming).
+    Encoder blocks are stacks of dilated causal convolutions, which reach a similar context per block as one wide filter with fewer taps.
+    '''
+
+    def __init__(self, num_layers, num_initial_filters, output_type, num_sources, mono, filter_size, merge_filter_size, dilations, lookahead):
+        '''
+        Initialize causal U-net
+        :param num_layers: Number of down- and upscaling layers in the network
+        :param filter_size: Filter size of each dilated causal convolution in the encoder blocks
+        :param merge_filter_size: Filter size of the causal convolution in the upsampling blocks
+        :param dilations: List of dilation factors of the convolution stack in each encoder block
+        :param lookahead: Number of future input samples available to estimate each output sample
+        '''
+        self.num_layers = num_layers
+        self.num_initial_filters = num_initial_filters
+        self.filter_size = filter_size
+        self.merge_filter_size = merge_filter_size
+        self.dilations = dilations
+        self.lookahead = lookahead
+        self.output_type = output_type
+        self.num_sources = num_sources
+        self.num_channels = 1 if mono else 2
+
+    def get_receptive_field(self):
+        '''
+        Number of past input samples (including the current one) that influence one output
+        :return: Receptive field in samples at the input sampling rate
+        '''
+        block_history = sum([(self.filter_size - 1) * d for d in self.dilations])
+        history = 0
+        for i in range(self.num_layers):
+            history += (2 ** i) * (block_history + 1) # Conv stack and decimation
+            history += (2 ** i) * (self.merge_filter_size - 1 + 1) # Merge conv and sample hold in upsampling
+        history += (2 ** self.num_layers) * block_history
+        return history + 1
+
+    def get_latency(self, sample_rate):
+        '''
+        :return: Algorithmic latency in milliseconds
+        '''
+        return 1000.0 * self.lookahead / sample_rate
+
+    def get_padding(self, shape):
+        '''
+        Calculates the input shape so that the network has the given output shape. Unlike the valid-padding U-Net, the
+        context is not symmetric: the input extends receptive_field-1 samples into the past but only lookahead samples into the future
+        :param shape: Desired output shape
+        :return: Input_shape, output_shape, where each is a list [batch_size, time_steps, channels]. Output sample j belongs to input sample j + receptive_field - 1
+        '''
+        history = self.get_receptive_field() - 1
+        input_shape = np.array([shape[0], shape[1] + history + self.lookahead, self.num_channels])
+        output_shape = np.array([shape[0], shape[1], self.num_channels])
+        return input_shape, output_shape
+
+    def get_output(self, input, training=None, return_spectrogram=False, reuse=True, num_outputs=None):
+        '''
+        Creates symbolic computation graph of the causal U-Net for a given input batch
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param reuse: Whether to create new parameter variables or reuse existing ones
+        :param num_outputs: Number of output samples. If None, it is num_samples - receptive_field + 1 - lookahead (see get_padding)
+        :return: U-Net output: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
+        '''
+        input_length = input.get_shape().as_list()[1]
+        if num_outputs is None:
+            num_outputs = input_length - self.get_receptive_field() + 1 - self.lookahead
+        assert(num_outputs > 0)
+
+        with tf.variable_scope("separator", reuse=reuse):
+            # Pad on the left so the length is divisible by 2^num_layers, this only adds past silence
+            block = 2 ** self.num_layers
+            extra = (block - input_length % block) % block
+            current_layer = tf.pad(input, [[0, 0], [extra, 0], [0, 0]])
+
+            enc_outputs = list()
+            for i in range(self.num_layers):
+                for j, dilation in enumerate(self.dilations):
+                    current_layer = causal_conv_layer(current_layer, self.num_initial_filters + (self.num_initial_filters * i), self.filter_size, dilation, "enc_" + str(i) + "_" + str(j))
+                enc_outputs.append(current_layer)
+                current_layer = current_layer[:,1::2,:] # Decimate by factor of 2, keeping the more recent sample
+
+            for j, dilation in enumerate(self.dilations):
+                current_layer = causal_conv_layer(current_layer, self.num_initial_filters + (self.num_initial_filters * self.num_layers), self.filter_size, dilation, "bottleneck_" + str(j))
+
+            for i in range(self.num_layers):
+                # Sample-and-hold upsampling, delayed by one sample so no future low-resolution sample is used
+                shape = current_layer.get_shape().as_list()
+                current_layer = tf.reshape(tf.tile(tf.expand_dims(current_layer, axis=2), [1, 1, 2, 1]), [shape[0], shape[1] * 2, shape[2]])
+                current_layer = tf.pad(current_layer, [[0, 0], [1, 0], [0, 0]])[:, :-1, :]
+
+                current_layer = tf.concat([enc_outputs[-i-1], current_layer], axis=2)
+                current_layer = causal_conv_layer(current_layer, self.num_initial_filters + (self.num_initial_filters * (self.num_layers - i - 1)), self.merge_filter_size, 1, "dec_" + str(i))
+
+            # Features at time t estimate the sources at time t - lookahead
+            current_layer = current_layer[:, -num_outputs:, :]
+            aligned_input = input[:, input_length - num_outputs - self.lookahead:input_length - self.lookahead, :]
+            current_layer = tf.concat([aligned_input, current_layer], axis=2)
+
+            # Output layer
+            if self.output_type == "direct":
+                return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels)
+            elif self.output_type == "difference":
+                return OutputLayer.difference_output(aligned_input, current_layer, self.num_sources, self.num_channels)
+            else:
+                raise NotImplementedError
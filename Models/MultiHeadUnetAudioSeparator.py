@@ -0,0 +1,143 @@
+import tensorflow as tf
+
+import UnetAudioSeparator as Unet
+import ConditionalUnetAudioSeparator
+from UnetAudioSeparator import conv_layer_name
+
+class MultiHeadUnetAudioSeparator:
+    '''
+    U-Net separator with one shared encoder and one decoder and output layer (head) per dataset, e.g. a MUSDB head with
+    4 sources and a URMP head with 13. The encoder variables live directly in the "separator" scope, so they have the
+    same names as in a single-head checkpoint, and every head lives in its own "separator/<head name>" scope.
+    All heads are built on one encoder output, so a session run that fetches several heads computes the encoder only once
+    and a run that fetches one head does not compute the decoders of the others.
+    '''
+
+    def __init__(self, heads, num_layers, num_initial_filters, upsampling, output_type, context, mono, filter_size, merge_filter_size, **separator_args):
+        '''
+        :param heads: List of (name, num_sources, conditional) tuples, one per head. Conditional heads condition the bottleneck on source labels as ConditionalUnetAudioSeparator
+        :param separator_args: Further arguments of UnetAudioSeparator shared by the encoder and all decoders
+        '''
+        assert(len(heads) > 0)
+        self.heads = [(name, num_sources, conditional) for name, num_sources, conditional in heads]
+        self.separators = dict()
+        for name, num_sources, conditional in self.heads:
+            separator_module = ConditionalUnetAudioSeparator if conditional else Unet
+            self.separators[name] = separator_module.UnetAudioSeparator(num_layers, num_initial_filters, upsampling=upsampling, output_type=output_type,
+                                                                        context=context, num_sources=num_sources, mono=mono, filter_size=filter_size,
+                                                                        merge_filter_size=merge_filter_size, **separator_args)
+        # The encoder does not depend on the number of sources, any head separator can build it
+        self.encoder = self.separators[self.heads[0][0]]
+        self.num_layers = num_layers
+        self.num_channels = self.encoder.num_channels
+        if self.encoder.recompute_levels:
+            raise NotImplementedError # Decoders would have to recompute encoder convolutions from outside their scope
+
+    def get_head_names(self):
+        return [name for name, _, _ in self.heads]
+
+    def get_padding(self, shape):
+        '''
+        Input and output shapes as UnetAudioSeparator.get_padding, identical for all heads
+        '''
+        return self.encoder.get_padding(shape)
+
+    def get_output(self, input, labels=None, training=None, return_spectrogram=False, reuse=True, heads=None):
+        '''
+        Creates symbolic computation graph of the shared encoder and the requested heads for a given input batch
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param labels: Dictionary of conditioning labels [batch_size, num_sources] by head name, for conditional heads. Heads without an entry are conditioned on all sources being present
+        :param reuse: Whether to create new parameter variables or reuse existing ones
+        :param heads: Names of the heads to build, by default all heads
+        :return: Dictionary with a list of source estimates by head name. Each estimate is a 3D tensor [batch_size, num_out_samples, num_channels]
+        '''
+        if heads is None:
+            heads = self.get_head_names()
+        if labels is None:
+            labels = dict()
+        outputs = dict()
+        with tf.variable_scope("separator", reuse=reuse, use_resource=self.encoder.uses_recomputation() or None):
+            enc_outputs, bottleneck = self.encoder.get_encoder_output(input)
+            for name, num_sources, conditional in self.heads:
+                if name not in heads:
+                    continue
+                separator = self.separators[name]
+                with tf.variable_scope(name):
+                    current_layer = bottleneck
+                    if conditional:
+                        z = labels[name] if name in labels else tf.ones([tf.shape(input)[0], num_sources])
+                        current_layer = separator.condition_bottleneck(current_layer, z)
+                    outputs[name] = separator.get_decoder_output(input, enc_outputs, current_layer)
+        return outputs
+
+    def get_head_layer_names(self, name):
+        '''
+        :return: Names of all decoder and output layers of a head as in a single-head checkpoint, the scopes below separator/<name>
+        '''
+        separator = self.separators[name]
+        names = [conv_layer_name(index) for index in range(self.num_layers + 1, 2 * self.num_layers + 1 + separator.num_sources)]
+        if separator.upsampling == "learned":
+            names += ["interp_" + str(i) for i in range(self.num_layers)]
+        return names
+
+    def get_encoder_variables(self):
+        head_scopes = tuple(["separator/" + name + "/" for name in self.get_head_names()])
+        return [var for var in tf.global_variables("separator") if not var.op.name.startswith(head_scopes)]
+
+    def get_head_variables(self, name):
+        return tf.global_variables("separator/" + name + "/")
+
+    def warm_start(self, encoder_checkpoint, head_checkpoints):
+        '''
+        Initialises the shared encoder and the heads from single-head checkpoints, e.g. the encoder and the MUSDB head from a
+        MUSDB model and the URMP head from a URMP model. The checkpoints need the same encoder geometry. Decoders that were
+        trained with another encoder than the shared one usually need a short joint fine-tuning.
+        Has to be called after get_output, before the variables are initialised.
+        :param encoder_checkpoint: Checkpoint the encoder and bottleneck convolutions are read from
+        :param head_checkpoints: Dictionary of checkpoints by head name, the decoder and output layers of each head are read from its checkpoint. Heads without an entry keep their initialisation
+        '''
+        encoder_map = dict()
+        for index in range(self.num_layers + 1):
+            encoder_map["separator/" + conv_layer_name(index) + "/"] = "separator/" + conv_layer_name(index) + "/"
+        tf.train.init_from_checkpoint(encoder_checkpoint, encoder_map)
+        for name, checkpoint in head_checkpoints.items():
+            assignment_map = dict()
+            for layer_name in self.get_head_layer_names(name):
+                if layer_name.startswith("interp_"):
+                    assignment_map["separator/" + layer_name] = "separator/" + name + "/" + layer_name
+                else:
+                    assignment_map["separator/" + layer_name + "/"] = "separator/" + name + "/" + layer_name + "/"
+            tf.train.init_from_checkpoint(checkpoint, assignment_map)
+
+    def get_joint_loss(self, outputs, sources, weights=None):
+        '''
+        Loss for joint training of the encoder and several heads
+        :param outputs: Dictionary of source estimates by head name, as returned by get_output
+        :param sources: Dictionary of ground truth source lists by head name, cropped to the output of the separator. Heads without an entry do not contribute
+        :param weights: Optional dictionary of loss weights by head name, 1 by default
+        :return: Weighted sum of the mean squared errors of all heads with ground truth
+        '''
+        loss = 0.0
+        for name, targets in sources.items():
+            head_loss = tf.add_n([tf.reduce_mean(tf.square(tf.cast(estimate, tf.float32) - tf.cast(target, tf.float32)))
+                                  for estimate, target in zip(outputs[name], targets)]) / float(len(targets))
+            loss += (weights[name] if weights is not None and name in weights else 1.0) * head_loss
+        return loss
+
+    def separate(self, sess, mix, outputs, mix_batch, heads=None, feed_dict=None):
+        '''
+        Runs the shared encoder once and the requested heads on a batch of mixtures
+        :param sess: Session with the initialised separator
+        :param mix: Input placeholder the graph was built with
+        :param outputs: Dictionary of source estimates by head name, as returned by get_output
+        :param mix_batch: Mixture batch [batch_size, num_samples, num_channels]
+        :param heads: Names of the heads to compute, by default all heads in outputs
+        :param feed_dict: Optional further feeds, e.g. label placeholders of conditional heads
+        :return: Dictionary with a list of source estimate arrays by head name
+        '''
+        if heads is None:
+            heads = list(outputs.keys())
+        feed = {mix : mix_batch}
+        if feed_dict is not None:
+            feed.update(feed_dict)
+        return sess.run({name : outputs[name] for name in heads}, feed_dict=feed)
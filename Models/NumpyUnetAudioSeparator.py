@@ -0,0 +1,222 @@
+import json
+import os
+
+import numpy as np
+
+CONFIG_FILE = "config.json"
+
+def conv_layer_name(index):
+    '''
+    Same layer names as UnetAudioSeparator.conv_layer_name, repeated here so this module does not depend on Tensorflow
+    '''
+    return "conv1d" if index == 0 else "conv1d_" + str(index)
+
+def weight_file(model_dir, variable_name):
+    '''
+    :param variable_name: Name of the variable inside the separator scope, e.g. "conv1d_3/kernel"
+    :return: Path of the .npy file that holds the variable in an exported model folder
+    '''
+    return os.path.join(model_dir, variable_name.replace("/", ".") + ".npy")
+
+def get_conv_names(config):
+    '''
+    :param config: Geometry of an exported model as in its config file
+    :return: Layer names of all convolutions: encoder, bottleneck, decoder and one output convolution per estimated source
+    '''
+    num_convs = 2 * config["num_layers"] + 1 + (config["num_sources"] if config["output_type"] == "direct" else config["num_sources"] - 1)
+    return [conv_layer_name(index) for index in range(num_convs)]
+
+def get_variable_names(config):
+    '''
+    :param config: Geometry of an exported model as in its config file
+    :return: Names of the model variables inside the separator scope that the engine reads, without optimizer slots or moving averages
+    '''
+    names = [name + "/" + weight for name in get_conv_names(config) for weight in ["kernel", "bias"]]
+    if config["upsampling"] == "learned":
+        names += ["interp_" + str(i) for i in range(config["num_layers"])]
+    return names
+
+def get_int8_names(config):
+    '''
+    :return: Names of the arrays of the int8 convolutions that Quantize.export_int8 writes next to the float model: int8
+             kernel, kernel scale per output channel and calibrated range of the input of every convolution
+    '''
+    return [name + "/" + array for name in get_conv_names(config) for array in ["kernel_q", "kernel_scale", "input_range"]]
+
+def leaky_relu(x, alpha=0.2):
+    return np.maximum(alpha * x, x)
+
+def crop(x, length):
+    '''
+    Centre crop of a feature map [batch_size, width, channels] along time, as Utils.crop
+    '''
+    start = (x.shape[1] - length) // 2
+    return x[:, start:start + length, :]
+
+class NumpyUnetAudioSeparator:
+    '''
+    Inference-only Wave-U-Net forward pass in NumPy, for machines without Tensorflow and for jobs where starting
+    Tensorflow takes longer than the separation itself. Reads a model folder written by Export.export_numpy, with the
+    weights memory-mapped from one .npy file per variable. Supports the UnetAudioSeparator with or without conditioning
+    on source labels (ConditionalUnetAudioSeparator), with dense convolutions, linear or learned upsampling, valid or same
+    padding and both output layer types. Optionally runs all convolutions with int8 inputs and kernels and int32
+    accumulation, from the quantized model that Quantize.export_int8 adds to the folder.
+    '''
+
+    def __init__(self, model_dir, max_chunk_frames=8192, int8=False):
+        '''
+        :param model_dir: Folder written by Export.export_numpy
+        :param max_chunk_frames: Maximum number of output samples per matrix multiply of a convolution, bounds the memory of the unfolded input
+        :param int8: Whether to quantize the input of every convolution to int8 within its calibrated range and multiply it with the int8 kernel
+        '''
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.model_dir = model_dir
+        self.max_chunk_frames = max_chunk_frames
+        self.num_layers = self.config["num_layers"]
+        self.num_sources = self.config["num_sources"]
+        self.num_channels = self.config["num_channels"]
+        self.context = self.config["context"]
+        self.conditional = self.config.get("conditional", False)
+        self.input_length = self.config["input_length"]
+        self.output_length = self.config["output_length"]
+
+        # Kernels as [filter_size * input_channels, num_filters] matrices, to multiply with the unfolded input
+        self.weights = dict()
+        self.int8_scales = dict()
+        for name in get_conv_names(self.config):
+            bias = np.load(weight_file(model_dir, name + "/bias"), mmap_mode="r")
+            if int8:
+                # NumPy's integer matrix multiply accumulates in the type of its operands, so the int8 values are held as int32
+                kernel = np.load(weight_file(model_dir, name + "/kernel_q")).astype(np.int32)
+                input_scale = max(float(np.load(weight_file(model_dir, name + "/input_range"))), 1e-12) / 127.0
+                self.int8_scales[name] = (input_scale, (input_scale * np.load(weight_file(model_dir, name + "/kernel_scale"))).astype(np.float32))
+            else:
+                kernel = np.load(weight_file(model_dir, name + "/kernel"), mmap_mode="r")
+            self.weights[name] = (kernel.reshape([-1, kernel.shape[2]]), kernel.shape[0], bias)
+        if self.config["upsampling"] == "learned":
+            for i in range(self.num_layers):
+                interp = np.load(weight_file(model_dir, "interp_" + str(i)), mmap_mode="r")
+                self.weights["interp_" + str(i)] = 1.0 / (1.0 + np.exp(-interp))
+
+    def conv(self, x, name):
+        '''
+        Convolution with stride 1 as a matrix multiply of the unfolded input with the kernel
+        :param x: Feature map [batch_size, width, channels]
+        :param name: Layer name
+        :return: Feature map [batch_size, new width, num_filters] before activation
+        '''
+        kernel, filter_size, bias = self.weights[name]
+        if name in self.int8_scales: # Symmetric int8 quantization of the input, zero padding stays exact
+            input_scale, output_scale = self.int8_scales[name]
+            x = np.clip(np.rint(x / input_scale), -127, 127).astype(np.int8)
+        if not self.context: # Same padding as Tensorflow: extra entry at the end
+            x = np.pad(x, [(0, 0), ((filter_size - 1) // 2, filter_size // 2), (0, 0)], mode="constant")
+        x = np.ascontiguousarray(x)
+        batch_size, width, channels = x.shape
+        out_width = width - filter_size + 1
+        output = np.empty([batch_size, out_width, kernel.shape[1]], np.float32)
+        for start in range(0, out_width, self.max_chunk_frames):
+            length = min(self.max_chunk_frames, out_width - start)
+            part = x[:, start:start + length + filter_size - 1]
+            windows = np.lib.stride_tricks.as_strided(part, shape=[batch_size, length, filter_size, channels],
+                                                      strides=[part.strides[0], part.strides[1], part.strides[1], part.strides[2]])
+            windows = windows.reshape([batch_size * length, filter_size * channels])
+            if name in self.int8_scales: # int32 accumulation of the int8 products, then rescaled to float
+                product = np.dot(windows.astype(np.int32), kernel).astype(np.float32) * output_scale
+            else:
+                product = np.dot(windows, kernel)
+            output[:, start:start + length] = product.reshape([batch_size, length, -1])
+        output += bias
+        return output
+
+    def upsample(self, x, level):
+        '''
+        Upsampling by a factor of two, N -> 2N-1 samples with valid padding and N -> 2N samples otherwise
+        '''
+        if self.config["upsampling"] == "learned":
+            weights = self.weights["interp_" + str(level)]
+            intermediate = weights * x[:, :-1] + (1.0 - weights) * x[:, 1:]
+        else:
+            intermediate = 0.5 * (x[:, :-1] + x[:, 1:])
+        out = np.empty([x.shape[0], 2 * x.shape[1] - 1, x.shape[2]], np.float32)
+        out[:, 0::2] = x
+        out[:, 1::2] = intermediate
+        if not self.context: # Same padding: the last intermediate sample sees zero padding (learned) or repeats the last sample (bilinear resizing)
+            last = self.weights["interp_" + str(level)] * x[:, -1:] if self.config["upsampling"] == "learned" else x[:, -1:]
+            out = np.concatenate([out, last], axis=1)
+        return out
+
+    def condition_bottleneck(self, x, labels):
+        '''
+        Multiplicative conditioning of the bottleneck features on the source labels as ConditionalUnetAudioSeparator.condition_bottleneck:
+        channel f * num_sources + s is feature f times the label of source s
+        :param x: Bottleneck feature map [batch_size, width, num_filters]
+        :param labels: Labels [batch_size, num_sources] or [1, num_sources]
+        :return: Conditioned feature map [batch_size, width, num_filters * num_sources]
+        '''
+        labels = np.asarray(labels, np.float32)
+        conditioned = x[:, :, :, np.newaxis] * labels[:, np.newaxis, np.newaxis, :]
+        return conditioned.reshape([x.shape[0], x.shape[1], x.shape[2] * self.num_sources])
+
+    def get_output(self, input, labels=None):
+        '''
+        Forward pass of the U-Net
+        :param input: Batch of mixtures [batch_size, num_samples, num_channels]
+        :param labels: For conditional models: Source labels [batch_size, num_sources] or [1, num_sources] for all entries, by default all sources
+        :return: List of source estimates, each [batch_size, num_out_samples, num_channels]
+        '''
+        input = np.asarray(input, np.float32)
+        enc_outputs = list()
+        current_layer = input
+        for i in range(self.num_layers):
+            current_layer = leaky_relu(self.conv(current_layer, conv_layer_name(i)))
+            enc_outputs.append(current_layer)
+            current_layer = current_layer[:, ::2, :]
+        current_layer = leaky_relu(self.conv(current_layer, conv_layer_name(self.num_layers)))
+        if self.conditional:
+            current_layer = self.condition_bottleneck(current_layer, np.ones([1, self.num_sources], np.float32) if labels is None else labels)
+
+        for i in range(self.num_layers):
+            current_layer = self.upsample(current_layer, i)
+            current_layer = np.concatenate([crop(enc_outputs[-i-1], current_layer.shape[1]), current_layer], axis=2)
+            current_layer = leaky_relu(self.conv(current_layer, conv_layer_name(self.num_layers + i + 1)))
+
+        current_layer = np.concatenate([crop(input, current_layer.shape[1]), current_layer], axis=2)
+        outputs = list()
+        num_output_convs = self.num_sources if self.config["output_type"] == "direct" else self.num_sources - 1
+        for i in range(num_output_convs):
+            outputs.append(np.tanh(self.conv(current_layer, conv_layer_name(2 * self.num_layers + 1 + i))))
+        if self.config["output_type"] == "difference":
+            outputs.append(crop(input, current_layer.shape[1]) - np.sum(outputs, axis=0))
+        return outputs
+
+    def separate(self, mix_audio, batch_size=4, labels=None):
+        '''
+        Separates a whole track window by window, as Evaluate.predict_track
+        :param mix_audio: Mixture [n_frames, n_channels] at the sampling rate of the model. Mono models separate each channel of a multichannel mixture as one batch entry
+        :param batch_size: Number of windows processed per forward pass
+        :param labels: For conditional models: Labels of the sources in the track [num_sources], by default all sources
+        :return: List of source estimates, each [n_frames, num_channels]
+        '''
+        source_time_frames, mix_channels = mix_audio.shape
+        channels_as_batch = mix_channels != self.num_channels
+        assert(not channels_as_batch or self.num_channels == 1)
+        pad_front = (self.input_length - self.output_length) // 2
+        pad_back = self.input_length - self.output_length - pad_front + max(self.output_length - source_time_frames, 0)
+        mix_audio_padded = np.pad(mix_audio, [(pad_front, pad_back), (0, 0)], mode="constant")
+
+        positions = [min(pos, max(source_time_frames - self.output_length, 0)) for pos in range(0, source_time_frames, self.output_length)]
+        source_preds = [np.zeros(mix_audio.shape, np.float32) for _ in range(self.num_sources)]
+        for start in range(0, len(positions), batch_size):
+            batch_positions = positions[start:start + batch_size]
+            windows = np.stack([mix_audio_padded[pos:pos + self.input_length] for pos in batch_positions])
+            if channels_as_batch: # [windows, frames, channels] -> [windows * channels, frames, 1]
+                windows = np.transpose(windows, [0, 2, 1]).reshape([-1, self.input_length, 1])
+            source_parts = self.get_output(windows, None if labels is None else np.reshape(labels, [1, self.num_sources]))
+            if channels_as_batch:
+                source_parts = [np.transpose(part.reshape([len(batch_positions), mix_channels, -1]), [0, 2, 1]) for part in source_parts]
+            for i in range(self.num_sources):
+                for b, pos in enumerate(batch_positions):
+                    source_preds[i][pos:pos + self.output_length] = source_parts[i][b, :source_time_frames - pos]
+        return source_preds
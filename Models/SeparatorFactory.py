@@ -0,0 +1,57 @@
+import UnetAudioSeparator
+import ConditionalUnetAudioSeparator
+import CausalUnetAudioSeparator
+import MultiHeadUnetAudioSeparator
+
+def get_separator(model_config, conditional=False):
+    '''
+    Creates the separator selected by model_config["network"]
+    :param model_config: Model configuration dictionary
+    :param conditional: Whether to use the variant conditioned on source labels (only for the unet network)
+    :return: Separator object with get_padding and get_output methods
+    '''
+    if model_config["network"] == "unet":
+        separator_module = ConditionalUnetAudioSeparator if conditional else UnetAudioSeparator
+        return separator_module.UnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
+                                                   output_type=model_config["output_type"],
+                                                   context=model_config["context"],
+                                                   mono=model_config["mono_downmix"],
+                                                   upsampling=model_config["upsampling"],
+                                                   num_sources=model_config["num_sources"],
+                                                   filter_size=model_config["filter_size"],
+                                                   merge_filter_size=model_config["merge_filter_size"],
+                                                   recompute_levels=model_config["recompute_levels"],
+                                                   recompute_decoder_levels=model_config["recompute_decoder_levels"],
+                                                   conv_type=model_config["conv_type"],
+                                                   conv_groups=model_config["conv_groups"],
+                                                   layer_filters=model_config["layer_filters"])
+    elif model_config["network"] == "causal_unet":
+        assert(not conditional)
+        lookahead = int(round(model_config["latency_ms"] * model_config["expected_sr"] / 1000.0))
+        return CausalUnetAudioSeparator.CausalUnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
+                                                                 output_type=model_config["output_type"],
+                                                                 mono=model_config["mono_downmix"],
+                                                                 num_sources=model_config["num_sources"],
+                                                                 filter_size=model_config["causal_filter_size"],
+                                                                 merge_filter_size=model_config["merge_filter_size"],
+                                                                 dilations=model_config["causal_dilations"],
+                                                                 lookahead=lookahead)
+    else:
+        raise NotImplementedError
+
+def get_multi_head_separator(model_config):
+    '''
+    Creates a separator with a shared encoder and one head per entry of model_config["heads"], with the Wave-U-Net settings of model_config
+    :param model_config: Model configuration dictionary
+    :return: MultiHeadUnetAudioSeparator object
+    '''
+    return MultiHeadUnetAudioSeparator.MultiHeadUnetAudioSeparator(model_config["heads"], model_config["num_layers"], model_config["num_initial_filters"],
+                                                                   output_type=model_config["output_type"],
+                                                                   context=model_config["context"],
+                                                                   mono=model_config["mono_downmix"],
+                                                                   upsampling=model_config["upsampling"],
+                                                                   filter_size=model_config["filter_size"],
+                                                                   merge_filter_size=model_config["merge_filter_size"],
+                                                                   conv_type=model_config["conv_type"],
+                                                                   conv_groups=model_config["conv_groups"],
+                                                                   layer_filters=model_config["layer_filters"])
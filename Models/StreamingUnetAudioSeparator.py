@@ -0,0 +1,314 @@
+import time
+
+import tensorflow as tf
+import numpy as np
+
+import Utils
+from Utils import LeakyReLU
+import OutputLayer
+from UnetAudioSeparator import conv_layer_name
+
+class StreamingUnetAudioSeparator:
+    '''
+    Stateful streaming inference engine for a valid-padding (context=True) UnetAudioSeparator.
+    Instead of recomputing the whole receptive field for every output window, the network is rebuilt as a step graph
+    that consumes hop_size new mixture samples and emits hop_size new source samples. Every convolution, upsampling
+    and skip connection keeps a small buffer of the activations it still needs from previous hops, so each step only
+    computes the fresh samples at every resolution.
+
+    Stream alignment: For every feature stream we track how many samples it lags behind the corresponding offline
+    feature map (warm-up samples computed from the zero-initialised buffers). Skip connections and the final input
+    concatenation get an extra delay line so that the same samples meet as in the offline centre crop, and decimation
+    is kept in phase with the offline graph. After discarding the warm-up, the output stream therefore equals the
+    output of get_output run on the whole (zero-padded) track as one input, up to floating point summation order.
+
+    Usage:
+        engine = StreamingUnetAudioSeparator(separator, hop_size=4096)
+        engine.build()
+        # restore checkpoint into the default graph, then
+        engine.push(sess, audio_chunk)
+        sources = engine.pull()
+    '''
+
+    def __init__(self, separator, hop_size, batch_size=1, precision="float32"):
+        '''
+        Initialize streaming engine
+        :param separator: UnetAudioSeparator instance whose weights should be used. Has to use context (valid convolutions) and linear upsampling
+        :param hop_size: Number of new samples consumed and produced per step. Has to be a multiple of 2^num_layers
+        :param batch_size: Number of independent streams processed in parallel
+        :param precision: Precision policy of the stream input, the activation buffers and the step graph (see Utils.precision_scope). Pulled estimates are float32
+        '''
+        assert(separator.context) # Streaming only makes sense for valid convolutions, "same" padding looks at future zeros
+        if separator.upsampling != 'linear' or separator.conv_type != "dense":
+            raise NotImplementedError
+        assert(hop_size > 0 and hop_size % (2 ** separator.num_layers) == 0)
+
+        self.separator = separator
+        self.hop_size = hop_size
+        self.batch_size = batch_size
+        self.num_channels = separator.num_channels
+        self.precision = precision
+        self.dtype = Utils.get_compute_dtype(precision)
+
+        self._compute_alignment()
+
+        self.state_placeholders = list()
+        self.new_states = list()
+        self.states = None
+        self.input_chunk = None
+        self.output_chunks = None
+        self.reset()
+
+    def _compute_alignment(self):
+        '''
+        Computes offline crop offsets and the delays every stream needs in the step graph so that it reproduces offline inference
+        '''
+        sep = self.separator
+        f, fm, L = sep.filter_size, sep.merge_filter_size, sep.num_layers
+
+        # Offline feature map lengths for the smallest valid input, to determine the centre crop offsets (independent of the input length)
+        input_shape, _ = sep.get_padding(np.array([1, 1, sep.num_channels]))
+        input_len = int(input_shape[1])
+        enc_lengths = list()
+        length = input_len
+        for i in range(L):
+            length = length - f + 1
+            enc_lengths.append(length)
+            length = (length - 1) // 2 + 1
+        length = length - f + 1
+        self.crop_offsets = list()
+        for i in range(L):
+            length = 2 * length - 1
+            self.crop_offsets.append((enc_lengths[-i-1] - length) // 2)
+            length = length - fm + 1
+        self.input_crop_offset = (input_len - length) // 2
+
+        # Walk through the step graph and track the warm-up lag of every stream relative to the offline feature maps
+        self.enc_delays = list()
+        enc_lags = list()
+        lag = 0
+        for i in range(L):
+            delay = (lag + f - 1) % 2 # Decimation has to keep offline-even positions
+            self.enc_delays.append(delay)
+            lag = lag + delay + f - 1
+            enc_lags.append(lag)
+            lag = lag // 2
+        lag = lag + f - 1
+
+        self.skip_delays = list()
+        self.up_delays = list()
+        for i in range(L):
+            lag = 2 * lag + 1 # Upsampling
+            delay = lag - enc_lags[-i-1] - self.crop_offsets[i]
+            self.skip_delays.append(max(delay, 0))
+            self.up_delays.append(max(-delay, 0))
+            lag = lag + max(-delay, 0) + fm - 1
+
+        delay = lag - self.input_crop_offset
+        self.input_delay = max(delay, 0)
+        self.output_delay = max(-delay, 0)
+        self.warmup = lag + self.output_delay
+
+    def get_latency(self):
+        '''
+        Algorithmic latency of the engine, not including the time to compute a step
+        :return: Number of samples between pushing a mixture sample and pulling its source estimate, assuming the hop is filled exactly
+        '''
+        return self.warmup - self.input_crop_offset + self.hop_size - 1
+
+    def _state(self, length, channels):
+        placeholder = tf.placeholder(self.dtype, [self.batch_size, length, channels])
+        self.state_placeholders.append(placeholder)
+        return placeholder
+
+    def _delay(self, current_layer, delay):
+        '''
+        Delay line: Outputs the stream delayed by delay samples, keeping the last delay samples as state
+        '''
+        if delay == 0:
+            return current_layer
+        channels = current_layer.get_shape().as_list()[2]
+        full = tf.concat([self._state(delay, channels), current_layer], axis=1)
+        length = current_layer.get_shape().as_list()[1]
+        self.new_states.append(full[:, length:, :])
+        return full[:, :length, :]
+
+    def _conv(self, current_layer, num_filters, filter_size, index, activation=LeakyReLU):
+        '''
+        Valid convolution over the new samples, with the last filter_size-1 input samples of the previous step as context
+        '''
+        channels = current_layer.get_shape().as_list()[2]
+        full = tf.concat([self._state(filter_size - 1, channels), current_layer], axis=1)
+        self.new_states.append(full[:, -(filter_size - 1):, :])
+        return tf.layers.conv1d(full, num_filters, filter_size, activation=activation, padding='valid', name=conv_layer_name(index))
+
+    def _upsample(self, current_layer):
+        '''
+        Linear upsampling as in tf.image.resize_bilinear with align_corners (out = 2*in - 1), where the missing neighbour
+        of the first new sample is the last sample of the previous step
+        '''
+        shape = current_layer.get_shape().as_list()
+        full = tf.concat([self._state(1, shape[2]), current_layer], axis=1)
+        self.new_states.append(full[:, -1:, :])
+        previous = full[:, :-1, :]
+        # Same formula as the resize kernel so results are bit-identical: top_left + (top_right - top_left) * x_lerp
+        interpolated = previous + (current_layer - previous) * 0.5
+        current_layer = tf.stack([interpolated, current_layer], axis=2)
+        return tf.reshape(current_layer, [shape[0], shape[1] * 2, shape[2]])
+
+    def build(self, reuse=False):
+        '''
+        Creates the step graph. Variable names are identical to the ones created by UnetAudioSeparator.get_output, so
+        a checkpoint of the offline model can be restored into it
+        :param reuse: Whether to create new parameter variables or reuse existing ones
+        :return: List of source output tensors of one step, each [batch_size, hop_size, num_channels]
+        '''
+        sep = self.separator
+        del self.state_placeholders[:]
+        del self.new_states[:]
+        self.input = tf.placeholder(self.dtype, [self.batch_size, self.hop_size, self.num_channels], name="stream_input")
+
+        with Utils.precision_scope(self.precision), tf.variable_scope("separator", reuse=reuse):
+            enc_outputs = list()
+            current_layer = self.input
+
+            for i in range(sep.num_layers):
+                current_layer = self._delay(current_layer, self.enc_delays[i])
+                current_layer = self._conv(current_layer, sep.get_num_filters(i), sep.filter_size, i)
+                enc_outputs.append(current_layer)
+                current_layer = current_layer[:,::2,:] # Decimate, hop at this level is even so the phase stays fixed
+
+            current_layer = self._conv(current_layer, sep.get_num_filters(sep.num_layers), sep.filter_size, sep.num_layers)
+
+            for i in range(sep.num_layers):
+                current_layer = self._upsample(current_layer)
+                current_layer = self._delay(current_layer, self.up_delays[i])
+                skip = self._delay(enc_outputs[-i-1], self.skip_delays[i])
+                current_layer = tf.concat([skip, current_layer], axis=2)
+                current_layer = self._conv(current_layer, sep.get_num_filters(sep.num_layers + i + 1), sep.merge_filter_size, sep.num_layers + i + 1)
+
+            current_layer = self._delay(current_layer, self.output_delay)
+            cropped_input = self._delay(self.input, self.input_delay)
+            current_layer = tf.concat([cropped_input, current_layer], axis=2)
+
+            # Output layer
+            output_names = [conv_layer_name(2 * sep.num_layers + 1 + i) for i in range(sep.num_sources)]
+            if sep.output_type == "direct":
+                self.outputs = OutputLayer.independent_outputs(current_layer, sep.num_sources, sep.num_channels, output_names)
+            elif sep.output_type == "difference":
+                self.outputs = OutputLayer.difference_output(cropped_input, current_layer, sep.num_sources, sep.num_channels, output_names)
+            else:
+                raise NotImplementedError
+        self.outputs = [tf.cast(output, tf.float32) for output in self.outputs]
+        self.reset()
+        return self.outputs
+
+    def reset(self):
+        '''
+        Clears all activation buffers and starts a new stream. The stream is preceded by the same zero padding that
+        Evaluate.predict_track puts in front of a track, so the n-th pulled sample belongs to the n-th pushed sample
+        '''
+        self.states = [np.zeros(p.get_shape().as_list(), self.dtype.as_numpy_dtype) for p in self.state_placeholders]
+        self.input_chunk = np.zeros([self.batch_size, self.input_crop_offset, self.num_channels], self.dtype.as_numpy_dtype)
+        self.output_chunks = list()
+        self.to_discard = self.warmup
+        self.num_pushed = 0
+        self.num_pulled = 0
+        self.chunk_latencies = list()
+
+    def step(self, sess, chunk):
+        '''
+        Runs the step graph on exactly hop_size new samples
+        :param sess: Session holding the restored separator variables
+        :param chunk: Mixture audio [batch_size, hop_size, num_channels]
+        :return: List of source estimates for the hop, each [batch_size, hop_size, num_channels] (includes warm-up samples)
+        '''
+        feed_dict = {self.input : chunk}
+        feed_dict.update(zip(self.state_placeholders, self.states))
+
+        start = time.time()
+        outputs, self.states = sess.run([self.outputs, self.new_states], feed_dict=feed_dict)
+        self.chunk_latencies.append(time.time() - start)
+        return outputs
+
+    def push(self, sess, audio):
+        '''
+        Feeds new mixture samples into the stream and runs as many steps as there are complete hops buffered
+        :param sess: Session holding the restored separator variables
+        :param audio: Mixture audio [batch_size, num_samples, num_channels] or [num_samples, num_channels] if batch_size is 1
+        '''
+        if len(audio.shape) == 2:
+            audio = np.expand_dims(audio, axis=0)
+        self.num_pushed += audio.shape[1]
+        self.input_chunk = np.concatenate([self.input_chunk, audio.astype(self.dtype.as_numpy_dtype)], axis=1)
+        while self.input_chunk.shape[1] >= self.hop_size:
+            outputs = self.step(sess, self.input_chunk[:, :self.hop_size, :])
+            self.input_chunk = self.input_chunk[:, self.hop_size:, :]
+
+            discard = min(self.to_discard, self.hop_size)
+            self.to_discard -= discard
+            if discard < self.hop_size:
+                self.output_chunks.append(np.stack([output[:, discard:, :] for output in outputs], axis=1))
+
+    def flush(self, sess):
+        '''
+        Pushes zeros until the source estimates for all pushed samples are available, as in the zero-padded end of Evaluate.predict_track
+        '''
+        missing = self.num_pushed - self.num_pulled - sum([chunk.shape[2] for chunk in self.output_chunks])
+        if missing > 0:
+            pushed = self.num_pushed
+            needed = missing + self.to_discard # Number of samples that still have to go through the step graph
+            padding = int(np.ceil(float(needed) / self.hop_size)) * self.hop_size - self.input_chunk.shape[1]
+            self.push(sess, np.zeros([self.batch_size, padding, self.num_channels], np.float32))
+            self.num_pushed = pushed
+
+    def pull(self, max_samples=None):
+        '''
+        Returns the source estimates computed so far that have not been pulled yet
+        :param max_samples: Maximum number of samples to return
+        :return: List of source estimates, each [batch_size, num_samples, num_channels]
+        '''
+        available = np.concatenate(self.output_chunks, axis=2) if len(self.output_chunks) > 0 else \
+            np.zeros([self.batch_size, self.separator.num_sources, 0, self.num_channels], np.float32)
+        limit = self.num_pushed - self.num_pulled # Never return estimates for padding samples
+        if max_samples is not None:
+            limit = min(limit, max_samples)
+        out, rest = available[:, :, :limit, :], available[:, :, limit:, :]
+        self.output_chunks = [rest] if rest.shape[2] > 0 else list()
+        self.num_pulled += out.shape[2]
+        return [out[:, i] for i in range(self.separator.num_sources)]
+
+    def separate(self, sess, mix_audio):
+        '''
+        Separates a whole track by streaming it through the engine hop by hop
+        :param sess: Session holding the restored separator variables
+        :param mix_audio: [n_frames, n_channels] mixture, already at the sampling rate and number of channels of the model
+        :return: List of source estimates, each [n_frames, n_channels]
+        '''
+        self.reset()
+        for pos in range(0, mix_audio.shape[0], self.hop_size):
+            self.push(sess, mix_audio[pos:pos + self.hop_size])
+        self.flush(sess)
+        return [source[0] for source in self.pull()]
+
+    def get_latency_report(self, sample_rate):
+        '''
+        Summarises latency of the stream so far
+        :param sample_rate: Sampling rate of the stream
+        :return: Dictionary with algorithmic latency and per-chunk compute time statistics (in milliseconds) and the real-time factor
+        '''
+        hop_ms = 1000.0 * self.hop_size / sample_rate
+        report = {
+            'hop_ms' : hop_ms,
+            'algorithmic_latency_ms' : 1000.0 * self.get_latency() / sample_rate,
+            'num_chunks' : len(self.chunk_latencies)
+        }
+        if len(self.chunk_latencies) > 0:
+            chunk_ms = 1000.0 * np.array(self.chunk_latencies)
+            report.update({
+                'chunk_ms_mean' : float(np.mean(chunk_ms)),
+                'chunk_ms_p95' : float(np.percentile(chunk_ms, 95)),
+                'chunk_ms_max' : float(np.max(chunk_ms)),
+                'real_time_factor' : float(np.mean(chunk_ms)) / hop_ms
+            })
+        return report
@@ -5,16 +5,34 @@ from Utils import LeakyReLU
 import numpy as np
 import OutputLayer
 
+def conv_layer_name(index):
+    '''
+    Name that tf.layers.conv1d assigns by default to the index-th convolution created inside the separator scope.
+    Layers are created in the order encoder, bottleneck, decoder, output layer, so graphs that rebuild the network
+    layer by layer can use this to map onto variables of a checkpoint written by get_output
+    :param index: Creation index of the convolution
+    :return: Layer name, e.g. "conv1d" or "conv1d_12"
+    '''
+    return "conv1d" if index == 0 else "conv1d_" + str(index)
+
 class UnetAudioSeparator:
     '''
     U-Net separator network for singing voice separation.
     Uses valid convolutions, so it predicts for the centre part of the input - only certain input and output shapes are therefore possible (see getpadding function)
     '''
 
-    def __init__(self, num_layers, num_initial_filters, upsampling, output_type, context, num_sources, mono, filter_size, merge_filter_size):
+    def __init__(self, num_layers, num_initial_filters, upsampling, output_type, context, num_sources, mono, filter_size, merge_filter_size,
+                 recompute_levels=None, recompute_decoder_levels=None, conv_type="dense", conv_groups=4, layer_filters=None):
         '''
         Initialize U-net
         :param num_layers: Number of down- and upscaling layers in the network 
+        :param recompute_levels: Levels (0 = full sample rate) whose encoder block is recomputed in the backward pass. Only the block input is kept,
+        the skip connection feature map is recomputed inside the decoder block of the same level instead of being stored
+        :param recompute_decoder_levels: Levels whose decoder block (concatenation and merge convolution) is recomputed in the backward pass
+        :param conv_type: Convolution used in the encoder and decoder blocks: "dense", "separable" (depthwise followed by pointwise convolution) or "grouped"
+        :param conv_groups: For grouped convolutions: Number of channel groups
+        :param layer_filters: Optional list of 2*num_layers+1 filter counts for the encoder, bottleneck and decoder convolutions in creation order (e.g. of a pruned network).
+        By default, the number of filters at level i is num_initial_filters * (i+1)
         '''
         self.num_layers = num_layers
         self.num_initial_filters = num_initial_filters
@@ -26,6 +44,16 @@ class UnetAudioSeparator:
         self.padding = "valid" if context else "same"
         self.num_sources = num_sources
         self.num_channels = 1 if mono else 2
+        self.recompute_levels = set(recompute_levels or [])
+        self.recompute_decoder_levels = set(recompute_decoder_levels or [])
+        if conv_type not in ["dense", "separable", "grouped"]:
+            raise NotImplementedError
+        self.conv_type = conv_type
+        self.conv_groups = conv_groups
+        if layer_filters is not None:
+            assert(len(layer_filters) == 2 * num_layers + 1)
+        self.layer_filters = layer_filters
+        self.conv_input_hook = None # Optional function (input, layer name) -> input applied to the input of every convolution, e.g. for calibration or quantization
 
     def get_padding(self, shape):
         '''
@@ -69,54 +97,312 @@ class UnetAudioSeparator:
         else:
             return [shape[0], shape[1], self.num_channels], [shape[0], shape[1], self.num_channels]
 
+    def get_valid_length(self, num_frames):
+        '''
+        Snaps a desired number of output samples to the nearest valid output length that is not shorter (see get_padding)
+        :param num_frames: Desired number of output samples
+        :return: Valid input length, valid output length
+        '''
+        input_shape, output_shape = self.get_padding(np.array([1, num_frames, self.num_channels]))
+        return int(input_shape[1]), int(output_shape[1])
+
+    def _get_lengths(self, bottleneck_length):
+        # Input and output length of the valid-padding network for a given length of the lowest-res feature map (see get_padding)
+        input_length = bottleneck_length + self.filter_size - 1
+        output_length = bottleneck_length
+        for i in range(self.num_layers):
+            output_length = 2*output_length - 1 - self.merge_filter_size + 1
+            input_length = 2*input_length - 1 + self.filter_size - 1
+        return int(input_length), int(output_length)
+
+    def get_valid_shapes(self, num_frames, num_candidates=5):
+        '''
+        Lists valid pairs of input and output length close to a desired output length
+        :param num_frames: Desired number of output samples
+        :param num_candidates: Number of valid pairs to return
+        :return: List of (input_length, output_length) tuples, sorted by distance of the output length to num_frames
+        '''
+        if self.context:
+            # Valid lengths are determined by the length of the lowest-res feature map, which has to be at least 2
+            _, output_length = self.get_valid_length(num_frames)
+            bottleneck_length = (output_length + self.merge_filter_size * (2 ** self.num_layers - 1)) // (2 ** self.num_layers) # out = 2^L * x - merge_filter_size * (2^L - 1)
+            candidates = [self._get_lengths(x) for x in range(max(2, bottleneck_length - num_candidates), bottleneck_length + num_candidates + 1)]
+        else:
+            # Same padding: Feature maps have to be halved exactly num_layers times
+            block = 2 ** self.num_layers
+            start = max(1, int(round(num_frames / float(block))) - num_candidates)
+            candidates = [(x * block, x * block) for x in range(start, start + 2 * num_candidates + 1)]
+        return sorted(candidates, key=lambda shapes: (abs(shapes[1] - num_frames), shapes[1]))[:num_candidates]
+
+    def get_receptive_field(self):
+        '''
+        :return: Number of input samples that influence one output sample
+        '''
+        if self.context:
+            input_length, output_length = self._get_lengths(2)
+            return input_length - output_length + 1
+        else:
+            # Same padding: One sample of the lowest-res feature map sees the whole bottleneck filter, grown by every level below
+            return (self.filter_size - 1) * (2 ** (self.num_layers + 1) - 1) + 2 ** self.num_layers
+
+    def get_bottleneck_channels(self, num_filters):
+        '''
+        :return: Number of channels of the bottleneck features that go into the decoder
+        '''
+        return num_filters
+
+    def get_plan(self, num_frames, batch_size=1, bytes_per_value=4):
+        '''
+        Plans the geometry of the network for a desired output length without building a graph: activation shapes,
+        parameter counts and FLOPs of every layer, as well as activation memory for training and inference
+        :param num_frames: Desired number of output samples, snapped to a valid length
+        :param batch_size: Batch size
+        :param bytes_per_value: Size of one activation value, 4 for float32, 2 for float16/bfloat16
+        :return: Dictionary with input_length, output_length, receptive_field, total params, flops, inference_peak_bytes,
+                 training_activation_bytes, recompute_flops (extra FLOPs per training step spent on recomputation) and the list of layers,
+                 each a dictionary with name, type, input_shape, output_shape, params, flops, activation_bytes and whether it is recomputed
+        '''
+        input_length, output_length = self.get_valid_length(num_frames)
+        layers = list()
+
+        def add(name, type, input_shape, output_shape, params=0, flops=0, recomputed=False):
+            layers.append({"name" : name, "type" : type, "input_shape" : input_shape, "output_shape" : output_shape,
+                           "params" : params, "flops" : flops,
+                           "activation_bytes" : int(np.prod(output_shape)) * bytes_per_value,
+                           "recomputed" : recomputed})
+            return output_shape
+
+        def conv(index, shape, num_filters, filter_size, recomputed=False):
+            length = shape[1] - filter_size + 1 if self.context else shape[1]
+            conv_type = self.get_conv_type(index, shape[2], num_filters) if index <= 2 * self.num_layers else "dense"
+            if conv_type == "separable":
+                weights = filter_size * shape[2] + shape[2] * num_filters
+            elif conv_type == "grouped":
+                weights = filter_size * shape[2] * num_filters // self.conv_groups
+            else:
+                weights = filter_size * shape[2] * num_filters
+            params = weights + num_filters
+            flops = 2 * batch_size * length * weights
+            return add(conv_layer_name(index), "conv", shape, [batch_size, length, num_filters], params, flops, recomputed)
+
+        shape = [batch_size, input_length, self.num_channels]
+        enc_shapes = list()
+        recompute_flops = 0
+        for i in range(self.num_layers):
+            shape = conv(i, shape, self.get_num_filters(i), self.filter_size, i in self.recompute_levels)
+            if i in self.recompute_levels: # Recomputed in the encoder backward pass, and forward and backward in the decoder block
+                recompute_flops += 3 * layers[-1]["flops"]
+            enc_shapes.append(shape)
+            shape = add("decimate_" + str(i), "decimate", shape, [batch_size, (shape[1] - 1) // 2 + 1, shape[2]])
+        shape = conv(self.num_layers, shape, self.get_num_filters(self.num_layers), self.filter_size)
+        shape = [batch_size, shape[1], self.get_bottleneck_channels(shape[2])]
+
+        for i in range(self.num_layers):
+            length = 2 * shape[1] - 1 if self.context else 2 * shape[1]
+            shape = add("upsample_" + str(i), "upsample", shape, [batch_size, length, shape[2]], shape[2] if self.upsampling == 'learned' else 0)
+            level = self.num_layers - i - 1
+            recomputed = level in self.recompute_levels or level in self.recompute_decoder_levels
+            shape = add("concat_" + str(i), "concat", shape, [batch_size, shape[1], shape[2] + enc_shapes[-i-1][2]], recomputed=recomputed)
+            shape = conv(self.num_layers + i + 1, shape, self.get_num_filters(self.num_layers + i + 1), self.merge_filter_size)
+            if recomputed:
+                recompute_flops += layers[-1]["flops"]
+
+        shape = add("concat_input", "concat", shape, [batch_size, shape[1], shape[2] + self.num_channels])
+        num_output_convs = self.num_sources if self.output_type == "direct" else self.num_sources - 1
+        for i in range(num_output_convs):
+            conv(2 * self.num_layers + 1 + i, shape, self.num_channels, 1)
+
+        # Inference: Only the skip connections stay alive next to the input and output of the current layer
+        inference_peak = 0
+        live_skips = 0
+        current = batch_size * input_length * self.num_channels * bytes_per_value
+        for layer in layers:
+            inference_peak = max(inference_peak, live_skips + current + layer["activation_bytes"])
+            if layer["type"] == "concat" and layer["name"] != "concat_input": # Skip connection is consumed
+                live_skips -= int(np.prod(enc_shapes[-int(layer["name"].split("_")[1])-1])) * bytes_per_value
+            if layer["type"] == "conv" and layer["name"] in [conv_layer_name(i) for i in range(self.num_layers)]:
+                live_skips += layer["activation_bytes"]
+            current = layer["activation_bytes"]
+
+        return {"input_length" : input_length,
+                "output_length" : output_length,
+                "receptive_field" : self.get_receptive_field(),
+                "params" : int(sum([l["params"] for l in layers])),
+                "flops" : int(sum([l["flops"] for l in layers])),
+                "inference_peak_bytes" : int(inference_peak),
+                "training_activation_bytes" : int(sum([l["activation_bytes"] for l in layers if not l["recomputed"]])), # Backpropagation keeps all activations that are not recomputed
+                "recompute_flops" : int(recompute_flops),
+                "layers" : layers}
+
     def get_output(self, input, training=None, return_spectrogram=False, reuse=True):
         '''
         Creates symbolic computation graph of the U-Net for a given input batch
-        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]. Batch size and number of samples can be unknown (None), as long as the number of samples at runtime is valid (see get_valid_length)
         :param reuse: Whether to create new parameter variables or reuse existing ones
         :return: U-Net output: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
         '''
-        with tf.variable_scope("separator", reuse=reuse):
-            enc_outputs = list()
-            current_layer = input
+        with tf.variable_scope("separator", reuse=reuse, use_resource=self.uses_recomputation() or None):
+            enc_outputs, current_layer = self.get_encoder_output(input)
+            return self.get_decoder_output(input, enc_outputs, current_layer)
 
-            # Down-convolution: Repeat strided conv
-            for i in range(self.num_layers):
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * i), self.filter_size, strides=1, activation=LeakyReLU, padding=self.padding) # out = in - filter + 1
+    def uses_recomputation(self):
+        '''
+        :return: Whether any block is recomputed in the backward pass. Recomputed blocks need resource variables, so get_output then creates the separator variables as such
+        '''
+        return len(self.recompute_levels) > 0 or len(self.recompute_decoder_levels) > 0
+
+    def get_num_filters(self, index):
+        '''
+        :param index: Creation index of an encoder, bottleneck or decoder convolution, see conv_layer_name
+        :return: Number of filters of that convolution
+        '''
+        if self.layer_filters is not None:
+            return self.layer_filters[index]
+        level = index if index <= self.num_layers else 2 * self.num_layers - index
+        return self.num_initial_filters + (self.num_initial_filters * level)
+
+    def get_conv_type(self, index, num_input_channels, num_filters):
+        '''
+        Determines the convolution type of an encoder or decoder block. The first layer only sees the audio channels and
+        always stays dense, as do grouped layers whose channel counts are not divisible by the number of groups
+        :param index: Creation index of the convolution, see conv_layer_name
+        :return: "dense", "separable" or "grouped"
+        '''
+        if index == 0:
+            return "dense"
+        if self.conv_type == "grouped" and (num_input_channels % self.conv_groups != 0 or num_filters % self.conv_groups != 0):
+            return "dense"
+        return self.conv_type
+
+    def conv(self, input, num_filters, filter_size, index, reuse=None):
+        '''
+        Convolution with LeakyReLU activation, named explicitly after its creation index so recomputed blocks map onto the same variables
+        :param index: Creation index of the convolution, see conv_layer_name
+        :param reuse: Whether to reuse the variables of an already created convolution with the same index
+        '''
+        if self.conv_input_hook is not None:
+            input = self.conv_input_hook(input, conv_layer_name(index))
+        num_input_channels = input.get_shape().as_list()[2]
+        conv_type = self.get_conv_type(index, num_input_channels, num_filters)
+        if conv_type == "separable":
+            return tf.layers.separable_conv1d(input, num_filters, filter_size, strides=1, activation=LeakyReLU, padding=self.padding,
+                                              name=conv_layer_name(index), reuse=reuse)
+        elif conv_type == "grouped":
+            # Independent convolutions on each group of channels, followed by a channel shuffle so the next grouped layer mixes information across groups
+            with tf.variable_scope(conv_layer_name(index), reuse=reuse):
+                groups = tf.split(input, self.conv_groups, axis=2)
+                outputs = [tf.layers.conv1d(group, num_filters // self.conv_groups, filter_size, strides=1, padding=self.padding, name="group_" + str(g))
+                           for g, group in enumerate(groups)]
+                output = LeakyReLU(tf.concat(outputs, axis=2))
+                shape = Utils.get_shape(output)
+                output = tf.reshape(output, [shape[0], shape[1], self.conv_groups, num_filters // self.conv_groups])
+                output = tf.transpose(output, [0, 1, 3, 2])
+                return tf.reshape(output, [shape[0], shape[1], num_filters])
+        else:
+            return tf.layers.conv1d(input, num_filters, filter_size, strides=1, activation=LeakyReLU, padding=self.padding,
+                                    name=conv_layer_name(index), reuse=reuse) # out = in - filter + 1
+
+    def get_encoder_output(self, input):
+        '''
+        Creates the downsampling part of the U-Net. Has to be called inside the variable scope of the separator
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :return: List of feature maps for the skip connections, bottleneck feature map
+        '''
+        enc_outputs = list()
+        current_layer = input
+
+        # Down-convolution: Repeat strided conv
+        for i in range(self.num_layers):
+            num_filters = self.get_num_filters(i)
+            if i in self.recompute_levels:
+                # Keep only the block input for the skip connection, the decoder recomputes the convolution from it
+                def encoder_block(x, num_filters=num_filters, i=i):
+                    return self.conv(x, num_filters, self.filter_size, i)[:,::2,:]
+                enc_outputs.append(current_layer)
+                current_layer = tf.contrib.layers.recompute_grad(encoder_block)(current_layer)
+            else:
+                current_layer = self.conv(current_layer, num_filters, self.filter_size, i)
                 enc_outputs.append(current_layer)
                 current_layer = current_layer[:,::2,:] # Decimate by factor of 2 # out = (in-1)/2 + 1
 
-            current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * self.num_layers),self.filter_size,activation=LeakyReLU,padding=self.padding) # One more conv here since we need to compute features after last decimation
-            # Feature map here shall be X along one dimension
+        current_layer = self.conv(current_layer, self.get_num_filters(self.num_layers), self.filter_size, self.num_layers) # One more conv here since we need to compute features after last decimation
+        # Feature map here shall be X along one dimension
+        return enc_outputs, current_layer
 
-            # Upconvolution
-            for i in range(self.num_layers):
-                #UPSAMPLING
-                current_layer = tf.expand_dims(current_layer, axis=1)
-                if self.upsampling == 'learned':
-                    # Learned interpolation between two neighbouring time positions by using a convolution filter of width 2, and inserting the responses in the middle of the two respective inputs
-                    current_layer = Utils.learned_interpolation_layer(current_layer, self.padding, i)
+    def get_decoder_output(self, input, enc_outputs, current_layer):
+        '''
+        Creates the upsampling part of the U-Net and the output layer. Has to be called inside the variable scope of the separator
+        :param input: Input batch of mixtures, 3D tensor [batch_size, num_samples, num_channels]
+        :param enc_outputs: Feature maps for the skip connections from get_encoder_output
+        :param current_layer: Bottleneck feature map
+        :return: List of source estimates. Each item is a 3D tensor [batch_size, num_out_samples, num_channels]
+        '''
+        # Upconvolution
+        for i in range(self.num_layers):
+            #UPSAMPLING
+            current_layer = tf.expand_dims(current_layer, axis=1)
+            width = current_layer.get_shape().as_list()[2]
+            if width is None: # Shape-polymorphic graph
+                width = tf.shape(current_layer)[2]
+            if self.upsampling == 'learned':
+                # Learned interpolation between two neighbouring time positions by using a convolution filter of width 2, and inserting the responses in the middle of the two respective inputs
+                current_layer = Utils.learned_interpolation_layer(current_layer, self.padding, i)
+            else:
+                if self.context:
+                    current_layer = tf.image.resize_bilinear(current_layer, [1, width * 2 - 1], align_corners=True)
                 else:
-                    if self.context:
-                        current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2] * 2 - 1], align_corners=True)
-                        current_layer = tf.cast(current_layer, tf.bfloat16)
-                    else:
-                        current_layer = tf.image.resize_bilinear(current_layer, [1, current_layer.get_shape().as_list()[2]*2]) # out = in + in - 1
-                #current_layer = tf.layers.conv2d_transpose(current_layer, self.num_initial_filters + (16 * (self.num_layers-i-1)), [1, 15], strides=[1, 2], activation=LeakyReLU, padding='same') # output = input * stride + filter - stride
-                current_layer = tf.squeeze(current_layer, axis=1)
-
-                assert(enc_outputs[-i-1].get_shape().as_list()[1] == current_layer.get_shape().as_list()[1] or self.context) #No cropping should be necessary unless we are using context
-                current_layer = Utils.crop_and_concat(enc_outputs[-i-1], current_layer, match_feature_dim=False)
-                current_layer = tf.layers.conv1d(current_layer, self.num_initial_filters + (self.num_initial_filters * (self.num_layers - i - 1)), self.merge_filter_size,
-                                                 activation=LeakyReLU,
-                                                 padding=self.padding)  # out = in - filter + 1
-
-            current_layer = Utils.crop_and_concat(input, current_layer, match_feature_dim=False)
-            # Output layer
-            if self.output_type == "direct":
-                return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels)
-            elif self.output_type == "difference":
-                cropped_input = Utils.crop(input,current_layer.get_shape().as_list(), match_feature_dim=False)
-                return OutputLayer.difference_output(cropped_input, current_layer, self.num_sources, self.num_channels)
+                    current_layer = tf.image.resize_bilinear(current_layer, [1, width*2]) # out = in + in - 1
+                current_layer = tf.cast(current_layer, input.dtype) # Resizing always outputs float32, go back to the precision of the model
+            #current_layer = tf.layers.conv2d_transpose(current_layer, self.num_initial_filters + (16 * (self.num_layers-i-1)), [1, 15], strides=[1, 2], activation=LeakyReLU, padding='same') # output = input * stride + filter - stride
+            current_layer = tf.squeeze(current_layer, axis=1)
+
+            level = self.num_layers - i - 1
+            def decoder_block(skip, x, level=level, i=i):
+                if level in self.recompute_levels: # Skip connection only holds the encoder block input, recompute its convolution
+                    skip = self.conv(skip, self.get_num_filters(level), self.filter_size, level, reuse=True)
+                assert(skip.get_shape().as_list()[1] == x.get_shape().as_list()[1] or self.context or x.get_shape().as_list()[1] is None) #No cropping should be necessary unless we are using context
+                x = Utils.crop_and_concat(skip, x, match_feature_dim=False)
+                return self.conv(x, self.get_num_filters(self.num_layers + 1 + i), self.merge_filter_size, self.num_layers + 1 + i)
+
+            if level in self.recompute_levels or level in self.recompute_decoder_levels:
+                current_layer = tf.contrib.layers.recompute_grad(decoder_block)(enc_outputs[-i-1], current_layer)
             else:
-                raise NotImplementedError
+                current_layer = decoder_block(enc_outputs[-i-1], current_layer)
+
+        current_layer = Utils.crop_and_concat(input, current_layer, match_feature_dim=False)
+        # Output layer
+        output_names = [conv_layer_name(2 * self.num_layers + 1 + i) for i in range(self.num_sources)]
+        if self.conv_input_hook is not None:
+            current_layer = self.conv_input_hook(current_layer, output_names[0]) # All output convolutions share this input
+        if self.output_type == "direct":
+            return OutputLayer.independent_outputs(current_layer, self.num_sources, self.num_channels, output_names)
+        elif self.output_type == "difference":
+            cropped_input = Utils.crop(input,Utils.get_shape(current_layer), match_feature_dim=False)
+            return OutputLayer.difference_output(cropped_input, current_layer, self.num_sources, self.num_channels, output_names)
+        else:
+            raise NotImplementedError
+
+def search_geometry(num_frames_options, num_layers_options, num_initial_filters_options, max_flops=None, max_training_bytes=None, batch_size=1, **separator_args):
+    '''
+    Plans all combinations of output length, depth and width and keeps those within a compute and memory budget
+    :param num_frames_options: List of desired output lengths
+    :param num_layers_options: List of numbers of U-Net layers
+    :param num_initial_filters_options: List of numbers of filters in the first layer
+    :param max_flops: Maximum FLOPs per forward pass of one batch, None for no limit
+    :param max_training_bytes: Maximum activation memory for training one batch, None for no limit
+    :param batch_size: Batch size
+    :param separator_args: Remaining arguments of the UnetAudioSeparator constructor
+    :return: List of plan summaries (see get_plan, without the layer list) with the configuration, sorted by FLOPs per output sample
+    '''
+    results = list()
+    for num_layers in num_layers_options:
+        for num_initial_filters in num_initial_filters_options:
+            separator = UnetAudioSeparator(num_layers, num_initial_filters, **separator_args)
+            for num_frames in num_frames_options:
+                plan = separator.get_plan(num_frames, batch_size)
+                del plan["layers"]
+                if (max_flops is None or plan["flops"] <= max_flops) and (max_training_bytes is None or plan["training_activation_bytes"] <= max_training_bytes):
+                    plan.update({"num_frames" : num_frames, "num_layers" : num_layers, "num_initial_filters" : num_initial_filters,
+                                 "flops_per_output_sample" : plan["flops"] / float(batch_size * plan["output_length"])})
+                    results.append(plan)
+    return sorted(results, key=lambda plan: plan["flops_per_output_sample"])
@@ -0,0 +1,137 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+INPUT_READY_KEY = "input_ready_time"
+
+def mark_input_ready(features, labels):
+    '''
+    Records the wall-clock time at which a training step has received its input batch, for InputStallHook. The model
+    only starts once the time is taken, so the time from the start of the step until then is spent waiting for input.
+    Uses a py_func, so it can only be used when the step runs on the CPU of this host, not on a TPU
+    :param features: Feature dictionary returned by the input_fn
+    :param labels: Labels returned by the input_fn
+    :return: Features and labels that depend on the timestamp
+    '''
+    tensors = list(features.values()) + [labels]
+    with tf.control_dependencies(tensors):
+        ready = tf.py_func(lambda: np.float64(time.time()), [], tf.float64, stateful=True)
+    tf.add_to_collection(INPUT_READY_KEY, ready)
+    with tf.control_dependencies([ready]):
+        features = {key : tf.identity(value) for key, value in features.items()}
+        labels = tf.identity(labels)
+    return features, labels
+
+def measure_input_throughput(input_fn, params, num_batches=20):
+    '''
+    Reads batches from an input pipeline alone, without a model
+    :param input_fn: Input function as passed to an Estimator
+    :param params: Parameters for input_fn, with batch_size
+    :param num_batches: Number of timed batches, after one untimed batch
+    :return: Examples per second the input pipeline delivers
+    '''
+    with tf.Graph().as_default():
+        batch = input_fn(params).make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            sess.run(batch)
+            start = time.time()
+            for _ in range(num_batches):
+                sess.run(batch)
+            return num_batches * params["batch_size"] / (time.time() - start)
+
+class InputStallHook(tf.train.SessionRunHook):
+    '''
+    Measures per window of training steps how much time is spent waiting for the input pipeline and how much in the
+    train op, together with examples/s and bytes/s, writes them as summaries and logs a report that names the
+    bottleneck at the end of training.
+    The input wait is measured directly when the model function used mark_input_ready (training on CPU). Otherwise,
+    e.g. with a TPUEstimator that runs many steps per session run, only throughput is measured and the bottleneck is
+    found by comparing it with the throughput of the input pipeline alone (see measure_input_throughput).
+    '''
+
+    def __init__(self, output_dir, batch_size, example_bytes, window=100, input_examples_per_second=None):
+        '''
+        :param output_dir: Folder the summaries are written to
+        :param batch_size: Number of examples per step
+        :param example_bytes: Size of one input example in bytes
+        :param window: Number of steps per summary
+        :param input_examples_per_second: Optional throughput of the input pipeline alone
+        '''
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.example_bytes = example_bytes
+        self.window = window
+        self.input_examples_per_second = input_examples_per_second
+        self.totals = {"steps" : 0, "input_seconds" : 0.0, "compute_seconds" : 0.0}
+        self.window_totals = dict(self.totals)
+
+    def begin(self):
+        ready = tf.get_collection(INPUT_READY_KEY)
+        self.ready = ready[0] if len(ready) > 0 else None
+        self.global_step = tf.train.get_global_step()
+        self.last_step = None
+        self.writer = tf.summary.FileWriterCache.get(self.output_dir)
+
+    def before_run(self, run_context):
+        self.start_time = time.time()
+        fetches = {"global_step" : self.global_step}
+        if self.ready is not None:
+            fetches["ready"] = self.ready
+        return tf.train.SessionRunArgs(fetches)
+
+    def after_run(self, run_context, run_values):
+        end_time = time.time()
+        results = run_values.results
+        num_steps = 1 if self.last_step is None else max(results["global_step"] - self.last_step, 1)
+        self.last_step = results["global_step"]
+        input_seconds = results["ready"] - self.start_time if "ready" in results else 0.0
+        for totals in [self.totals, self.window_totals]:
+            totals["steps"] += num_steps
+            totals["input_seconds"] += input_seconds
+            totals["compute_seconds"] += end_time - self.start_time - input_seconds
+
+        if self.window_totals["steps"] >= self.window:
+            stats = self.get_stats(self.window_totals)
+            summary = tf.Summary(value=[tf.Summary.Value(tag="input/" + name, simple_value=stats[name]) for name in sorted(stats)])
+            self.writer.add_summary(summary, self.last_step)
+            self.window_totals = {"steps" : 0, "input_seconds" : 0.0, "compute_seconds" : 0.0}
+
+    def end(self, session):
+        self.writer.flush()
+        tf.logging.info(self.report())
+
+    def get_stats(self, totals):
+        '''
+        :return: Dictionary with input_fraction, examples_per_second and bytes_per_second over the given totals
+        '''
+        seconds = max(totals["input_seconds"] + totals["compute_seconds"], 1e-12)
+        examples_per_second = totals["steps"] * self.batch_size / seconds
+        return {"input_fraction" : totals["input_seconds"] / seconds,
+                "examples_per_second" : examples_per_second,
+                "bytes_per_second" : examples_per_second * self.example_bytes}
+
+    def get_bottleneck(self):
+        '''
+        :return: "input" if training waits for the input pipeline, "compute" otherwise, None if it can not be told
+        '''
+        stats = self.get_stats(self.totals)
+        if self.ready is not None:
+            return "input" if stats["input_fraction"] > 0.1 else "compute"
+        if self.input_examples_per_second is not None:
+            # The input pipeline can not deliver much more than training consumes
+            return "input" if self.input_examples_per_second < 1.1 * stats["examples_per_second"] else "compute"
+        return None
+
+    def report(self):
+        stats = self.get_stats(self.totals)
+        lines = ["Input analysis over " + str(self.totals["steps"]) + " steps:",
+                 "  examples/s: %.2f, MB/s: %.2f" % (stats["examples_per_second"], stats["bytes_per_second"] / 1e6)]
+        if self.ready is not None:
+            lines.append("  waiting for input: %.1f%% of the step time (%.3f s input, %.3f s compute per step)" %
+                         (100 * stats["input_fraction"], self.totals["input_seconds"] / self.totals["steps"], self.totals["compute_seconds"] / self.totals["steps"]))
+        if self.input_examples_per_second is not None:
+            lines.append("  input pipeline alone: %.2f examples/s" % self.input_examples_per_second)
+        bottleneck = self.get_bottleneck()
+        lines.append("  bottleneck: " + ("unknown" if bottleneck is None else bottleneck))
+        return "\n".join(lines)
@@ -0,0 +1,233 @@
+import numpy as np
+import tensorflow as tf
+
+from Input import urmp_input
+import Models.SeparatorFactory
+from Models.UnetAudioSeparator import conv_layer_name
+import Evaluate
+import Training
+import Utils
+
+def get_input_channels(separator, index, keep, conditional):
+    '''
+    Input channels of a convolution that survive pruning, as indices into its unpruned input
+    :param separator: Unpruned UnetAudioSeparator
+    :param index: Creation index of the convolution, see conv_layer_name. Indices above 2*num_layers are the output convolutions
+    :param keep: List of the kept filter indices of every encoder, bottleneck and decoder convolution
+    :param conditional: Whether the bottleneck is conditioned on source labels, which repeats each bottleneck channel once per source
+    :return: List of input channel indices
+    '''
+    L = separator.num_layers
+    if index == 0:
+        return list(range(separator.num_channels))
+    elif index <= L:
+        return list(keep[index - 1])
+    elif index <= 2 * L:
+        level = 2 * L - index
+        return list(keep[level]) + [separator.get_num_filters(level) + c for c in get_upsampling_channels(separator, index - L - 1, keep, conditional)]
+    else:
+        return list(range(separator.num_channels)) + [separator.num_channels + c for c in keep[2 * L]]
+
+def get_upsampling_channels(separator, i, keep, conditional):
+    '''
+    :return: Kept channels of the feature map that is upsampled in the i-th decoder block
+    '''
+    prev = separator.num_layers + i
+    if i == 0 and conditional:
+        return [f * separator.num_sources + s for f in keep[prev] for s in range(separator.num_sources)]
+    return list(keep[prev])
+
+def get_magnitude_scores(separator, weights):
+    '''
+    Ranks the filters of every encoder, bottleneck and decoder convolution by the L1 norm of their weights
+    :param weights: Dictionary of separator variable values by variable name
+    :return: List of score arrays, one per convolution
+    '''
+    scores = list()
+    for index in range(2 * separator.num_layers + 1):
+        prefix = "separator/" + conv_layer_name(index) + "/"
+        if prefix + "kernel" in weights:
+            kernel = weights[prefix + "kernel"]
+        elif prefix + "pointwise_kernel" in weights:
+            kernel = weights[prefix + "pointwise_kernel"]
+        else:
+            raise ValueError("Layer " + conv_layer_name(index) + " has grouped convolutions, which can not be pruned filter by filter")
+        scores.append(np.sum(np.abs(kernel), axis=(0, 1)))
+    return scores
+
+def get_activation_scores(model_config, separator, sess, mix, activations, audio_list, max_windows=20):
+    '''
+    Ranks the filters of every encoder, bottleneck and decoder convolution by their mean absolute activation on a few tracks,
+    measured where the next layer consumes them
+    :param separator: Separator the graph was built with
+    :param sess: Session with the restored separator
+    :param mix: Input placeholder of the separator
+    :param activations: Dictionary of convolution input tensors by layer name, collected with the conv_input_hook of the separator
+    :param audio_list: Tracks as in Test.test
+    :param max_windows: Maximum number of input windows per track
+    :return: List of score arrays, one per convolution
+    '''
+    stats = {name : tf.reduce_mean(tf.abs(tf.cast(x, tf.float32)), axis=[0, 1]) for name, x in activations.items()}
+    totals = {name : 0.0 for name in stats}
+    num_windows = 0
+
+    input_frames = mix.get_shape().as_list()[1]
+    for sample in audio_list:
+        mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
+        mix_audio = Evaluate.preprocess_mix(model_config, mix_audio, mix_sr)
+        for start in range(0, max(mix_audio.shape[0] - input_frames, 0) + 1, input_frames)[:max_windows]:
+            mix_part = mix_audio[start:start + input_frames]
+            mix_part = np.pad(mix_part, [(0, input_frames - mix_part.shape[0]), (0, 0)], mode="constant")
+            values = sess.run(stats, feed_dict={mix : mix_part[np.newaxis]})
+            for name in totals:
+                totals[name] = totals[name] + values[name]
+            num_windows += 1
+
+    # Locate the channels of each convolution in the input of its consumer
+    L = separator.num_layers
+    scores = list()
+    for index in range(2 * L + 1):
+        num_filters = separator.get_num_filters(index)
+        consumer = totals[conv_layer_name(index + 1)] / float(num_windows)
+        if index < L:
+            offset = 0
+        elif index < 2 * L:
+            offset = separator.get_num_filters(2 * L - index - 1)
+        else:
+            offset = separator.num_channels
+        values = consumer[offset:]
+        if values.shape[0] > num_filters: # Conditioned bottleneck: One copy of each filter per source
+            values = values[:num_filters * separator.num_sources].reshape([num_filters, separator.num_sources]).mean(axis=1)
+        scores.append(values[:num_filters])
+    return scores
+
+def prune(model_config, load_model, output_path, prune_ratio, criterion="magnitude", audio_list=None, conditional=None):
+    '''
+    Removes the least important filters of every encoder, bottleneck and decoder convolution of a trained separator
+    together with the matching input channels of the following layers, the skip connections and the output layer,
+    and writes a slimmer checkpoint
+    :param model_config: Model configuration dictionary (unet network)
+    :param load_model: Checkpoint path
+    :param output_path: Path of the pruned checkpoint
+    :param prune_ratio: Fraction of filters to remove, either one value or a list with one value per convolution (2*num_layers+1)
+    :param criterion: "magnitude" (L1 norm of the filter weights) or "activation" (mean absolute activation on audio_list)
+    :param audio_list: Tracks as in Test.test, needed for the activation criterion
+    :param conditional: Whether the checkpoint belongs to the separator conditioned on source labels. By default as in Training
+    :return: List of filter counts of the pruned network, to be used as model_config["layer_filters"]
+    '''
+    if criterion not in ["magnitude", "activation"]:
+        raise ValueError("Unknown pruning criterion " + str(criterion))
+    if conditional is None:
+        conditional = model_config["network"] == "unet"
+    model_config = dict(model_config)
+    model_config["precision"] = "float32"
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    num_convs = 2 * separator_class.num_layers + 1
+    if not isinstance(prune_ratio, (list, tuple)):
+        prune_ratio = [prune_ratio] * num_convs
+
+    # Restore the unpruned network and collect its weights
+    sep_input_shape, _ = separator_class.get_padding(np.array([1, model_config["num_frames"], 0]))
+    activations = dict()
+    def record_input(input, name):
+        activations[name] = input
+        return input
+    separator_class.conv_input_hook = record_input
+    mix = tf.placeholder(tf.float32, [1, sep_input_shape[1], separator_class.num_channels])
+    if conditional:
+        separator_class.get_output(mix, tf.ones([1, model_config["num_sources"]]), False, reuse=False)
+    else:
+        separator_class.get_output(mix, False, reuse=False)
+
+    sess = tf.Session()
+    separator_vars = tf.global_variables("separator")
+    tf.train.Saver(separator_vars, write_version=tf.train.SaverDef.V2).restore(sess, load_model)
+    weights = {var.op.name : value for var, value in zip(separator_vars, sess.run(separator_vars))}
+
+    if criterion == "magnitude":
+        scores = get_magnitude_scores(separator_class, weights)
+    else:
+        scores = get_activation_scores(model_config, separator_class, sess, mix, activations, audio_list)
+    sess.close()
+    tf.reset_default_graph()
+
+    keep = list()
+    for index in range(num_convs):
+        num_keep = max(1, int(round(separator_class.get_num_filters(index) * (1.0 - prune_ratio[index]))))
+        keep.append(np.sort(np.argsort(-scores[index])[:num_keep]))
+    layer_filters = [len(k) for k in keep]
+
+    # Slice all weights to the kept filters and their inputs
+    pruned = dict()
+    for name, value in weights.items():
+        scope = name.split("/")[1]
+        var_name = name.split("/")[-1]
+        if scope.startswith("interp_"):
+            pruned[name] = value[get_upsampling_channels(separator_class, int(scope.split("_")[1]), keep, conditional)]
+            continue
+        index = 0 if scope == "conv1d" else int(scope.split("_")[1])
+        inputs = get_input_channels(separator_class, index, keep, conditional)
+        outputs = keep[index] if index < num_convs else slice(None)
+        if var_name in ["kernel", "pointwise_kernel"]:
+            pruned[name] = value[:, inputs][:, :, outputs]
+        elif var_name == "depthwise_kernel":
+            pruned[name] = value[:, inputs]
+        else: # Bias
+            pruned[name] = value[outputs]
+
+    # Write the pruned network
+    model_config["layer_filters"] = layer_filters
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    mix = tf.placeholder(tf.float32, [1, sep_input_shape[1], separator_class.num_channels])
+    if conditional:
+        separator_class.get_output(mix, tf.ones([1, model_config["num_sources"]]), False, reuse=False)
+    else:
+        separator_class.get_output(mix, False, reuse=False)
+    tf.train.get_or_create_global_step()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for var in tf.global_variables("separator"):
+            var.load(pruned[var.op.name], sess)
+        tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2).save(sess, output_path)
+    tf.reset_default_graph()
+
+    unpruned_plan = Models.SeparatorFactory.get_separator(dict(model_config, layer_filters=None)).get_plan(model_config["num_frames"])
+    pruned_plan = separator_class.get_plan(model_config["num_frames"])
+    print("Filters per layer: " + str(layer_filters))
+    print("Parameters: " + str(unpruned_plan["params"]) + " -> " + str(pruned_plan["params"]) +
+          ", FLOPs: " + str(unpruned_plan["flops"]) + " -> " + str(pruned_plan["flops"]))
+    return layer_filters
+
+def fine_tune(model_config, load_model, output_path, num_steps=2000, learning_rate=None):
+    '''
+    Short fine-tuning of a pruned separator on the training set to recover the quality lost by pruning
+    :param model_config: Model configuration dictionary, with layer_filters as returned by prune
+    :param load_model: Pruned checkpoint path
+    :param output_path: Path of the fine-tuned checkpoint
+    :param num_steps: Number of training steps
+    :param learning_rate: Learning rate, by default the initial learning rate of the model configuration
+    :return: Mean training loss over the last 100 steps
+    '''
+    model_config = dict(model_config)
+    model_config.update({"use_tpu" : False, "precision" : "float32", "write_audio_summaries" : False})
+    if learning_rate is not None:
+        model_config["init_sup_sep_lr"] = learning_rate
+
+    dataset = urmp_input.URMPInput(mode="train", data_dir=model_config["data_path"], precision=model_config["precision"])
+    features, labels = dataset.input_fn(model_config).make_one_shot_iterator().get_next()
+    tf.train.get_or_create_global_step()
+    spec = Training.unet_separator(features, labels, tf.estimator.ModeKeys.TRAIN, model_config)
+
+    losses = list()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # Only the weights: the pruned checkpoint has no optimizer slots, moving averages or accumulators, which start fresh
+        tf.train.Saver(tf.trainable_variables("separator"), write_version=tf.train.SaverDef.V2).restore(sess, load_model)
+        for step in range(num_steps):
+            _, loss = sess.run([spec.train_op, spec.loss])
+            losses.append(loss)
+            if step % 100 == 0:
+                print("Fine-tuning step " + str(step) + ", loss " + str(np.mean(losses[-100:])))
+        tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2).save(sess, output_path)
+    tf.reset_default_graph()
+    return float(np.mean(losses[-100:]))
@@ -0,0 +1,236 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from Input import Input as Input
+import Models.SeparatorFactory
+from Models import NumpyUnetAudioSeparator
+import Benchmark
+import Evaluate
+import Export
+import Utils
+
+KERNEL_NAMES = ["kernel", "depthwise_kernel", "pointwise_kernel"]
+RANGE_PREFIX = "activation_range/"
+
+def quantize_kernel(kernel, channel_axis=-1):
+    '''
+    Symmetric per-channel int8 quantization of a convolution kernel
+    :param kernel: Float kernel as numpy array
+    :param channel_axis: Axis with one scale per entry, the output channels (input channels for depthwise kernels)
+    :return: int8 kernel and float32 scales, so that kernel ~ q * scale (scale broadcast along channel_axis)
+    '''
+    reduce_axes = tuple([a for a in range(kernel.ndim) if a != channel_axis % kernel.ndim])
+    scale = np.max(np.abs(kernel), axis=reduce_axes, keepdims=True) / 127.0
+    scale = np.maximum(scale, 1e-12).astype(np.float32)
+    q = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+def get_labels(model_config, mix_context, conditional):
+    '''
+    :return: Labels input [batch_size, num_sources] of a conditional separator, all sources unless fed, or None
+    '''
+    if not conditional:
+        return None
+    return tf.placeholder_with_default(tf.ones(tf.stack([tf.shape(mix_context)[0], model_config["num_sources"]])),
+                                       [None, model_config["num_sources"]], name="labels")
+
+def quantize_checkpoint(model_config, load_model, audio_list, output_path, conditional=None):
+    '''
+    Quantizes all convolution kernels of a trained separator checkpoint to int8 with one scale per output channel, and
+    calibrates the range of the input of every convolution on a few tracks
+    :param model_config: Model configuration dictionary (unet network)
+    :param load_model: Checkpoint path
+    :param audio_list: Calibration tracks as in Test.test
+    :param output_path: Path of the .npz file the quantized model is written to
+    :param conditional: Whether the separator is conditioned on source labels, by default as Training.py trains the unet network. Calibrated with all sources present
+    :return: Dictionary with all arrays written to output_path
+    '''
+    if conditional is None:
+        conditional = model_config["network"] == "unet"
+    model_config = dict(model_config)
+    model_config.update({"precision" : "float32", "channels_as_batch" : False})
+    disc_input_shape = [1, model_config["num_frames"], 0]
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
+    pad_front = Evaluate.get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
+
+    # Track the largest absolute value seen at the input of each convolution. Local variables, so they are not part of the separator checkpoint
+    ranges = dict()
+    def record_range(input, name):
+        ranges[name] = tf.Variable(0.0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="range_" + name)
+        ranges[name + "_update"] = tf.assign(ranges[name], tf.maximum(ranges[name], tf.reduce_max(tf.abs(input))))
+        return input
+    separator_class.conv_input_hook = record_range
+
+    mix_context, _ = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+    if conditional:
+        separator_sources = separator_class.get_output(mix_context, get_labels(model_config, mix_context, conditional), False, reuse=False)
+    else:
+        separator_sources = separator_class.get_output(mix_context, False, reuse=False)
+    layer_names = [name for name in ranges.keys() if not name.endswith("_update")]
+
+    sess = tf.Session()
+    sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+    restorer = tf.train.Saver(tf.global_variables("separator"), write_version=tf.train.SaverDef.V2)
+    restorer.restore(sess, load_model)
+
+    # predict_track only uses the first num_sources fetches, so the range updates can run alongside
+    fetches = separator_sources + [ranges[name + "_update"] for name in layer_names]
+    for sample in audio_list:
+        mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
+        Evaluate.predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, fetches, mix_context, pad_front)
+
+    arrays = dict()
+    for name in layer_names:
+        arrays[RANGE_PREFIX + name] = np.float32(sess.run(ranges[name]))
+    for var in tf.global_variables("separator"):
+        name = var.op.name
+        value = sess.run(var)
+        if name.split("/")[-1] in KERNEL_NAMES:
+            q, scale = quantize_kernel(value, -2 if name.endswith("depthwise_kernel") else -1)
+            arrays[name + "/q"] = q
+            arrays[name + "/scale"] = scale
+        else:
+            arrays[name] = value.astype(np.float32)
+
+    sess.close()
+    tf.reset_default_graph()
+
+    np.savez(output_path, **arrays)
+    return arrays
+
+def get_model_bytes(arrays, quantize_activations=True):
+    '''
+    :param quantize_activations: Whether to count the calibrated activation ranges, which are only needed if activations are quantized
+    :return: Size of the int8 kernels, their scales and all other weights of a quantized model in bytes, as stored by an int8 runtime
+    '''
+    return int(sum([value.nbytes for name, value in arrays.items() if quantize_activations or not name.startswith(RANGE_PREFIX)]))
+
+def load_simulated_quantized_separator(model_config, quantized_path, quantize_activations=True, conditional=None):
+    '''
+    Builds the separator for single-example inference from a quantized model written by quantize_checkpoint, simulating
+    int8 inference to measure its quality: int8 weights are dequantized to float32 inside the graph and activations are
+    rounded to 8 bit within their calibrated range, but all computation stays in float32 and is not faster than the float32 model
+    :param model_config: Model configuration dictionary
+    :param quantized_path: Path of the .npz file written by quantize_checkpoint
+    :param quantize_activations: Whether to also quantize the input of every convolution, otherwise only weights are quantized
+    :param conditional: Whether the separator is conditioned on source labels, by default for the unet network
+    :return: Dictionary as returned by Benchmark.load_separator, with the int8 model size (see get_model_bytes) as model_bytes
+    '''
+    if conditional is None:
+        conditional = model_config["network"] == "unet"
+    arrays = dict(np.load(quantized_path))
+    disc_input_shape = [1, model_config["num_frames"], 0]
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
+    pad_front = Evaluate.get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
+
+    def quantized_getter(getter, name, *args, **kwargs):
+        if name + "/q" in arrays:
+            return tf.cast(tf.constant(arrays[name + "/q"]), tf.float32) * tf.constant(arrays[name + "/scale"])
+        elif name in arrays:
+            return tf.constant(arrays[name])
+        return getter(name, *args, **kwargs)
+
+    def quantize_input(input, name):
+        input_range = float(arrays[RANGE_PREFIX + name])
+        return tf.fake_quant_with_min_max_args(input, min=-input_range, max=input_range, num_bits=8, narrow_range=True)
+    if quantize_activations:
+        separator_class.conv_input_hook = quantize_input
+
+    mix_context, _ = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
+    labels = get_labels(model_config, mix_context, conditional)
+    with tf.variable_scope(tf.get_variable_scope(), custom_getter=quantized_getter):
+        if conditional:
+            separator_sources = separator_class.get_output(mix_context, labels, False, reuse=False)
+        else:
+            separator_sources = separator_class.get_output(mix_context, False, reuse=False)
+
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    model = {"sess" : sess, "separator" : separator_class, "input_shape" : sep_input_shape, "output_shape" : sep_output_shape,
+             "pad_front" : pad_front, "sources" : separator_sources, "mix" : mix_context, "model_bytes" : get_model_bytes(arrays, quantize_activations)}
+    if conditional:
+        model["labels"] = labels
+    return model
+
+def export_int8(model_config, load_model, quantized_path, output_dir, conditional=None):
+    '''
+    Exports a checkpoint for the NumPy inference engine (see Export.export_numpy) together with its int8 quantization,
+    so the engine can run the same model in float32 or with int8 convolutions (NumpyUnetAudioSeparator with int8=True)
+    :param model_config: Model configuration dictionary (unet network with dense convolutions)
+    :param load_model: Checkpoint path
+    :param quantized_path: Path of the .npz file written by quantize_checkpoint for this checkpoint
+    :param output_dir: Folder to write the exported model to
+    :param conditional: Whether the separator is conditioned on source labels, by default for the unet network
+    '''
+    if conditional is None:
+        conditional = model_config["network"] == "unet"
+    Export.export_numpy(model_config, load_model, output_dir, conditional)
+    with open(os.path.join(output_dir, NumpyUnetAudioSeparator.CONFIG_FILE)) as f:
+        config = json.load(f)
+
+    arrays = np.load(quantized_path)
+    conv_names = NumpyUnetAudioSeparator.get_conv_names(config)
+    first_output = 2 * config["num_layers"] + 1
+    for index, name in enumerate(conv_names):
+        kernel = "separator/" + name + "/kernel"
+        np.save(NumpyUnetAudioSeparator.weight_file(output_dir, name + "/kernel_q"), arrays[kernel + "/q"])
+        np.save(NumpyUnetAudioSeparator.weight_file(output_dir, name + "/kernel_scale"), arrays[kernel + "/scale"].reshape([-1]))
+        # All output convolutions share one input, calibrated under the name of the first
+        range_name = RANGE_PREFIX + (name if index < first_output else conv_names[first_output])
+        np.save(NumpyUnetAudioSeparator.weight_file(output_dir, name + "/input_range"), arrays[range_name])
+
+def quantization_report(model_config, load_model, quantized_path, audio_list, export_dir=None):
+    '''
+    Compares model size, separation quality and speed of the float32 checkpoint and its int8 quantization on a held-out set.
+    Quality of the int8 models in Tensorflow is simulated in float32 (see load_simulated_quantized_separator), so their
+    speed is not that of int8 arithmetic. With an export_dir, the NumPy inference engine runs the same model once in
+    float32 and once with int8 convolutions, which measures the speed of int8 arithmetic against float32 in one runtime
+    :param model_config: Model configuration dictionary
+    :param load_model: Float32 checkpoint path
+    :param quantized_path: Path of the .npz file written by quantize_checkpoint for this checkpoint
+    :param audio_list: Held-out tracks as in Test.test, not used for calibration
+    :param export_dir: Optional folder to export the model to with export_int8, for the NumPy engine (unet network with dense convolutions)
+    :return: List of result dictionaries for float32, simulated int8 weights only and simulated int8 weights and
+             activations, and the NumPy engine in float32 and int8 if export_dir is given
+    '''
+    model_config = dict(model_config)
+    model_config["precision"] = "float32"
+    results = list()
+
+    model = Benchmark.load_separator(model_config, load_model)
+    model["model_bytes"] = int(sum([np.prod(var.get_shape().as_list()) * 4 for var in tf.global_variables("separator")]))
+    reference = {"model" : "float32", "model_bytes" : model["model_bytes"]}
+    reference.update(Benchmark.evaluate_separator(model_config, model, audio_list))
+    results.append(reference)
+    model["sess"].close()
+    tf.reset_default_graph()
+
+    arrays = dict(np.load(quantized_path))
+    for name, quantize_activations in [("int8_weights_simulated", False), ("int8_simulated", True)]:
+        model = load_simulated_quantized_separator(model_config, quantized_path, quantize_activations)
+        result = {"model" : name, "model_bytes" : model["model_bytes"]}
+        result.update(Benchmark.evaluate_separator(model_config, model, audio_list))
+        results.append(result)
+        model["sess"].close()
+        tf.reset_default_graph()
+
+    if export_dir is not None:
+        export_int8(model_config, load_model, quantized_path, export_dir)
+        for name, int8 in [("numpy_float32", False), ("numpy_int8", True)]:
+            engine = NumpyUnetAudioSeparator.NumpyUnetAudioSeparator(export_dir, int8=int8)
+            result = {"model" : name, "model_bytes" : get_model_bytes(arrays) if int8 else reference["model_bytes"]}
+            result.update(Benchmark.evaluate_separator(model_config, {"engine" : engine}, audio_list))
+            results.append(result)
+
+    for result in results:
+        result.update({"size_ratio" : result["model_bytes"] / float(reference["model_bytes"]),
+                       "snr_diff" : result["snr"] - reference["snr"],
+                       "sdr_diff" : result["sdr"] - reference["sdr"]})
+
+    Benchmark.print_table(results, ["model_bytes", "size_ratio", "snr", "snr_diff", "sdr", "sdr_diff", "mse", "seconds_per_audio_second"])
+    return results
@@ -0,0 +1,216 @@
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import Benchmark
+
+def grid(space):
+    '''
+    :param space: Dictionary with a list of values for every swept model_config key
+    :return: List of model_config updates, one per combination of values
+    '''
+    keys = sorted(space.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+
+def random_search(space, num_trials, seed=0):
+    '''
+    :param space: Dictionary by swept model_config key with either a list of values to choose from, or a (low, high)
+                  tuple to sample uniformly from (integers if both bounds are integers)
+    :param num_trials: Number of sampled configurations
+    :return: List of model_config updates
+    '''
+    rng = np.random.RandomState(seed)
+    trials = list()
+    for _ in range(num_trials):
+        trial = dict()
+        for key in sorted(space.keys()):
+            values = space[key]
+            if isinstance(values, tuple):
+                low, high = values
+                trial[key] = int(rng.randint(low, high + 1)) if isinstance(low, int) and isinstance(high, int) else float(rng.uniform(low, high))
+            else:
+                trial[key] = values[rng.randint(len(values))]
+        trials.append(trial)
+    return trials
+
+def get_trial_name(trial):
+    return ",".join([key + "=" + str(trial[key]) for key in sorted(trial.keys())])
+
+def read_metrics(model_dir):
+    '''
+    :return: Evaluation results written by Training.EvaluationThread into a model folder, oldest first
+    '''
+    path = os.path.join(model_dir, "metrics.json")
+    if not tf.gfile.Exists(path):
+        return list()
+    try:
+        with tf.gfile.GFile(path) as f:
+            return json.load(f)
+    except ValueError: # Read while being written
+        return list()
+
+class Trial:
+    '''
+    One training run of a sweep in its own process, on the CPU of this machine
+    '''
+
+    def __init__(self, trial_id, config, base_dir, named_configs, num_threads):
+        base_dir = os.path.abspath(base_dir) # Training.py runs in the repository folder
+        self.trial_id = trial_id
+        self.config = config
+        self.model_dir = os.path.join(base_dir, str(trial_id))
+        self.num_threads = num_threads
+        self.metrics = list()
+        self.stopped_early = False
+        self.start_time = None
+        self.end_time = None
+
+        settings = dict(config)
+        # Without checkpoint_on_preemption, a stopped trial exits on SIGTERM right away instead of writing a final checkpoint
+        settings.update({"use_tpu" : False, "precision" : "float32", "concurrent_evaluation" : True, "checkpoint_on_preemption" : False, "model_base_dir" : base_dir,
+                         "experiment_id" : trial_id, "cpu_intra_op_threads" : num_threads, "cpu_inter_op_threads" : min(2, num_threads)})
+        self.command = [sys.executable, "Training.py", "with"] + list(named_configs) + \
+                       ["model_config." + key + "=" + repr(value) for key, value in sorted(settings.items())]
+        self.process = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.log = open(self.model_dir + ".log", "w")
+        self.process = subprocess.Popen(self.command, stdout=self.log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def poll(self):
+        '''
+        Reads new evaluation results of the trial
+        :return: Whether the process is still running
+        '''
+        self.metrics = read_metrics(self.model_dir)
+        running = self.process.poll() is None
+        if not running and self.end_time is None:
+            self.end_time = time.time()
+            self.log.close()
+        return running
+
+    def stop(self):
+        '''
+        Terminates the trial without waiting for the process to exit, so the sweep can go on scheduling
+        '''
+        self.stopped_early = True
+        self.process.terminate()
+        self.end_time = time.time()
+        self.log.close()
+
+    def get_loss_at(self, step):
+        '''
+        :return: Evaluation loss of the first evaluation at or after a step, None if the trial has not got there yet
+        '''
+        for metrics in self.metrics:
+            if metrics["step"] >= step:
+                return metrics["loss"]
+        return None
+
+    def get_result(self):
+        seconds = (self.end_time or time.time()) - self.start_time
+        losses = [metrics["loss"] for metrics in self.metrics]
+        return {"model" : get_trial_name(self.config),
+                "steps" : self.metrics[-1]["step"] if len(self.metrics) > 0 else 0,
+                "eval_loss" : self.metrics[-1]["loss"] if len(losses) > 0 else float("nan"),
+                "best_eval_loss" : min(losses) if len(losses) > 0 else float("nan"),
+                "stopped_early" : self.stopped_early,
+                "seconds" : seconds,
+                "core_hours" : seconds * self.num_threads / 3600.0}
+
+def run_sweep(trials, base_dir, named_configs=(), max_parallel=None, threads_per_trial=None, min_steps=2000, reduction_factor=3, poll_secs=30):
+    '''
+    Trains one separator per configuration in parallel processes and stops underperforming trials early with
+    asynchronous successive halving (ASHA): at every rung (min_steps * reduction_factor^k steps) a trial only continues if its
+    evaluation loss is among the best 1/reduction_factor of all trials that have reached that rung so far
+    :param trials: List of model_config updates, e.g. from grid or random_search. Trials train for model_config["training_steps"] unless set here
+    :param base_dir: Folder for the model folders (by trial index) and logs of all trials
+    :param named_configs: Named configurations of Training.py applied to every trial
+    :param max_parallel: Number of trials running at the same time, by default as many as fit with threads_per_trial cores each
+    :param threads_per_trial: Cores per trial, by default 4 or all cores if fewer
+    :param min_steps: Training steps at the first rung
+    :param reduction_factor: Fraction of trials that continue at every rung is 1/reduction_factor
+    :param poll_secs: Seconds between checks of the evaluation results of all running trials
+    :return: List of result dictionaries, one per trial
+    '''
+    num_cores = multiprocessing.cpu_count()
+    if threads_per_trial is None:
+        threads_per_trial = min(4, num_cores)
+    if max_parallel is None:
+        max_parallel = max(1, num_cores // threads_per_trial)
+    if not tf.gfile.Exists(base_dir):
+        tf.gfile.MakeDirs(base_dir)
+
+    pending = [Trial(trial_id, config, base_dir, named_configs, threads_per_trial) for trial_id, config in enumerate(trials)]
+    all_trials = list(pending)
+    running = list()
+    rung_losses = dict() # Losses of all trials that reached a rung, by rung step
+    checked = set() # (trial id, rung step) pairs already decided
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < max_parallel:
+            trial = pending.pop(0)
+            trial.start()
+            running.append(trial)
+            print("Started trial " + str(trial.trial_id) + ": " + get_trial_name(trial.config))
+        time.sleep(poll_secs)
+
+        for trial in list(running):
+            if not trial.poll():
+                running.remove(trial)
+                print("Finished trial " + str(trial.trial_id))
+                continue
+            if len(trial.metrics) > 0:
+                print("Trial " + str(trial.trial_id) + " step " + str(trial.metrics[-1]["step"]) + ": eval loss " + str(trial.metrics[-1]["loss"]))
+
+            rung = min_steps
+            while trial.get_loss_at(rung) is not None:
+                if (trial.trial_id, rung) not in checked:
+                    checked.add((trial.trial_id, rung))
+                    losses = rung_losses.setdefault(rung, list())
+                    losses.append(trial.get_loss_at(rung))
+                    num_promoted = len(losses) // reduction_factor
+                    if len(losses) >= reduction_factor and trial.get_loss_at(rung) > sorted(losses)[num_promoted - 1]:
+                        print("Stopping trial " + str(trial.trial_id) + " at rung " + str(rung))
+                        trial.stop()
+                        running.remove(trial)
+                        break
+                rung *= reduction_factor
+
+    for trial in all_trials:
+        trial.process.wait() # Reap stopped trials
+    results = [trial.get_result() for trial in all_trials]
+    results.sort(key=lambda result: (np.isnan(result["best_eval_loss"]), result["best_eval_loss"]))
+    Benchmark.print_table(results, ["steps", "eval_loss", "best_eval_loss", "stopped_early", "seconds", "core_hours"])
+    return results
+
+def time_to_target(runs, target_loss):
+    '''
+    Compares how long training runs need to reach a validation loss, e.g. a segment-length curriculum against the
+    fixed-length baseline. Needs runs trained with concurrent evaluation
+    :param runs: List of (name, model folder) tuples
+    :param target_loss: Evaluation loss to reach
+    :return: List of result dictionaries, one per run
+    '''
+    results = list()
+    for name, model_dir in runs:
+        metrics = read_metrics(model_dir)
+        reached = [m for m in metrics if m["loss"] <= target_loss]
+        results.append({"model" : name,
+                        "step" : reached[0]["step"] if len(reached) > 0 else None,
+                        "seconds" : reached[0]["seconds"] if len(reached) > 0 else float("nan"),
+                        "best_eval_loss" : min([m["loss"] for m in metrics]) if len(metrics) > 0 else float("nan")})
+    for result in results:
+        # None if the baseline or the run never reached the target, or reached it at once
+        reached_both = np.isfinite(results[0]["seconds"]) and np.isfinite(result["seconds"]) and result["seconds"] > 0
+        result["speedup"] = results[0]["seconds"] / result["seconds"] if reached_both else None
+    Benchmark.print_table(results, ["step", "seconds", "speedup", "best_eval_loss"])
+    return results
@@ -3,7 +3,7 @@ import numpy as np
 import os
 
 from Input import Input as Input
-import Models.UnetAudioSeparator
+import Models.SeparatorFactory
 import Evaluate
 import Utils
 import functools
@@ -14,24 +14,18 @@ import librosa
 def test(model_config, audio_list, model_folder, load_model):
     # Determine input and output shapes
     disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]  # Shape of discriminator input
-    separator_class = Models.UnetAudioSeparator.UnetAudioSeparator(model_config["num_layers"], model_config["num_initial_filters"],
-                                                                   output_type=model_config["output_type"],
-                                                                   context=model_config["context"],
-                                                                   mono=model_config["mono_downmix"],
-                                                                   upsampling=model_config["upsampling"],
-                                                                   num_sources=model_config["num_sources"],
-                                                                   filter_size=model_config["filter_size"],
-                                                                   merge_filter_size=model_config["merge_filter_size"])
+    separator_class = Models.SeparatorFactory.get_separator(model_config)
 
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
     separator_func = separator_class.get_output
 
     # Creating the batch generators
-    assert ((sep_input_shape[1] - sep_output_shape[1]) % 2 == 0)
+    assert (model_config["network"] != "unet" or (sep_input_shape[1] - sep_output_shape[1]) % 2 == 0)
+    pad_front = Evaluate.get_front_padding(model_config, separator_class, sep_input_shape, sep_output_shape)
 
-    # Batch size of 1
-    sep_input_shape[0] = 1
-    sep_output_shape[0] = 1
+    # Batch size of 1, or one batch entry per channel
+    sep_input_shape[0] = Evaluate.get_inference_batch_size(model_config)
+    sep_output_shape[0] = Evaluate.get_inference_batch_size(model_config)
 
     mix_context, sources = Input.get_multitrack_placeholders(sep_output_shape, model_config["num_sources"], sep_input_shape, "input")
 
@@ -39,12 +33,12 @@ def test(model_config, audio_list, model_folder, load_model):
 
     # BUILD MODELS
     # Separator
-    separator_sources = separator_func(mix_context, False, False, reuse=False)
+    separator_sources = Utils.get_output_with_precision(separator_func, model_config["precision"], mix_context, False, False, reuse=False)
 
     global_step = tf.get_variable('global_step', [], initializer=tf.constant_initializer(0), trainable=False, dtype=tf.int64)
 
     # Start session and queue input threads
-    sess = tf.Session()
+    sess = tf.Session(config=Utils.get_session_config(model_config["xla_inference"]))
     sess.run(tf.global_variables_initializer())
     writer = tf.summary.FileWriter(model_config["log_dir"] + os.path.sep +  model_folder, graph=sess.graph)
 
@@ -70,12 +64,12 @@ def test(model_config, audio_list, model_folder, load_model):
     for sample in audio_list: # Go through all tracks
         # Load mixture and fetch prediction for mixture
         mix_audio, mix_sr = Utils.load(sample[0].path, sr=None, mono=False)
-        sources_pred = Evaluate.predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context)
+        sources_pred = Evaluate.predict_track(model_config, sess, mix_audio, mix_sr, sep_input_shape, sep_output_shape, separator_sources, mix_context, pad_front)
 
         # Load original sources
         sources_gt = list()
         for s in sample[1:]:
-            s_audio, _ = Utils.load(s.path, sr=model_config["expected_sr"], mono=model_config["mono_downmix"], res_type="kaiser_fast")
+            s_audio, _ = Utils.load(s.path, sr=model_config["expected_sr"], mono=model_config["mono_downmix"] and not model_config["channels_as_batch"], res_type="kaiser_fast")
             sources_gt.append(s_audio)
 
         # Determine mean squared error
@@ -1,20 +1,24 @@
 from sacred import Experiment
 import tensorflow as tf
 import numpy as np
+import json
 import os
+import threading
+import time
 
 from Input import urmp_input
+from Input import musdb_input
 import Utils
 import Test
-import Models.UnetAudioSeparator
-import Models.ConditionalUnetAudioSeparator
+import Checkpointing
+import Profiling
+import Models.SeparatorFactory
 
 from tensorflow.contrib.cluster_resolver import TPUClusterResolver
 from tensorflow.contrib import summary
 from tensorflow.contrib.tpu.python.tpu import tpu_config
 from tensorflow.contrib.tpu.python.tpu import tpu_estimator
 from tensorflow.contrib.tpu.python.tpu import tpu_optimizer
-from tensorflow.contrib.tpu.python.tpu import bfloat16
 from tensorflow.python.estimator import estimator
 
 ex = Experiment('Conditioned-Waveunet')
@@ -29,12 +33,36 @@ def cfg():
                     "epoch_it": 2000, # Number of supervised separator steps per epoch
                     "training_steps": 2000*100, # Number of training steps per training
                     "evaluation_steps": 1000,
-                    "use_tpu": True,
-                    "use_bfloat16": True,
+                    "local_checkpoint_dir": None, # For training on CPU: Local folder for checkpoints and summaries, mirrored to the model folder in model_base_dir by a background uploader. None writes to the model folder directly
+                    "remote_keep_checkpoints": 10, # For local checkpoints: Number of newest checkpoints kept in the model folder (None = all)
+                    "weight_averaging": None, # None, 'ema' to track an exponential moving average of the weights, or 'last_n' to average the last checkpoints. With local checkpoints, the averaged model is uploaded to the "average" subfolder
+                    "ema_decay": 0.999, # For weight_averaging 'ema': Decay of the moving average per optimizer step
+                    "average_checkpoints": 5, # For weight_averaging 'last_n': Number of averaged checkpoints, at most the 5 checkpoints kept in the model folder
+                    "input_stall_analysis": False, # Whether to measure how much of the training time is spent waiting for input, with summaries and a report at the end of training
+                    "input_stall_window": 100, # For input stall analysis: Number of steps per summary
+                    "curriculum": None, # Optional segment-length curriculum for the unet network: List of [start step, num_frames] pairs, e.g. [[0, 4096], [20000, 8192], [60000, 16384]]. Training steps of each phase use shorter input and output excerpts
+                    "warm_start_checkpoint": None, # Checkpoint of a separator with the same encoder and decoder, possibly trained on another dataset with another number of sources, to start training from
+                    "warm_start_source_map": None, # For warm start: For every source, the index of the checkpoint source whose output layer it starts from, or None to start from scratch. By default the first checkpoint sources in order
+                    "gradient_accumulation_steps": 1, # Number of micro-batches of batch_size whose gradients are averaged per optimizer step. The global step and training_steps count micro-batches
+                    "resumable_input": False, # For training on CPU: Save the state of the training input iterator with every checkpoint, so a restarted run continues the same example order
+                    "input_seed": None, # Seed of the training file order and example shuffling. None = different in every run, or for resumable input derived from experiment_id, so a restarted run keeps its order
+                    "shuffle_buffer_size": 1024, # Number of training examples in the shuffle buffer (at most 64 for resumable input, which saves the buffer with every checkpoint)
+                    "checkpoint_on_preemption": True, # Whether to stop training and write a final checkpoint when the process receives SIGTERM
+                    "concurrent_evaluation": False, # Whether to evaluate every new checkpoint on the CPU while training continues, with results in metrics.json of the model folder
+                    "concurrent_evaluation_steps": 50, # For concurrent evaluation: Number of evaluation batches per checkpoint
+                    "early_stopping_patience": None, # For concurrent evaluation: Stop training after this many evaluations without improvement of the evaluation loss (None = never)
+                    "early_stopping_min_delta": 0.0, # For concurrent evaluation: Smallest decrease of the evaluation loss that counts as an improvement
+                    "use_tpu": True, # If False, train with an Estimator on the CPUs of this machine
+                    "cpu_intra_op_threads": 0, # For training on CPU: Threads per op (0 = all cores)
+                    "cpu_inter_op_threads": 2, # For training on CPU: Ops run concurrently (0 = all cores)
+                    "precision": "bfloat16", # Precision policy of input pipeline and separator activations: 'float32', 'float16' or 'bfloat16' (only on the TPU). Weights, loss and summaries are always float32
+                    "loss_scale": "dynamic", # For float16 precision: Fixed loss scaling factor, or 'dynamic' to adapt it to gradient overflows
                     "load_model": True,
                     "predict_only": False,
                     "write_audio_summaries": False,
                     "audio_summaries_every_n_steps": 10000,
+                    "audio_summary_examples": 4, # Number of evaluation examples in the audio summaries
+                    "summary_window": 100, # Training metrics are accumulated on the device and written to the summaries once every this many steps
                     "decay_steps": 2000,
                     "decay_rate": 0.96,
                     'num_layers': 12, # How many U-Net layers
@@ -46,11 +74,34 @@ def cfg():
                     'mono_downmix': True,  # Whether to downsample the audio input
                     'output_type': 'direct', # Type of output layer, either "direct" or "difference". Direct output: Each source is result of tanh activation and independent. DIfference: Last source output is equal to mixture input - sum(all other sources)
                     'context': False, # Type of padding for convolutions in separator. If False, feature maps double or half in dimensions after each convolution, and convolutions are padded with zeros ("same" padding). If True, convolution is only performed on the available mixture input, thus the output is smaller than the input
-                    'network': 'unet', # Type of network architecture, either unet (our model) or unet_spectrogram (Jansson et al 2017 model)
+                    'network': 'unet', # Type of network architecture, either unet (our model), causal_unet (low-latency causal variant) or unet_spectrogram (Jansson et al 2017 model)
+                    'latency_ms': 20, # For causal_unet: Future context (algorithmic latency) in milliseconds available to estimate each output sample
+                    'causal_filter_size': 3, # For causal_unet: Filter size of each dilated causal conv in the downsampling blocks
+                    'causal_dilations': [1, 2, 4], # For causal_unet: Dilation factors of the causal conv stack in each downsampling block. The past context of the network has to fit in the mixture excerpts of the records (see the causal config)
                     'upsampling': 'linear', # Type of technique used for upsampling the feature maps in a unet architecture, either 'linear' interpolation or 'learned' filling in of extra samples
                     'task': 'voice', # Type of separation task. 'voice' : Separate music into voice and accompaniment. 'multi_instrument': Separate music into guitar, bass, vocals, drums and other (Sisec)
                     'augmentation': True, # Random attenuation of source signals to improve generalisation performance (data augmentation)
                     'raw_audio_loss': True, # Only active for unet_spectrogram network. True: L2 loss on audio. False: L1 loss on spectrogram magnitudes for training and validation and test loss
+                    'polymorphic_inference': False, # Whether to build the inference graph with unknown batch size and input length, so whole tracks are separated in a few calls (only unet network)
+                    'inference_max_frames': 2**20, # For polymorphic inference: Maximum number of output samples per call
+                    'xla_inference': False, # Whether to JIT-compile the separator with XLA for inference on CPU
+                    'channels_as_batch': False, # For inference with mono models: Separate each channel of multichannel mixtures as one entry of a batch instead of downmixing, to get multichannel estimates
+                    'recompute_levels': [], # For Wave-U-Net: Levels (0 = full sample rate) whose encoder block and skip connection are recomputed in the backward pass instead of stored
+                    'recompute_decoder_levels': [], # For Wave-U-Net: Levels whose decoder block is recomputed in the backward pass
+                    'conv_type': 'dense', # For Wave-U-Net: Convolutions in the encoder and decoder blocks, either 'dense', 'separable' (depthwise + pointwise) or 'grouped'
+                    'conv_groups': 4, # For Wave-U-Net with grouped convolutions: Number of channel groups
+                    'layer_filters': None, # For Wave-U-Net: Optional list of filter counts of all encoder, bottleneck and decoder convolutions (e.g. written by Prune.py), overrides num_initial_filters
+                    'distillation': False, # Whether to train the separator (student) to also match the source estimates of a frozen teacher separator
+                    'teacher_checkpoint': None, # For distillation: Checkpoint of the teacher
+                    'teacher_config': {'num_layers': 12, 'num_initial_filters': 24}, # For distillation: Entries of model_config that differ for the teacher
+                    'teacher_cache': None, # For distillation: Folder with training records that include precomputed teacher estimates (see Distill.py). If None, the teacher runs in the training graph
+                    'distillation_weight': 0.5, # For distillation: Weight of the teacher estimates in the loss, the ground truth sources get the remaining weight
+                    'multi_head': False, # Whether to train the multi-head separator (Models/MultiHeadUnetAudioSeparator.py) with a shared encoder jointly on the datasets of all heads
+                    'heads': [['musdb', 4, True], ['urmp', 13, True]], # For the multi-head separator: Name, number of sources and conditioning of each dataset-specific decoder
+                    'head_data_paths': {'musdb': 'gs://vimsstfrecords/', 'urmp': 'gs://vimsstfrecords/urmp-labels'}, # For the multi-head separator: Records of each head. The first sources stored in a record are the sources of the head. The 'musdb' head reads MusDB records, all others URMP records
+                    'head_loss_weights': None, # For the multi-head separator: Optional dictionary of loss weights by head name, 1 by default
+                    'encoder_checkpoint': None, # For the multi-head separator: Single-head checkpoint to start the shared encoder from
+                    'head_checkpoints': {}, # For the multi-head separator: Single-head checkpoint by head name to start the decoder of the head from
                     'experiment_id': np.random.randint(0,1000000)
                     }
 
@@ -114,6 +165,36 @@ def musdb():
         "task": "multi_instrument"
     }
 
+@ex.named_config
+def causal():
+    print("Training low-latency causal separator with URMP dataset")
+    model_config = {
+        "dataset_name": "urmp",
+        "data_path": "gs://vimsstfrecords/urmp-labels",
+        "estimates_path": "estimates",
+        "model_base_dir": "gs://vimsscheckpoints", # Base folder for model checkpoints
+        "network": "causal_unet",
+        "num_layers": 10, # With causal_dilations [1, 2, 4], the past context of 34796 samples fits in front of the stored source excerpts
+        "output_type": "difference",
+        "mono_downmix": True,
+        "task": "multi_instrument"
+    }
+
+@ex.named_config
+def separable():
+    print("Training Wave-U-Net with depthwise-separable convolutions")
+    model_config = {
+        "conv_type": "separable"
+    }
+
+@ex.named_config
+def grouped():
+    print("Training Wave-U-Net with grouped convolutions")
+    model_config = {
+        "conv_type": "grouped",
+        "conv_groups": 4
+    }
+
 @ex.named_config
 def baseline_comparison():
     model_config = {
@@ -127,14 +208,272 @@ def baseline_comparison():
         "num_initial_filters" : 34
     }
 
+@ex.named_config
+def multi_head():
+    print("Training a multi-head separator jointly on MusDB and URMP")
+    model_config = {
+        "multi_head": True,
+        "estimates_path": "estimates",
+        "model_base_dir": "gs://vimsscheckpoints", # Base folder for model checkpoints
+        "output_type": "difference",
+        "context": True,
+        "upsampling": "linear",
+        "mono_downmix": True,
+        "task": "multi_instrument"
+    }
+
+@ex.named_config
+def distill():
+    print("Training a small separator by distillation from a large teacher")
+    model_config = {
+        "distillation": True,
+        "num_layers": 8,
+        "num_initial_filters": 16
+    }
+
+def align_sources(sources, front, length):
+    '''
+    Pads or crops source excerpts [batch_size, num_sources, num_samples, num_channels] along time so that they line up with a separator output
+    :param front: Number of output samples before the first source sample (negative if the output starts later)
+    :param length: Number of output samples
+    :return: Aligned sources [batch_size, num_sources, length, num_channels]
+    '''
+    num_samples = sources.shape[2].value
+    sources = tf.pad(sources, [[0, 0], [0, 0], [max(front, 0), max(length - num_samples - front, 0)], [0, 0]], "CONSTANT")
+    start = max(-front, 0)
+    return sources[:, :, start:start + length, :]
+
+def get_teacher_sources(mix, conditioning, model_config, output_start, output_length):
+    '''
+    Runs the frozen teacher separator on the mixture excerpts, with weights initialised from the teacher checkpoint
+    :param mix: Mixture excerpts as stored in the records
+    :param output_start: Position of the first student output sample in the mixture excerpt
+    :param output_length: Number of student output samples
+    :return: Teacher estimates aligned to the student output [batch_size, num_sources, output_length, num_channels]
+    '''
+    teacher_config = dict(model_config)
+    teacher_config.update(model_config["teacher_config"])
+    conditional = teacher_config["network"] == "unet"
+    teacher_class = Models.SeparatorFactory.get_separator(teacher_config, conditional=conditional)
+    teacher_input_shape, teacher_output_shape = teacher_class.get_padding(np.array([model_config["batch_size"], teacher_config["num_frames"], 0]))
+
+    crop_start = (mix.shape[1].value - teacher_input_shape[1]) // 2
+    teacher_start = crop_start + (teacher_input_shape[1] - teacher_output_shape[1]) // 2
+    assert(crop_start >= 0 and teacher_start <= output_start and teacher_start + teacher_output_shape[1] >= output_start + output_length) # Teacher has to cover the student output
+    mix = mix[:, crop_start:crop_start + teacher_input_shape[1], :]
+
+    with tf.variable_scope("teacher"):
+        if conditional:
+            teacher_sources = Utils.get_output_with_precision(teacher_class.get_output, model_config["precision"], mix, conditioning, False, reuse=False)
+        else:
+            teacher_sources = Utils.get_output_with_precision(teacher_class.get_output, model_config["precision"], mix, False, reuse=False)
+    tf.train.init_from_checkpoint(model_config["teacher_checkpoint"], {"separator/" : "teacher/separator/"})
+
+    teacher_sources = tf.stop_gradient(tf.stack(teacher_sources, axis=1))
+    offset = output_start - teacher_start
+    return teacher_sources[:, :, offset:offset + output_length, :]
+
+def accumulate_gradients(optimizer, grads_and_vars, global_step, num_steps, moving_average=None):
+    '''
+    Sums the gradients of num_steps consecutive micro-batches and applies their mean with the optimizer after the last
+    one, which trains like a batch num_steps times larger. The global step counts micro-batches
+    :param optimizer: Optimizer
+    :param grads_and_vars: Gradients of the current micro-batch as returned by optimizer.compute_gradients
+    :param global_step: Global step variable
+    :param num_steps: Number of micro-batches per optimizer step
+    :param moving_average: Optional tf.train.ExponentialMovingAverage of the trained variables, updated once per optimizer step
+    :return: Train op of one micro-batch
+    '''
+    grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+    with tf.variable_scope("gradient_accumulation"):
+        accumulators = [tf.get_variable(var.op.name, var.get_shape(), tf.float32, tf.zeros_initializer(), trainable=False)
+                        for _, var in grads_and_vars]
+    accumulate = [tf.assign_add(acc, tf.cast(grad, tf.float32)) for acc, (grad, _) in zip(accumulators, grads_and_vars)]
+
+    def apply_and_reset():
+        # apply_gradients and apply create the optimizer slots and moving averages inside the condition, but under
+        # init_scope, which lifts the variables and their initializers out of the condition into the outer graph
+        apply_op = optimizer.apply_gradients([(acc / float(num_steps), var) for acc, (_, var) in zip(accumulators, grads_and_vars)])
+        if moving_average is not None:
+            with tf.control_dependencies([apply_op]):
+                apply_op = moving_average.apply([var for _, var in grads_and_vars])
+        with tf.control_dependencies([apply_op]):
+            return tf.group(*[tf.assign(acc, tf.zeros_like(acc)) for acc in accumulators])
+
+    with tf.control_dependencies(accumulate):
+        apply = tf.cond(tf.equal((global_step + 1) % num_steps, 0), apply_and_reset, tf.no_op)
+    with tf.control_dependencies([apply]):
+        return tf.assign_add(global_step, 1).op
+
+def get_window_metrics(loss, grad_norm, window):
+    '''
+    Accumulates training metrics on the device over windows of steps, so the host only has to write them once per window
+    :param loss: Training loss of the current step
+    :param grad_norm: Global gradient norm of the current step
+    :param window: Number of steps per window
+    :return: Dictionary with mean, min and max loss and mean gradient norm of the current window including this step,
+             boolean tensor whether this step completes the window, and the op that updates (or, at the end of a window, resets) the accumulators
+    '''
+    with tf.variable_scope("training_metrics"):
+        sums = tf.get_variable("sums", [3], tf.float32, tf.zeros_initializer(), trainable=False) # Loss, gradient norm, number of steps
+        loss_min = tf.get_variable("loss_min", [], tf.float32, tf.constant_initializer(np.inf), trainable=False)
+        loss_max = tf.get_variable("loss_max", [], tf.float32, tf.constant_initializer(-np.inf), trainable=False)
+
+    loss = tf.cast(loss, tf.float32)
+    new_sums = sums + tf.stack([loss, tf.cast(grad_norm, tf.float32), 1.0])
+    new_min = tf.minimum(loss_min, loss)
+    new_max = tf.maximum(loss_max, loss)
+    flush = tf.greater_equal(new_sums[2], window)
+    update = tf.group(tf.assign(sums, tf.where(flush, tf.zeros([3]), new_sums)),
+                      tf.assign(loss_min, tf.where(flush, np.inf, new_min)),
+                      tf.assign(loss_max, tf.where(flush, -np.inf, new_max)))
+    metrics = {"loss_mean" : new_sums[0] / new_sums[2], "loss_min" : new_min, "loss_max" : new_max, "grad_norm" : new_sums[1] / new_sums[2]}
+    return metrics, flush, update
+
+class CheckpointThread(threading.Thread):
+    '''
+    Background thread that processes every new checkpoint of a training run until it is stopped
+    '''
+
+    def __init__(self, model_dir, poll_secs=60):
+        '''
+        :param model_dir: Folder with the training checkpoints
+        :param poll_secs: Seconds between checks for new checkpoints
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.model_dir = model_dir
+        self.poll_secs = poll_secs
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        '''
+        Stops the thread once it has processed the newest checkpoint
+        '''
+        self.stop_event.set()
+        self.join()
+
+    def checkpoints(self):
+        '''
+        :return: Generator of (checkpoint path, global step) for every new checkpoint, ends when the thread is stopped
+        '''
+        for checkpoint in tf.contrib.training.checkpoints_iterator(self.model_dir, min_interval_secs=self.poll_secs,
+                                                                   timeout=self.poll_secs, timeout_fn=self.stop_event.is_set):
+            yield checkpoint, int(tf.train.load_variable(checkpoint, tf.GraphKeys.GLOBAL_STEP))
+
+class AudioSummaryThread(CheckpointThread):
+    '''
+    Writes audio summaries of mixture, ground truth and estimated sources for a fixed sample of evaluation examples
+    whenever training writes a new checkpoint. Runs its own graph on the CPU of the host, so the training step does not
+    have to send audio batches to the host.
+    '''
+
+    def __init__(self, model_config, model_dir, num_examples=4, poll_secs=60):
+        '''
+        :param model_config: Model configuration dictionary
+        :param model_dir: Folder with the training checkpoints, audio summaries go to its "audio" subfolder
+        :param num_examples: Number of evaluation examples that are summarised
+        :param poll_secs: Seconds between checks for new checkpoints
+        '''
+        CheckpointThread.__init__(self, model_dir, poll_secs)
+        self.model_config = dict(model_config)
+        self.model_config.update({"precision" : "float32", "use_tpu" : False, "distillation" : False, "batch_size" : num_examples})
+        self.num_examples = num_examples
+
+    def run(self):
+        model_config = self.model_config
+        with tf.Graph().as_default():
+            dataset = urmp_input.URMPInput(mode="eval", data_dir=model_config["data_path"], precision="float32")
+            features, sources = dataset.input_fn({"batch_size" : self.num_examples}).make_one_shot_iterator().get_next()
+            tf.train.get_or_create_global_step()
+            spec = unet_separator(features, sources, tf.estimator.ModeKeys.EVAL, model_config)
+            gt_sources, est_sources = spec.eval_metrics[1]["labels"], spec.eval_metrics[1]["predictions"]
+
+            summaries = [tf.summary.audio('mix', tf.cast(features["mix"], tf.float32), model_config['expected_sr'], max_outputs=self.num_examples)]
+            for source_id in range(gt_sources.shape[1].value):
+                summaries.append(tf.summary.audio('gt_sources_{source_id}'.format(source_id=source_id), gt_sources[:, source_id, :, :],
+                                                  model_config['expected_sr'], max_outputs=self.num_examples))
+                summaries.append(tf.summary.audio('est_sources_{source_id}'.format(source_id=source_id), est_sources[:, source_id, :, :],
+                                                  model_config['expected_sr'], max_outputs=self.num_examples))
+            summary_op = tf.summary.merge(summaries)
+            saver = tf.train.Saver(tf.global_variables("separator"))
+            writer = tf.summary.FileWriter(os.path.join(self.model_dir, "audio"))
+
+            last_step = None
+            with tf.Session() as sess:
+                # Draw the sample once and feed it for every checkpoint, so all summaries show the same examples
+                sample = sess.run({"mix" : features["mix"], "labels" : features["labels"], "sources" : sources})
+                feed_dict = {features["mix"] : sample["mix"], features["labels"] : sample["labels"], sources : sample["sources"]}
+                for checkpoint, step in self.checkpoints():
+                    if last_step is not None and step - last_step < model_config["audio_summaries_every_n_steps"]:
+                        continue
+                    saver.restore(sess, checkpoint)
+                    writer.add_summary(sess.run(summary_op, feed_dict=feed_dict), step)
+                    writer.flush()
+                    last_step = step
+            writer.close()
+
+class EvaluationThread(CheckpointThread):
+    '''
+    Evaluates every new checkpoint on the CPU of the host while training continues, appends the results to a metrics
+    log and signals training to stop once the evaluation loss has not improved for a number of evaluations
+    '''
+
+    def __init__(self, model_config, model_dir, num_steps, patience=None, min_delta=0.0, poll_secs=60):
+        '''
+        :param model_config: Model configuration dictionary
+        :param model_dir: Folder with the training checkpoints. The metrics log is written to metrics.json in it
+        :param num_steps: Number of evaluation batches per checkpoint
+        :param patience: Number of evaluations without improvement after which training is stopped, None to never stop early
+        :param min_delta: Smallest decrease of the evaluation loss that counts as an improvement
+        :param poll_secs: Seconds between checks for new checkpoints
+        '''
+        CheckpointThread.__init__(self, model_dir, poll_secs)
+        self.model_config = dict(model_config)
+        self.model_config.update({"precision" : "float32", "use_tpu" : False, "distillation" : False})
+        self.num_steps = num_steps
+        self.patience = patience
+        self.min_delta = min_delta
+        self.stop_training = threading.Event()
+        self.metrics = list()
+        self.best = None
+
+    def run(self):
+        dataset = urmp_input.URMPInput(mode="eval", data_dir=self.model_config["data_path"], precision="float32")
+        evaluator = tf.estimator.Estimator(model_fn=cpu_separator, model_dir=self.model_dir, params=self.model_config,
+                                           config=tf.estimator.RunConfig(session_config=Utils.get_cpu_session_config(
+                                               self.model_config["cpu_intra_op_threads"], self.model_config["cpu_inter_op_threads"])))
+        start_time = time.time()
+        for checkpoint, step in self.checkpoints():
+            result = evaluator.evaluate(input_fn=dataset.input_fn, steps=self.num_steps, checkpoint_path=checkpoint, name="concurrent")
+            self.metrics.append({"step" : step, "loss" : float(result["loss"]), "mse" : float(result["mse"]), "seconds" : time.time() - start_time})
+            with tf.gfile.GFile(os.path.join(self.model_dir, "metrics.json"), "w") as f:
+                json.dump(self.metrics, f, indent=1)
+            tf.logging.info('Evaluation results at step %d: %s' % (step, self.metrics[-1]))
+
+            if self.best is None or self.metrics[-1]["loss"] < self.best["loss"] - self.min_delta:
+                self.best = self.metrics[-1]
+            elif self.patience is not None and len([m for m in self.metrics if m["step"] > self.best["step"]]) >= self.patience:
+                tf.logging.info("No improvement over step %d for %d evaluations, stopping training" % (self.best["step"], self.patience))
+                self.stop_training.set()
+
+class EarlyStoppingHook(tf.train.SessionRunHook):
+    '''
+    Stops training once an event is set, e.g. EvaluationThread.stop_training. With a TPUEstimator, training stops at the end of the current loop of iterations
+    '''
+
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+
+    def after_run(self, run_context, run_values):
+        if self.stop_event.is_set():
+            run_context.request_stop()
+
 @ex.capture
 def unet_separator(features, labels, mode, params):
 
     # Define host call function
-    def host_call_fn(gs, loss, lr,
-            mix=None,
-            gt_sources=None,
-            est_sources=None):
+    def host_call_fn(gs, loss_mean, loss_min, loss_max, grad_norm, lr, flush):
             """Training host call. Creates scalar summaries for training metrics.
             This function is executed on the CPU and should not directly reference
             any Tensors in the rest of the `model_fn`. To pass Tensors from the
@@ -143,30 +482,30 @@ def unet_separator(features, labels, mode, params):
             for more information.
             Arguments should match the list of `Tensor` objects passed as the second
             element in the tuple passed to `host_call`.
+            Metrics are accumulated on the device over windows of `summary_window` steps
+            (see get_window_metrics) and only written when a window is complete. Audio
+            summaries are written by an AudioSummaryThread instead.
             Args:
               gs: `Tensor with shape `[batch]` for the global_step
-              loss: `Tensor` with shape `[batch]` for the training loss.
+              loss_mean, loss_min, loss_max: `Tensor` with shape `[batch]` for the training loss over the window.
+              grad_norm: `Tensor` with shape `[batch]` for the mean global gradient norm over the window.
               lr: `Tensor` with shape `[batch]` for the learning_rate.
-              input: `Tensor` with shape `[batch, mix_samples, 1]`
-              gt_sources: `Tensor` with shape `[batch, sources_n, output_samples, 1]`
-              est_sources: `Tensor` with shape `[batch, sources_n, output_samples, 1]`
+              flush: `Tensor` with shape `[batch]`, whether this step completes a window
             Returns:
               List of summary ops to run on the CPU host.
             """
             gs = gs[0]
-            with summary.create_file_writer(model_config["model_base_dir"]+os.path.sep+str(model_config["experiment_id"])).as_default():
+            # The writer is created outside of the condition, so its initializer does not depend on flush and
+            # can run when the session is created, before any step
+            with summary.create_file_writer(get_model_dir(model_config)).as_default():
                 with summary.always_record_summaries():
-                    summary.scalar('loss', loss[0], step=gs)
-                    summary.scalar('learning_rate', lr[0], step=gs)
-                if gs % 10000 == 0:
-                    with summary.record_summaries_every_n_global_steps(model_config["audio_summaries_every_n_steps"]):
-                        summary.audio('mix', mix, model_config['expected_sr'], max_outputs=model_config["num_sources"])
-                        for source_id in range(gt_sources.shape[1].value):
-                            summary.audio('gt_sources_{source_id}'.format(source_id=source_id), gt_sources[:, source_id, :, :],
-                                          model_config['expected_sr'], max_outputs=model_config["num_sources"])
-                            summary.audio('est_sources_{source_id}'.format(source_id=source_id), est_sources[:, source_id, :, :],
-                                          model_config['expected_sr'], max_outputs=model_config["num_sources"])
-            return summary.all_summary_ops()
+                    def write_summaries():
+                        return tf.group(summary.scalar('loss', loss_mean[0], step=gs),
+                                        summary.scalar('loss_min', loss_min[0], step=gs),
+                                        summary.scalar('loss_max', loss_max[0], step=gs),
+                                        summary.scalar('gradient_norm', grad_norm[0], step=gs),
+                                        summary.scalar('learning_rate', lr[0], step=gs))
+                    return [tf.cond(tf.greater(flush[0], 0), write_summaries, tf.no_op)]
 
     mix = features['mix']
     conditioning = features['labels']
@@ -174,32 +513,53 @@ def unet_separator(features, labels, mode, params):
     model_config = params
     disc_input_shape = [model_config["batch_size"], model_config["num_frames"], 0]
 
-    with bfloat16.bfloat16_scope():
-        separator_class = Models.ConditionalUnetAudioSeparator.UnetAudioSeparator(
-            model_config["num_layers"], model_config["num_initial_filters"],
-            output_type=model_config["output_type"],
-            context=model_config["context"],
-            mono=model_config["mono_downmix"],
-            upsampling=model_config["upsampling"],
-            num_sources=model_config["num_sources"],
-            filter_size=model_config["filter_size"],
-            merge_filter_size=model_config["merge_filter_size"])
+    conditional = model_config["network"] == "unet"
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=conditional)
 
     sep_input_shape, sep_output_shape = separator_class.get_padding(np.array(disc_input_shape))
 
-    # Input context that the input audio has to be padded ON EACH SIDE
-    # TODO move this to dataset function
-    assert mix.shape[1].value == sep_input_shape[1]
+    full_mix = mix
+    num_source_frames = sources.shape[2].value if sources is not None else urmp_input.NUM_SAMPLES
+    source_start = (mix.shape[1].value - num_source_frames) // 2 # The stored sources are centred in the stored mixture
+    if model_config["network"] == "causal_unet":
+        # Causal model needs a long past but only a short future: cut its input out of the centred mixture excerpt,
+        # so that its output is aligned with the (unpadded) source excerpt
+        history = sep_input_shape[1] - sep_output_shape[1] - separator_class.lookahead
+        # Padding the missing past with silence would train on inputs the model never sees at inference
+        assert history <= source_start, "Past context of %d samples is longer than the %d stored in front of the sources, use fewer layers or dilations" % (history, source_start)
+        start = source_start - history
+        mix = mix[:, start:start + sep_input_shape[1], :]
+        output_start = source_start
+    else:
+        # Smaller networks need less input context than stored in the records, cut out the centre of the mixture
+        assert mix.shape[1].value >= sep_input_shape[1]
+        crop_start = (mix.shape[1].value - sep_input_shape[1]) // 2
+        mix = mix[:, crop_start:crop_start + sep_input_shape[1], :]
+        output_start = crop_start + (sep_input_shape[1] - sep_output_shape[1]) // 2
+
+    # Pad or crop the sources to the output of the separator
     if mode != tf.estimator.ModeKeys.PREDICT:
-        pad_tensor = tf.constant([[0, 0], [0, 0], [2, 3], [0, 0]])
-        sources = tf.pad(sources, pad_tensor, "CONSTANT")
+        sources = align_sources(sources, source_start - output_start, sep_output_shape[1])
+
+    if model_config["distillation"] and mode == tf.estimator.ModeKeys.TRAIN:
+        if "teacher_sources" in features: # Precomputed teacher estimates are stored like the sources
+            teacher_sources = align_sources(features["teacher_sources"], source_start - output_start, sep_output_shape[1])
+        else:
+            teacher_sources = get_teacher_sources(full_mix, conditioning, model_config, output_start, sep_output_shape[1])
+        teacher_sources = tf.cast(teacher_sources, tf.float32)
 
     separator_func = separator_class.get_output
 
-    # Compute loss.
-    separator_sources = tf.stack(separator_func(mix, conditioning,
-                                                True, not model_config["raw_audio_loss"],
-                                                reuse=False), axis=1)
+    # Compute loss. Separator runs in the precision of the input pipeline, loss and summaries in float32
+    if conditional:
+        separator_sources = Utils.get_output_with_precision(separator_func, model_config["precision"], mix, conditioning,
+                                                            True, not model_config["raw_audio_loss"], reuse=False)
+    else:
+        separator_sources = Utils.get_output_with_precision(separator_func, model_config["precision"], mix,
+                                                            True, not model_config["raw_audio_loss"], reuse=False)
+    separator_sources = tf.stack(separator_sources, axis=1)
+    mix = tf.cast(mix, tf.float32)
+    sources = tf.cast(sources, tf.float32)
 
     if mode == tf.estimator.ModeKeys.PREDICT:
         predictions = {
@@ -210,28 +570,22 @@ def unet_separator(features, labels, mode, params):
         }
         return tpu_estimator.TPUEstimatorSpec(mode, predictions=predictions)
 
-    separator_loss = tf.cast(tf.reduce_sum(tf.squared_difference(sources, separator_sources)), tf.float32)
+    separator_loss = tf.reduce_sum(tf.squared_difference(sources, separator_sources))
+    if model_config["distillation"] and mode == tf.estimator.ModeKeys.TRAIN:
+        teacher_loss = tf.reduce_sum(tf.squared_difference(teacher_sources, separator_sources))
+        separator_loss = (1.0 - model_config["distillation_weight"]) * separator_loss + model_config["distillation_weight"] * teacher_loss
 
     if mode != tf.estimator.ModeKeys.PREDICT:
         global_step = tf.train.get_global_step()
         sep_lr = tf.train.exponential_decay(
                      model_config['init_sup_sep_lr'],
-                     global_step,
+                     global_step // model_config["gradient_accumulation_steps"], # Decay per optimizer step
                      model_config['decay_steps'],
                      model_config['decay_rate'],
                      staircase=False,
                      name=None
                  )
 
-        gs_t = tf.reshape(global_step, [1])
-        loss_t = tf.reshape(separator_loss, [1])
-        lr_t = tf.reshape(sep_lr, [1])
-
-        if model_config["write_audio_summaries"]:
-            host_call = (host_call_fn, [gs_t, loss_t, lr_t, mix, sources, separator_sources])
-        else:
-            host_call = (host_call_fn, [gs_t, loss_t, lr_t, tf.zeros((1)), tf.zeros((1)), tf.zeros((1))])
-
     # Creating evaluation estimator
     if mode == tf.estimator.ModeKeys.EVAL:
         def metric_fn(labels, predictions):
@@ -244,7 +598,6 @@ def unet_separator(features, labels, mode, params):
         return tpu_estimator.TPUEstimatorSpec(
             mode=mode,
             loss=separator_loss,
-            host_call=host_call,
             eval_metrics=(metric_fn, eval_params))
 
 
@@ -252,27 +605,234 @@ def unet_separator(features, labels, mode, params):
     # TODO add learning rate schedule
     # TODO add early stopping
     if mode == tf.estimator.ModeKeys.TRAIN:
-        separator_vars = Utils.getTrainableVariables("separator")
+        separator_vars = tf.trainable_variables("separator") # Excludes a frozen teacher
         print("Sep_Vars: " + str(Utils.getNumParams(separator_vars)))
         print("Num of variables: " + str(len(tf.global_variables())))
 
         separator_solver = tf.train.AdamOptimizer(learning_rate=sep_lr)
+        if model_config["precision"] == "float16":
+            # Scale the loss so that small float16 gradients do not flush to zero, gradients are unscaled before the update
+            if model_config["loss_scale"] == "dynamic":
+                loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale=2**15, incr_every_n_steps=1000)
+            else:
+                loss_scale_manager = tf.contrib.mixed_precision.FixedLossScaleManager(model_config["loss_scale"])
+            separator_solver = tf.contrib.mixed_precision.LossScaleOptimizer(separator_solver, loss_scale_manager)
         if model_config["use_tpu"]:
             separator_solver = tpu_optimizer.CrossShardOptimizer(separator_solver)
 
-        train_op = separator_solver.minimize(separator_loss,
-                                             var_list=separator_vars,
-                                             global_step=global_step)
+        grads_and_vars = separator_solver.compute_gradients(separator_loss, var_list=separator_vars)
+        grad_norm = tf.global_norm([grad for grad, _ in grads_and_vars if grad is not None])
+        # Moving averages are stored next to the weights, see Checkpointing.ema_checkpoint
+        moving_average = tf.train.ExponentialMovingAverage(model_config["ema_decay"]) if model_config["weight_averaging"] == "ema" else None
+        if model_config["gradient_accumulation_steps"] > 1:
+            # Averages are only updated when the accumulated gradients are applied
+            train_op = accumulate_gradients(separator_solver, grads_and_vars, global_step, model_config["gradient_accumulation_steps"], moving_average)
+        else:
+            train_op = separator_solver.apply_gradients(grads_and_vars, global_step=global_step)
+            if moving_average is not None:
+                with tf.control_dependencies([train_op]):
+                    train_op = moving_average.apply(separator_vars)
+
+        metrics, flush, update_metrics = get_window_metrics(separator_loss, grad_norm, model_config["summary_window"])
+        train_op = tf.group(train_op, update_metrics)
+        host_call = (host_call_fn, [tf.reshape(global_step, [1])] +
+                     [tf.reshape(metrics[name], [1]) for name in ["loss_mean", "loss_min", "loss_max", "grad_norm"]] +
+                     [tf.reshape(sep_lr, [1]), tf.reshape(tf.cast(flush, tf.int32), [1])])
+        scaffold_fn = None
+        if model_config["warm_start_checkpoint"] is not None:
+            scaffold_fn = Checkpointing.get_warm_start_scaffold(model_config["warm_start_checkpoint"], separator_class, conditional,
+                                                                model_config["warm_start_source_map"])
         return tpu_estimator.TPUEstimatorSpec(mode=mode,
                                               loss=separator_loss,
                                               host_call=host_call,
-                                              train_op=train_op)
-
+                                              train_op=train_op,
+                                              scaffold_fn=scaffold_fn)
+
+
+def cpu_separator(features, labels, mode, params):
+    '''
+    Model function for training on CPU with a plain Estimator. Builds the same model as unet_separator and converts its
+    TPUEstimatorSpec, which runs the host call on the CPU after every step instead of sending its tensors through the outfeed
+    '''
+    if params["multi_head"]:
+        return multi_head_separator(features, labels, mode, params).as_estimator_spec()
+    if params["input_stall_analysis"] and mode == tf.estimator.ModeKeys.TRAIN:
+        features, labels = Profiling.mark_input_ready(features, labels)
+    return unet_separator(features, labels, mode, params).as_estimator_spec()
+
+def get_input_seed(model_config):
+    '''
+    :return: Seed of the training input. Without a fixed input_seed, runs that restart without saved input state see a
+             new example order instead of replaying the examples they already trained on, and resumable input uses the
+             experiment id, which stays the same when a run is restarted into its model folder
+    '''
+    if model_config["input_seed"] is not None:
+        return model_config["input_seed"]
+    if model_config["resumable_input"]:
+        return int(model_config["experiment_id"])
+    return None
+
+def get_multi_head_input_fn(model_config, mode):
+    '''
+    :param mode: 'train' or 'eval'
+    :return: Input function for multi_head_separator that reads one batch per head from the records in
+             model_config["head_data_paths"]. Features are the mixtures and conditioning labels of every head as
+             "<head>_mix" and "<head>_labels", labels a dictionary of the stored sources by head name. The "musdb" head
+             reads MusDB records, which store no labels: all of its sources are present
+    '''
+    datasets = list()
+    for name, num_sources, _ in model_config["heads"]:
+        data_dir = model_config["head_data_paths"][name]
+        if name == "musdb":
+            dataset = musdb_input.MusDBInput(is_training=(mode == "train"), data_dir=data_dir, precision=model_config["precision"])
+        else:
+            dataset = urmp_input.URMPInput(mode=mode, data_dir=data_dir, precision=model_config["precision"],
+                                           seed=get_input_seed(model_config), shuffle_buffer_size=model_config["shuffle_buffer_size"])
+        datasets.append((name, num_sources, dataset))
+
+    def merge(*batches):
+        features, sources = dict(), dict()
+        for (name, num_sources, _), (head_features, head_sources) in zip(datasets, batches):
+            features[name + "_mix"] = head_features["mix"]
+            if "labels" in head_features:
+                features[name + "_labels"] = head_features["labels"]
+            else:
+                features[name + "_labels"] = tf.ones([tf.shape(head_features["mix"])[0], num_sources], dtype=head_features["mix"].dtype)
+            sources[name] = head_sources
+        return features, sources
+
+    def input_fn(params):
+        return tf.data.Dataset.zip(tuple([dataset.input_fn(params) for _, _, dataset in datasets])).map(merge)
+    return input_fn
+
+def multi_head_separator(features, labels, mode, params):
+    '''
+    Model function for joint training of the multi-head separator on the batches of get_multi_head_input_fn: the
+    batch of every head goes through the shared encoder and the decoder of its head, and the weighted sum of the losses
+    of all heads is optimised. Starts from single-head checkpoints if model_config["encoder_checkpoint"] is set
+    '''
+    assert(mode != tf.estimator.ModeKeys.PREDICT) # Separate with MultiHeadUnetAudioSeparator.separate
+    model_config = params
+    separator = Models.SeparatorFactory.get_multi_head_separator(model_config)
+    sep_input_shape, sep_output_shape = separator.get_padding(np.array([model_config["batch_size"], model_config["num_frames"], 0]))
+
+    outputs, sources = dict(), dict()
+    for name, num_sources, _ in separator.heads:
+        mix = features[name + "_mix"]
+        head_sources = labels[name][:, :num_sources]
+        source_start = (mix.shape[1].value - head_sources.shape[2].value) // 2 # The stored sources are centred in the stored mixture
+        assert mix.shape[1].value >= sep_input_shape[1]
+        crop_start = (mix.shape[1].value - sep_input_shape[1]) // 2
+        mix = mix[:, crop_start:crop_start + sep_input_shape[1], :]
+        output_start = crop_start + (sep_input_shape[1] - sep_output_shape[1]) // 2
+        head_sources = tf.cast(align_sources(head_sources, source_start - output_start, sep_output_shape[1]), tf.float32)
+        sources[name] = [head_sources[:, i] for i in range(num_sources)]
+
+        # Every head is built on the encoder output of its own batch, the encoder variables are created by the first head
+        conditioning = {name : features[name + "_labels"][:, :num_sources]}
+        outputs[name] = Utils.get_output_with_precision(lambda input, *args, **kwargs: separator.get_output(input, *args, **kwargs)[name],
+                                                        model_config["precision"], mix, conditioning, True, reuse=tf.AUTO_REUSE, heads=[name])
+    loss = separator.get_joint_loss(outputs, sources, model_config["head_loss_weights"])
 
-@ex.automain
-def experiment(model_config):
-    tf.logging.set_verbosity(tf.logging.INFO)
-    tf.logging.info("SCRIPT START")
+    if mode == tf.estimator.ModeKeys.EVAL:
+        def metric_fn(**tensors):
+            return {"mse_" + name : tf.metrics.mean_squared_error(tensors[name + "_sources"], tensors[name + "_estimates"]) for name in separator.get_head_names()}
+
+        eval_params = dict()
+        for name in separator.get_head_names():
+            eval_params[name + "_sources"] = tf.stack(sources[name], axis=1)
+            eval_params[name + "_estimates"] = tf.stack(outputs[name], axis=1)
+        return tpu_estimator.TPUEstimatorSpec(mode=mode, loss=loss, eval_metrics=(metric_fn, eval_params))
+
+    global_step = tf.train.get_global_step()
+    sep_lr = tf.train.exponential_decay(model_config['init_sup_sep_lr'], global_step, model_config['decay_steps'], model_config['decay_rate'])
+    separator_solver = tf.train.AdamOptimizer(learning_rate=sep_lr)
+    if model_config["use_tpu"]:
+        separator_solver = tpu_optimizer.CrossShardOptimizer(separator_solver)
+    train_op = separator_solver.minimize(loss, global_step=global_step, var_list=tf.trainable_variables("separator"))
+
+    scaffold_fn = None
+    if model_config["encoder_checkpoint"] is not None:
+        def scaffold_fn():
+            # Only applies when training starts without a checkpoint in the model folder
+            separator.warm_start(model_config["encoder_checkpoint"], model_config["head_checkpoints"])
+            return tf.train.Scaffold()
+    return tpu_estimator.TPUEstimatorSpec(mode=mode, loss=loss, train_op=train_op, scaffold_fn=scaffold_fn)
+
+def train_multi_head(model_config):
+    '''
+    Trains the multi-head separator jointly on the records of all heads and evaluates it. Joint training optimises every
+    step with Adam in the precision policy and writes only the loss summaries of the Estimator
+    '''
+    # Training options of unet_separator and the experiment that joint training does not implement
+    assert(model_config["gradient_accumulation_steps"] == 1)
+    assert(model_config["weight_averaging"] is None)
+    assert(model_config["precision"] != "float16") # No loss scaling
+    assert(not model_config["concurrent_evaluation"])
+    assert(model_config["curriculum"] is None)
+    assert(not model_config["resumable_input"])
+    assert(not model_config["input_stall_analysis"])
+    assert(not model_config["distillation"])
+    assert(model_config["warm_start_checkpoint"] is None) # Use encoder_checkpoint and head_checkpoints
+    separator = get_estimator(model_config)
+    hooks = list()
+    if model_config["checkpoint_on_preemption"]:
+        preemption = Checkpointing.PreemptionHook()
+        hooks.append(preemption)
+    separator.train(input_fn=get_multi_head_input_fn(model_config, "train"), steps=model_config["training_steps"], hooks=hooks)
+    if model_config["checkpoint_on_preemption"] and preemption.preempted:
+        tf.logging.info("Training preempted, final checkpoint written")
+        return
+
+    eval_result = separator.evaluate(input_fn=get_multi_head_input_fn(model_config, "eval"), steps=model_config["evaluation_steps"])
+    tf.logging.info('Evaluation results: %s' % eval_result)
+
+def get_curriculum_phases(model_config):
+    '''
+    :return: List of (model configuration, first step, last step) for every phase of the segment-length curriculum, or
+             a single phase over all training steps without curriculum
+    '''
+    if model_config["curriculum"] is None:
+        return [(model_config, 0, model_config["training_steps"])]
+    assert(model_config["network"] == "unet")
+    starts = [start for start, _ in model_config["curriculum"]] + [model_config["training_steps"]]
+    return [(dict(model_config, num_frames=num_frames), starts[i], starts[i+1]) for i, (_, num_frames) in enumerate(model_config["curriculum"])]
+
+def get_excerpt_lengths(model_config):
+    '''
+    :return: Mixture and source excerpt lengths the separator of a model configuration needs, for urmp_input.URMPInput
+    '''
+    separator_class = Models.SeparatorFactory.get_separator(model_config, conditional=model_config["network"] == "unet")
+    sep_input_shape, sep_output_shape = separator_class.get_padding(np.array([model_config["batch_size"], model_config["num_frames"], 0]))
+    return sep_input_shape[1], sep_output_shape[1]
+
+def get_model_dir(model_config):
+    '''
+    :return: Folder the training run writes its checkpoints and summaries to
+    '''
+    if model_config["local_checkpoint_dir"] is not None:
+        assert(not model_config["use_tpu"]) # The TPU writes checkpoints itself and can not reach the local disk of this machine
+        return model_config["local_checkpoint_dir"]
+    return model_config['model_base_dir'] + os.path.sep + str(model_config["experiment_id"])
+
+def get_estimator(model_config):
+    '''
+    Creates a TPUEstimator if model_config["use_tpu"] is set, otherwise an Estimator that trains on all CPU cores of this machine
+    :param model_config: Model configuration dictionary
+    :return: Estimator with unet_separator (or multi_head_separator) as model function
+    '''
+    model_dir = get_model_dir(model_config)
+    if not model_config["use_tpu"]:
+        # Tensorflow has no bfloat16 convolution kernels for the CPU, set precision to 'float32' or 'float16' to train without a TPU
+        assert(model_config["precision"] in ["float32", "float16"])
+        tf.logging.info("Assigning CPU Estimator")
+        config = tf.estimator.RunConfig(
+            model_dir=model_dir,
+            save_checkpoints_steps=500,
+        keep_checkpoint_max=Checkpointing.KEEP_CHECKPOINT_MAX,
+            save_summary_steps=250,
+            session_config=Utils.get_cpu_session_config(model_config["cpu_intra_op_threads"], model_config["cpu_inter_op_threads"]))
+        return tf.estimator.Estimator(model_fn=cpu_separator, config=config, params=dict(model_config))
 
     tf.logging.info("TPU resolver started")
 
@@ -282,26 +842,19 @@ def experiment(model_config):
         zone=os.environ['PROJECT_ZONE'])
     config = tpu_config.RunConfig(
         cluster=tpu_cluster_resolver,
-        model_dir=model_config['model_base_dir'] + os.path.sep + str(model_config["experiment_id"]),
+        model_dir=model_dir,
         save_checkpoints_steps=500,
+        keep_checkpoint_max=Checkpointing.KEEP_CHECKPOINT_MAX,
         save_summary_steps=250,
         tpu_config=tpu_config.TPUConfig(
             iterations_per_loop=500,
             num_shards=8,
             per_host_input_for_training=tpu_config.InputPipelineConfig.PER_HOST_V1))  # pylint: disable=line-too-long
 
-    tf.logging.info("Creating datasets")
-    urmp_train, urmp_eval, urmp_test = [urmp_input.URMPInput(
-        mode=mode,
-        data_dir=model_config['data_path'],
-        transpose_input=False,
-        use_bfloat16=model_config['use_bfloat16']) for mode in ['train', 'eval', 'test']]
-
     tf.logging.info("Assigning TPUEstimator")
-    # Optimize in a +supervised fashion until validation loss worsens
-    separator = tpu_estimator.TPUEstimator(
+    return tpu_estimator.TPUEstimator(
         use_tpu=model_config["use_tpu"],
-        model_fn=unet_separator,
+        model_fn=multi_head_separator if model_config["multi_head"] else unet_separator,
         config=config,
         train_batch_size=model_config['batch_size'],
         eval_batch_size=model_config['batch_size'],
@@ -309,17 +862,100 @@ def experiment(model_config):
         params={i: model_config[i] for i in model_config if i != 'batch_size'}
     )
 
+@ex.automain
+def experiment(model_config):
+    tf.logging.set_verbosity(tf.logging.INFO)
+    tf.logging.info("SCRIPT START")
+
+    assert(model_config["weight_averaging"] in [None, "ema", "last_n"])
+    if model_config["weight_averaging"] == "last_n":
+        assert(model_config["average_checkpoints"] <= Checkpointing.KEEP_CHECKPOINT_MAX) # Older checkpoints are deleted before they are averaged
+    if model_config['multi_head']:
+        assert(model_config['mode'] == 'train_and_eval')
+        train_multi_head(model_config)
+        return
+
+    tf.logging.info("Creating datasets")
+    use_teacher_cache = model_config['distillation'] and model_config['teacher_cache'] is not None
+    urmp_train, urmp_eval, urmp_test = [urmp_input.URMPInput(
+        mode=mode,
+        data_dir=model_config['teacher_cache'] if (mode == 'train' and use_teacher_cache) else model_config['data_path'],
+        transpose_input=False,
+        precision=model_config['precision'],
+        teacher_outputs=(mode == 'train' and use_teacher_cache),
+        seed=get_input_seed(model_config),
+        resumable=model_config['resumable_input'],
+        shuffle_buffer_size=model_config['shuffle_buffer_size']) for mode in ['train', 'eval', 'test']]
+    if model_config['resumable_input']:
+        assert(not model_config['use_tpu']) # The TPUEstimator reads its input in a separate infeed graph whose iterator is not saved
+
+    # Optimize in a +supervised fashion until validation loss worsens
+    separator = get_estimator(model_config)
+
     if model_config['load_model']:
         tf.logging.info("Load the model")
-        current_step = estimator._load_global_step_from_checkpoint_dir(
-            model_config['model_base_dir'] + os.path.sep + str(model_config["experiment_id"]))
+        current_step = estimator._load_global_step_from_checkpoint_dir(get_model_dir(model_config))
 
     if model_config['mode'] == 'train_and_eval':
         tf.logging.info("Train the model")
-        # Should be an early stopping here, but it will come with tf 1.10
-        separator.train(
-            input_fn=urmp_train.input_fn,
-            steps=model_config['training_steps'])
+        checkpoint_threads = list()
+        hooks = list()
+        if model_config["write_audio_summaries"]:
+            checkpoint_threads.append(AudioSummaryThread(model_config, separator.model_dir, model_config["audio_summary_examples"]))
+        if model_config["concurrent_evaluation"]:
+            evaluation = EvaluationThread(model_config, separator.model_dir, model_config["concurrent_evaluation_steps"],
+                                          model_config["early_stopping_patience"], model_config["early_stopping_min_delta"])
+            checkpoint_threads.append(evaluation)
+            hooks.append(EarlyStoppingHook(evaluation.stop_training))
+        if model_config["input_stall_analysis"]:
+            input_examples_per_second = Profiling.measure_input_throughput(urmp_train.input_fn, {"batch_size" : model_config["batch_size"]})
+            example_bytes = (urmp_input.MIX_WITH_PADDING + urmp_input.NUM_SOURCES * urmp_input.NUM_SAMPLES) * 4 # Float32 audio in the records
+            hooks.append(Profiling.InputStallHook(separator.model_dir, model_config["batch_size"], example_bytes,
+                                                  model_config["input_stall_window"], input_examples_per_second))
+        if model_config["local_checkpoint_dir"] is not None:
+            checkpoint_threads.append(Checkpointing.get_uploader(model_config, separator.model_dir))
+        for thread in checkpoint_threads:
+            thread.start()
+        if model_config["checkpoint_on_preemption"]:
+            preemption = Checkpointing.PreemptionHook()
+            hooks.append(preemption)
+        if model_config["curriculum"] is None:
+            separator.train(
+                input_fn=urmp_train.saveable_input_fn if model_config['resumable_input'] else urmp_train.input_fn,
+                steps=model_config['training_steps'],
+                hooks=hooks)
+        else:
+            # Same weights for all segment lengths, only the excerpts and the graph change between phases
+            for phase_config, start_step, end_step in get_curriculum_phases(model_config):
+                tf.logging.info("Curriculum phase from step %d: num_frames %d" % (start_step, phase_config["num_frames"]))
+                input_length, output_length = get_excerpt_lengths(phase_config)
+                phase_train = urmp_input.URMPInput(
+                    mode='train',
+                    data_dir=model_config['teacher_cache'] if use_teacher_cache else model_config['data_path'],
+                    transpose_input=False,
+                    precision=model_config['precision'],
+                    teacher_outputs=use_teacher_cache,
+                    input_length=input_length,
+                    output_length=output_length,
+                    seed=get_input_seed(model_config),
+                    resumable=model_config['resumable_input'],
+                    shuffle_buffer_size=model_config['shuffle_buffer_size'])
+                get_estimator(phase_config).train(
+                    input_fn=phase_train.saveable_input_fn if model_config['resumable_input'] else phase_train.input_fn,
+                    max_steps=end_step,
+                    hooks=hooks)
+                if model_config["checkpoint_on_preemption"] and preemption.preempted:
+                    break
+                if model_config["concurrent_evaluation"] and evaluation.stop_training.is_set():
+                    tf.logging.info("Early stopping, skipping the remaining curriculum phases")
+                    break
+        for thread in checkpoint_threads:
+            thread.stop()
+        if model_config["concurrent_evaluation"] and evaluation.best is not None:
+            tf.logging.info('Best evaluation results: %s' % evaluation.best)
+        if model_config["checkpoint_on_preemption"] and preemption.preempted:
+            tf.logging.info("Training preempted, final checkpoint written")
+            return
 
         tf.logging.info("Supervised training finished!")
         tf.logging.info("Evaluate model")
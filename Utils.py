@@ -1,8 +1,73 @@
 import os
+import contextlib
 import tensorflow as tf
 import numpy as np
 import librosa
 from google.cloud import storage
+from tensorflow.contrib.tpu.python.tpu import bfloat16
+
+from FrozenGraph import get_session_config # Session configuration for inference, defined with the frozen graph loader
+
+PRECISIONS = {"float32": tf.float32, "float16": tf.float16, "bfloat16": tf.bfloat16}
+
+def get_compute_dtype(precision):
+    '''
+    Data type that activations (and input audio) use under a precision policy
+    :param precision: Name of the precision policy, one of "float32", "float16" or "bfloat16"
+    :return: Tensorflow dtype
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision policy " + str(precision) + ", use one of " + str(sorted(PRECISIONS.keys())))
+    return PRECISIONS[precision]
+
+def _float32_variable_getter(getter, name, shape=None, dtype=None, trainable=True, *args, **kwargs):
+    # Keep float32 master weights for float16 layers, layers see a float16 copy
+    variable = getter(name, shape, dtype=tf.float32 if trainable else dtype, trainable=trainable, *args, **kwargs)
+    if trainable and dtype is not None and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+@contextlib.contextmanager
+def _no_scope():
+    yield
+
+def precision_scope(precision):
+    '''
+    Variable scope for building a model under a precision policy. Variables are always stored in float32, layers
+    receive them cast to the compute dtype of the policy
+    :param precision: Name of the precision policy
+    :return: Context manager
+    '''
+    get_compute_dtype(precision)
+    if precision == "bfloat16":
+        return bfloat16.bfloat16_scope()
+    elif precision == "float16":
+        return tf.variable_scope(tf.get_variable_scope(), custom_getter=_float32_variable_getter)
+    else:
+        return _no_scope()
+
+def get_output_with_precision(separator_func, precision, input, *args, **kwargs):
+    '''
+    Builds the separator output under a precision policy for a float32 input and returns float32 source estimates
+    :param separator_func: get_output function of a separator
+    :param precision: Name of the precision policy
+    :param input: Mixture input tensor, any float dtype
+    :return: List of float32 source estimates
+    '''
+    with precision_scope(precision):
+        outputs = separator_func(tf.cast(input, get_compute_dtype(precision)), *args, **kwargs)
+    return [tf.cast(output, tf.float32) for output in outputs]
+
+def get_cpu_session_config(intra_op_threads=0, inter_op_threads=0):
+    '''
+    Session configuration for training on CPU
+    :param intra_op_threads: Threads that parallelise a single op such as a convolution, 0 to use all cores
+    :param inter_op_threads: Threads that run independent ops concurrently, 0 to use all cores. The separator is mostly a
+    chain of large convolutions, so a few inter-op threads and all cores for intra-op parallelism usually scale best
+    :return: tf.ConfigProto
+    '''
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads,
+                          allow_soft_placement=True)
 
 
 # Slice up matrices into squares so the neural net gets a consistent size for training (doesnd't matter for inference)
@@ -30,9 +95,20 @@ def crop_and_concat(x1,x2, match_feature_dim=True):
     :param x2: Second input
     :return: Combined feature map
     '''
-    x1 = crop(x1,x2.get_shape().as_list(), match_feature_dim)
+    x1 = crop(x1,get_shape(x2), match_feature_dim)
     return tf.concat([x1, x2], axis=2)
 
+def get_shape(tensor):
+    '''
+    Shape of a tensor for shape computations that should work with static and dynamic shapes
+    :param tensor: Input tensor
+    :return: Static shape as list if it is fully known, otherwise the dynamic shape as 1D int32 tensor
+    '''
+    shape = tensor.get_shape().as_list()
+    if None in shape:
+        return tf.shape(tensor)
+    return shape
+
 def sdr_loss(reference_signals, estimates):
     loss = 0
     for i in range(len(reference_signals)):
@@ -94,28 +170,25 @@ def learned_interpolation_layer(input, padding, level):
     # Construct 2FxF weight matrix, where F is the number of feature channels in the feature map.
     # Matrix is constrained, made up out of two diagonal FxF matrices with diagonal weights w and 1-w. w is constrained to be in [0,1] # mioid
     weights = tf.get_variable("interp_" + str(level), shape=[features], dtype=tf.float32)
-    weights_scaled = tf.nn.sigmoid(weights) # Constrain weights to [0,1]
+    weights_scaled = tf.nn.sigmoid(tf.cast(weights, input.dtype)) # Constrain weights to [0,1]
     counter_weights = 1.0 - weights_scaled # Mirrored weights for the features from the other time step
     conv_weights = tf.expand_dims(tf.concat([tf.expand_dims(tf.diag(weights_scaled), axis=0), tf.expand_dims(tf.diag(counter_weights), axis=0)], axis=0), axis=0)
     intermediate_vals = tf.nn.conv2d(input, conv_weights, strides=[1,1,1,1], padding=padding.upper())
     #intermediate_vals = tf.layers.conv2d(input, features, [1,2], padding=padding)
 
-    intermediate_vals = tf.transpose(intermediate_vals, [2, 0, 1, 3])
-    out = tf.transpose(input, [2, 0, 1, 3])
-    num_entries = out.get_shape().as_list()[0]
-    out = tf.concat([out, intermediate_vals], axis=0)
-    indices = list()
-
-    # Interleave interpolated features with original ones, starting with the first original one
-    num_outputs = (2*num_entries - 1) if padding == "valid" else 2*num_entries
-    for idx in range(num_outputs):
-        if idx % 2 == 0:
-            indices.append(idx // 2)
-        else:
-            indices.append(num_entries + idx//2)
-    out = tf.gather(out, indices)
-    current_layer = tf.transpose(out, [1, 2, 0, 3])
-    return current_layer
+    # Interleave interpolated features with original ones, starting with the first original one. Uses the dynamic shape,
+    # so the width (and batch size) may be unknown as in shape-polymorphic inference graphs
+    originals = input[:, :, :-1, :] if padding == "valid" else input
+    out = tf.stack([originals, intermediate_vals], axis=3) # [batch_size, 1, num_intermediate, 2, F]
+    shape = tf.shape(out)
+    out = tf.reshape(out, [shape[0], 1, shape[2] * 2, features])
+    if padding == "valid":
+        out = tf.concat([out, input[:, :, -1:, :]], axis=2) # Last original feature vector has no successor
+    static_shape = input.get_shape().as_list()
+    if static_shape[2] is not None:
+        num_entries = static_shape[2]
+        out.set_shape([static_shape[0], 1, (2*num_entries - 1) if padding == "valid" else 2*num_entries, features])
+    return out
 
 def LeakyReLU(x, alpha=0.2):
     return tf.maximum(alpha*x, x)
@@ -182,9 +255,15 @@ def crop(tensor, target_shape, match_feature_dim=True):
     Crops a 3D tensor [batch_size, width, channels] along the width axes to a target shape.
     Performs a centre crop. If the dimension difference is uneven, crop last dimensions first.
     :param tensor: 4D tensor [batch_size, width, height, channels] that should be cropped.
-    :param target_shape: Target shape (4D tensor) that the tensor should be cropped to
+    :param target_shape: Target shape (4D tensor) that the tensor should be cropped to. Can be a shape tensor if shapes are only known at runtime (see get_shape)
     :return: Cropped tensor
     '''
+    if isinstance(target_shape, tf.Tensor) or None in tensor.get_shape().as_list():
+        # Dynamic shapes: Same centre crop, computed in the graph
+        diff = tf.shape(tensor)[1] - target_shape[1]
+        crop_start = diff // 2
+        return tensor[:,crop_start:crop_start + target_shape[1],:]
+
     shape = np.array(tensor.get_shape().as_list())
     diff = shape - np.array(target_shape)
     assert(diff[0] == 0 and (diff[2] == 0 or not match_feature_dim))# Only width axis can differ